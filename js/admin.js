@@ -62,6 +62,7 @@ libraryAdminApp.controller('libraryInfoCtrl', function($scope, averageFines) {
     $scope.search = function() {
         var toSearch = $scope.toSearch;
         $scope.copiesData = copiesResource.get({
+            stream: 'json',
             book_id: toSearch.book.book_id,
             lib_id: toSearch.branch.lib_id,
             number: toSearch.number,
@@ -91,7 +92,7 @@ libraryAdminApp.config(['$resourceProvider', function($resourceProvider) {
         controller: 'branchInfoCtrl',
         resolve: {
             branchesData: function(branchesResource) {
-                return branchesResource.get().$promise;
+                return branchesResource.get({stream: 'json'}).$promise;
             }
         }
     }).state('addReader', {
@@ -104,10 +105,10 @@ libraryAdminApp.config(['$resourceProvider', function($resourceProvider) {
         controller: 'addCopyCtrl',
         resolve: {
             branchesData: function(branchesResource) {
-                return branchesResource.get().$promise;
+                return branchesResource.get({stream: 'json'}).$promise;
             },
             booksData: function(booksResource) {
-                return booksResource.get().$promise;
+                return booksResource.get({stream: 'json'}).$promise;
             }
         }
     }).state('searchCopies', {
@@ -116,10 +117,10 @@ libraryAdminApp.config(['$resourceProvider', function($resourceProvider) {
         controller: 'searchCopyCtrl',
         resolve: {
             branchesData: function(branchesResource) {
-                return branchesResource.get().$promise;
+                return branchesResource.get({stream: 'json'}).$promise;
             },
             booksData: function(booksResource) {
-                return booksResource.get().$promise;
+                return booksResource.get({stream: 'json'}).$promise;
             }
         }
     });
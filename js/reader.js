@@ -144,7 +144,8 @@ libraryReaderApp.controller('HomeCtrl', function($scope, reader) {
 }).controller('SearchCtrl', function($scope, BooksResource) {
     $scope.query = function() {
         $scope.isCollapsed = true;
-        $scope.data = BooksResource.get($scope.search)
+        $scope.data = BooksResource.get(
+            angular.extend({stream: 'json'}, $scope.search));
     }
 }).controller('BookDetailCtrl', function($scope, $stateParams, $interval, BookResource, readerId) {
     $scope.readerId = readerId;
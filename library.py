@@ -1,21 +1,367 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from __future__ import print_function
-from datetime import datetime
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from decimal import Decimal
 from __builtin__ import tuple
+import Queue
+import argparse
+import csv
 import os
+import re
 import sqlite3
+import sys
+import threading
+import time
 
 __author__ = 'shunghsiyu'
 date_format = '%Y-%m-%d'
 datetime_format = '%Y-%m-%d %H:%M:%S.%f'
 
+# Process-wide sqlite3 settings, done once on import rather than per connection
+sqlite3.register_adapter(bool, int)
+sqlite3.register_converter("BOOLEAN", lambda v: v != '0')
+
+# Marks a relation that has not been prefetched and must be queried lazily
+_unloaded = object()
+
+
+def _page_values(limit=None, after=None):
+    """Values for a keyset-paginated ``WHERE pk > ? ... LIMIT ?`` query."""
+    return (after or 0, -1 if limit is None else limit)
+
+
+def _parse_datetime(value):
+    try:
+        return datetime.strptime(value, datetime_format)
+    except ValueError:
+        # str(datetime) leaves out the fraction when it is zero
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+
+def _match_query(text):
+    """FTS5 query matching every word of ``text`` as a prefix, or None."""
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8')
+    words = re.findall(r'\w+', text, re.UNICODE)
+    if not words:
+        return None
+    return u' '.join(u'"{}"*'.format(word) for word in words)
+
+
+# UPDATE ... RETURNING arrived in SQLite 3.35
+_has_returning = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+def _iter_rows(conn, query, values=(), chunk_size=1000):
+    """Yield the rows of ``query`` reading at most ``chunk_size`` at a time."""
+    try:
+        c = conn.cursor()
+        c.execute(query, values)
+        while True:
+            rows = c.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    except sqlite3.Error:
+        raise
+
+
+def _inserted_ids(c):
+    """Ids of the rows just inserted by ``c.executemany``.
+
+    All the rows go in within one transaction that holds the write lock, so
+    their AUTOINCREMENT ids are consecutive and end at last_insert_rowid().
+    """
+    count = c.rowcount
+    if count <= 0:
+        return []
+    c.execute('SELECT last_insert_rowid()')
+    last_id = c.fetchone()[0]
+    return list(range(last_id - count + 1, last_id + 1))
+
+
+def _select_in(conn, query, ids, chunk_size=500):
+    """Run ``query`` with its ``IN ({})`` placeholder bound to ``ids``.
+
+    The ids are sent in chunks so that large batches stay below SQLite's
+    limit on host parameters.
+    """
+    ids = list(ids)
+    rows = []
+    for i in range(0, len(ids), chunk_size):
+        chunk = ids[i:i + chunk_size]
+        try:
+            c = conn.cursor()
+            c.execute(query.format(','.join('?' * len(chunk))), tuple(chunk))
+            rows.extend(c.fetchall())
+        except sqlite3.Error:
+            raise
+
+    return rows
+
+
+class IdentityMap(object):
+    """Hands out a single entity instance per primary key for as long as
+    the connection it is attached to lives, until a write clears it.
+    """
+
+    def __init__(self):
+        self._entities = {}
+
+    def get(self, cls, key):
+        return self._entities.get((cls, key))
+
+    def add(self, entity, key):
+        return self._entities.setdefault((type(entity), key), entity)
+
+    def clear(self):
+        for entity in self._entities.values():
+            expire = getattr(entity, 'expire', None)
+            if expire is not None:
+                expire()
+        self._entities.clear()
+
+
+_in_list = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+_normalized = {}
+
+
+def normalize_sql(sql):
+    """``sql`` on one line, with ``IN (?, ?, ...)`` lists shortened to
+    ``IN (?...)`` so that every run of a statement reads the same.
+    """
+    normalized = _normalized.get(sql)
+    if normalized is None:
+        normalized = _in_list.sub('IN (?...)', ' '.join(sql.split()))
+        if len(_normalized) >= 1024:
+            _normalized.clear()
+        _normalized[sql] = normalized
+    return normalized
+
+
+class LoggedStatement(object):
+    """One execution of a statement recorded in a QueryLog. ``rows`` counts
+    the rows fetched, or changed by an INSERT, UPDATE or DELETE; ``seconds``
+    covers the execution and the fetches.
+    """
+    __slots__ = ('sql', 'parameters', 'rows', 'seconds', 'plan')
+
+    def __init__(self, sql, parameters, rows, seconds):
+        self.sql = sql
+        self.parameters = parameters
+        self.rows = rows
+        self.seconds = seconds
+        # The EXPLAIN QUERY PLAN details of a slow statement, once the log
+        # has explained it
+        self.plan = None
+
+
+class QueryLog(object):
+    """The statements run on a connection while the log is set as its
+    ``query_log``. Those that take ``slow_seconds`` or more are slow, and
+    ``explain`` reads their plans.
+    """
+
+    def __init__(self, slow_seconds=None):
+        self.slow_seconds = slow_seconds
+        self.statements = []
+        # (statement, sql, parameters) of the slow statements to explain
+        self.unexplained = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    @property
+    def seconds(self):
+        return sum(statement.seconds for statement in self.statements)
+
+    def slow(self):
+        if self.slow_seconds is None:
+            return []
+        return [statement for statement in self.statements
+                if statement.seconds >= self.slow_seconds]
+
+    def explain(self, conn):
+        """Read the plans of the slow statements on ``conn``.
+
+        Python 2's sqlite3 commits the open transaction before any statement
+        other than a SELECT, INSERT, UPDATE, DELETE or REPLACE, an EXPLAIN
+        included, so ``conn`` should be another connection to the database,
+        or the one the statements ran on once their transaction is over.
+        """
+        unexplained, self.unexplained = self.unexplained, []
+        # A plain cursor, so that the EXPLAIN is not logged itself
+        c = sqlite3.Cursor(conn)
+        try:
+            for statement, sql, parameters in unexplained:
+                try:
+                    c.execute('EXPLAIN QUERY PLAN ' + sql, parameters)
+                    statement.plan = [row[-1] for row in c.fetchall()]
+                except sqlite3.Error as e:
+                    statement.plan = ['(no plan: {})'.format(e)]
+        finally:
+            c.close()
+
+
+class QueryCursor(sqlite3.Cursor):
+    """Cursor that records what it runs in its connection's query log, if
+    the connection has one; without one it only costs a method call.
+    """
+    _statement = None
+    _slow = False
+
+    def execute(self, sql, parameters=()):
+        log = self.connection.query_log
+        if log is None:
+            return sqlite3.Cursor.execute(self, sql, parameters)
+        started = time.time()
+        try:
+            return sqlite3.Cursor.execute(self, sql, parameters)
+        finally:
+            self._record(log, sql, parameters, len(parameters),
+                         time.time() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        log = self.connection.query_log
+        if log is None:
+            return sqlite3.Cursor.executemany(self, sql, seq_of_parameters)
+        bound = [0, None]
+
+        def counted():
+            for parameters in seq_of_parameters:
+                bound[0] += len(parameters)
+                if bound[1] is None:
+                    bound[1] = parameters
+                yield parameters
+        started = time.time()
+        try:
+            return sqlite3.Cursor.executemany(self, sql, counted())
+        finally:
+            self._record(log, sql, bound[1] or (), bound[0],
+                         time.time() - started)
+
+    def executescript(self, sql_script):
+        log = self.connection.query_log
+        if log is None:
+            return sqlite3.Cursor.executescript(self, sql_script)
+        started = time.time()
+        try:
+            return sqlite3.Cursor.executescript(self, sql_script)
+        finally:
+            self._statement = None
+            log.statements.append(LoggedStatement(
+                normalize_sql(sql_script), 0, 0, time.time() - started))
+
+    def fetchone(self):
+        if self._statement is None:
+            return sqlite3.Cursor.fetchone(self)
+        started = time.time()
+        row = sqlite3.Cursor.fetchone(self)
+        self._fetched(row is not None, time.time() - started)
+        return row
+
+    def fetchmany(self, *args):
+        if self._statement is None:
+            return sqlite3.Cursor.fetchmany(self, *args)
+        started = time.time()
+        rows = sqlite3.Cursor.fetchmany(self, *args)
+        self._fetched(len(rows), time.time() - started)
+        return rows
+
+    def fetchall(self):
+        if self._statement is None:
+            return sqlite3.Cursor.fetchall(self)
+        started = time.time()
+        rows = sqlite3.Cursor.fetchall(self)
+        self._fetched(len(rows), time.time() - started)
+        return rows
+
+    def _record(self, log, sql, parameters, count, seconds):
+        statement = LoggedStatement(normalize_sql(sql), count,
+                                    max(self.rowcount, 0), seconds)
+        log.statements.append(statement)
+        self._statement = statement
+        self._sql = sql
+        self._parameters = parameters
+        self._log = log
+        self._slow = False
+        self._check_slow()
+
+    def _fetched(self, rows, seconds):
+        self._statement.rows += rows
+        self._statement.seconds += seconds
+        self._check_slow()
+
+    def _check_slow(self):
+        # Explaining it now would commit the transaction it runs in, so the
+        # log does later
+        slow_seconds = self._log.slow_seconds
+        if self._slow or slow_seconds is None or \
+                self._statement.seconds < slow_seconds:
+            return
+        self._slow = True
+        self._log.unexplained.append((self._statement, self._sql,
+                                      self._parameters))
+
+
+class LibraryConnection(sqlite3.Connection):
+    # A QueryLog to record the statements run through cursor() in, if any
+    query_log = None
+
+    def __init__(self, *args, **kwargs):
+        super(LibraryConnection, self).__init__(*args, **kwargs)
+        self.identity_map = IdentityMap()
+
+    def cursor(self, factory=QueryCursor):
+        return super(LibraryConnection, self).cursor(factory)
+
+    def close(self):
+        self.identity_map = IdentityMap()
+        super(LibraryConnection, self).close()
+
+
+def _lookup(conn, cls, key):
+    identity_map = getattr(conn, 'identity_map', None)
+    if identity_map is None:
+        return None
+    return identity_map.get(cls, key)
+
+
+def _register(conn, entity, key):
+    identity_map = getattr(conn, 'identity_map', None)
+    if identity_map is None:
+        return entity
+    return identity_map.add(entity, key)
+
+
+def _invalidate(conn):
+    identity_map = getattr(conn, 'identity_map', None)
+    if identity_map is not None:
+        identity_map.clear()
+
 
 class Table(object):
     pass
 
 
+class Entity(object):
+    """Base class of the row objects handed out by the ``Table`` classes.
+
+    Entities use ``__slots__`` to stay small; columns that are expensive to
+    decode keep the raw database value until they are first read.
+    """
+    __slots__ = ('conn',)
+    attributes = ()
+
+    def __marshallable__(self):
+        return dict((name, getattr(self, name)) for name in self.attributes)
+
+
 class Authors(Table):
     @classmethod
     def add(cls, conn, name):
@@ -31,9 +377,28 @@ class Authors(Table):
                 author_id = c.lastrowid
         except sqlite3.Error:
             raise
-        
+        _invalidate(conn)
+
         return Author(conn, author_id, name)
 
+    @classmethod
+    def add_many(cls, conn, names):
+        insert = """
+                 INSERT INTO Author (name)
+                 VALUES (?)
+                 """
+        values = ((name,) for name in names)
+        try:
+            with conn:
+                c = conn.cursor()
+                c.executemany(insert, values)
+                author_ids = _inserted_ids(c)
+        except sqlite3.Error:
+            raise
+        _invalidate(conn)
+
+        return author_ids
+
     @classmethod
     def get(cls, conn, author_id):
         query = """
@@ -78,15 +443,35 @@ class Authors(Table):
         return authors
 
     @classmethod
-    def get_all(cls, conn):
+    def get_authors_of_many(cls, conn, book_ids):
+        query = """
+                SELECT W.bookId, A.authorId, A.name
+                FROM Author A, Wrote W
+                WHERE A.authorId = W.authorId
+                  AND W.bookId IN ({})
+                """
+        rows = _select_in(conn, query, book_ids)
+
+        authors = defaultdict(list)
+        for row in rows:
+            authors[row[0]].append(Author(conn, row[1], row[2]))
+
+        return authors
+
+    @classmethod
+    def get_all(cls, conn, limit=None, after=None):
         query = """
                 SELECT *
                 FROM Author
+                WHERE authorId > ?
+                ORDER BY authorId
+                LIMIT ?
                 """
+        values = _page_values(limit, after)
 
         try:
             c = conn.cursor()
-            c.execute(query)
+            c.execute(query, values)
             rows = c.fetchall()
         except sqlite3.Error as e:
             raise e
@@ -95,8 +480,23 @@ class Authors(Table):
 
         return authors
 
+    @classmethod
+    def iter_all(cls, conn, after=None, chunk_size=1000):
+        query = """
+                SELECT *
+                FROM Author
+                WHERE authorId > ?
+                ORDER BY authorId
+                """
+        values = (after or 0,)
+
+        for row in _iter_rows(conn, query, values, chunk_size):
+            yield Author(conn, row[0], row[1])
 
-class Author(object):
+
+class Author(Entity):
+    __slots__ = ('author_id', 'name')
+    attributes = __slots__
 
     def __init__(self, conn, author_id, name):
         self.conn = conn
@@ -124,12 +524,45 @@ class Books(Table):
                 book_id = c.lastrowid
         except sqlite3.Error:
             raise AddBookError
+        _invalidate(conn)
+
+        return _register(conn, Book(conn, book_id, title, isbn, publisher_id,
+                                    publish_date), book_id)
+
+    @classmethod
+    def add_many(cls, conn, books):
+        """Insert (title, isbn, publisher_id, publish_date) tuples in one
+        transaction and return the new book ids.
+        """
+        insert = """
+                 INSERT INTO
+                  Book (title, ISBN, publisherId, publishdate)
+                 VALUES (?, ?, ?, ?)
+                 """
+
+        def values():
+            for title, isbn, publisher_id, publish_date in books:
+                assert isinstance(publish_date, datetime)
+                yield (title, isbn, publisher_id,
+                       publish_date.strftime(date_format))
+
+        try:
+            with conn:
+                c = conn.cursor()
+                c.executemany(insert, values())
+                book_ids = _inserted_ids(c)
+        except sqlite3.Error:
+            raise AddBookError
+        _invalidate(conn)
 
-        return Book(conn, book_id, title, isbn, publisher_id,
-                    publish_date)
+        return book_ids
 
     @classmethod
     def get(cls, conn, book_id):
+        book = _lookup(conn, Book, book_id)
+        if book is not None:
+            return book
+
         query = """
                 SELECT *
                 FROM Book
@@ -151,7 +584,36 @@ class Books(Table):
         return book
 
     @classmethod
-    def get_all(cls, conn, book_id=None, title=None, publisher_name=None, publisher_id=None):
+    def get_all(cls, conn, book_id=None, title=None, publisher_name=None, publisher_id=None,
+                limit=None, after=None):
+        query, values = cls._select(book_id, title, publisher_name,
+                                    publisher_id, after)
+        query += ' LIMIT ?'
+        values.append(-1 if limit is None else limit)
+
+        try:
+            c = conn.cursor()
+            c.execute(query, tuple(values))
+            rows = c.fetchall()
+        except sqlite3.Error as e:
+            raise e
+
+        books = [Book.create_from_books(conn, row) for row in rows]
+
+        return books
+
+    @classmethod
+    def iter_all(cls, conn, book_id=None, title=None, publisher_name=None, publisher_id=None,
+                 after=None, chunk_size=1000):
+        query, values = cls._select(book_id, title, publisher_name,
+                                    publisher_id, after)
+
+        for row in _iter_rows(conn, query, tuple(values), chunk_size):
+            yield Book(conn, row[0], row[1], row[2], row[3], row[4])
+
+    @classmethod
+    def _select(cls, book_id=None, title=None, publisher_name=None, publisher_id=None,
+                after=None):
         query = """
                 SELECT *
                 FROM {}
@@ -174,20 +636,100 @@ class Books(Table):
         if publisher_id:
             query+= ' AND B.publisherId = ?'
             values.append(publisher_id)
+        query += ' AND B.bookId > ? ORDER BY B.bookId'
+        values.append(after or 0)
+
+        return query.format(','.join(tables)), values
+
+    # Column weights for bm25(): a hit in the title beats one in the authors,
+    # which beats one in the publisher name
+    search_weights = (10.0, 5.0, 1.0)
+
+    @classmethod
+    def search(cls, conn, text, limit=None, offset=None):
+        """Books matching every word of ``text`` (as a prefix) in their title,
+        author names or publisher name, best match first.
+        """
+        match = _match_query(text)
+        if match is None:
+            return []
+
+        query = """
+                SELECT B.*
+                FROM BookSearch, Book B
+                WHERE BookSearch MATCH ?
+                  AND B.bookId = BookSearch.rowid
+                ORDER BY bm25(BookSearch, ?, ?, ?), B.bookId
+                LIMIT ? OFFSET ?
+                """
+        values = ((match,) + cls.search_weights +
+                  (-1 if limit is None else limit, offset or 0))
 
         try:
             c = conn.cursor()
-            c.execute(query.format(','.join(tables)), tuple(values))
+            c.execute(query, values)
             rows = c.fetchall()
         except sqlite3.Error as e:
             raise e
 
+        return [Book.create_from_books(conn, row) for row in rows]
+
+    @classmethod
+    def get_many(cls, conn, book_ids):
+        query = """
+                SELECT *
+                FROM Book
+                WHERE bookId IN ({})
+                """
+        rows = _select_in(conn, query, book_ids)
+
         books = [Book.create_from_books(conn, row) for row in rows]
 
         return books
 
+    @classmethod
+    def prefetch(cls, conn, books, publisher=True, authors=True,
+                 copies=True, copy_branch=True, copy_holders=True):
+        """Load the publisher, authors and copies of every book in ``books``
+        (and the branch, borrower and reserver of every copy) with a fixed
+        number of queries, so marshalling them does not hit the database.
+        The relations turned off are left to load lazily.
+        """
+        books = [book for book in books if book is not None]
+        if not books:
+            return books
+
+        book_ids = set(book.book_id for book in books)
+
+        if publisher:
+            publishers = dict((p.publisher_id, p) for p in Publishers.get_many(
+                conn, set(book.publisher_id for book in books)))
+            for book in books:
+                book._publisher = publishers.get(book.publisher_id)
+        if authors:
+            authors_of = Authors.get_authors_of_many(conn, book_ids)
+            for book in books:
+                book._authors = authors_of[book.book_id]
+        if copies:
+            copies_of = defaultdict(list)
+            for copy in Copies.get_copies_of_many(conn, book_ids):
+                copies_of[copy.book_id].append(copy)
+            for book in books:
+                book._copies = copies_of[book.book_id]
+                for copy in book._copies:
+                    copy._book = book
+            Copies.prefetch(conn, [copy for book in books
+                                   for copy in book._copies],
+                            book=False, branch=copy_branch,
+                            holders=copy_holders)
+
+        return books
+
 
-class Book(object):
+class Book(Entity):
+    __slots__ = ('book_id', 'title', 'isbn', 'publisher_id', '_publish_date',
+                 '_publisher', '_authors', '_copies')
+    attributes = ('book_id', 'title', 'isbn', 'publisher_id', 'publish_date')
 
     def __init__(self, conn, book_id, title, isbn, publisher_id,
                  publish_date):
@@ -196,25 +738,45 @@ class Book(object):
         self.title = title
         self.isbn = isbn
         self.publisher_id = publisher_id
-        if isinstance(publish_date, basestring):
-            publish_date = datetime.strptime(publish_date,
-                                             date_format)
-        self.publish_date = publish_date
+        self._publish_date = publish_date
+        self.expire()
+
+    @property
+    def publish_date(self):
+        if isinstance(self._publish_date, basestring):
+            self._publish_date = datetime.strptime(self._publish_date,
+                                                   date_format)
+        return self._publish_date
+
+    def expire(self):
+        self._publisher = _unloaded
+        self._authors = _unloaded
+        self._copies = _unloaded
 
     def get_authors(self):
+        if self._authors is not _unloaded:
+            return self._authors
         return Authors.get_authors_of(self.conn, self.book_id)
 
     def get_publisher(self):
+        if self._publisher is not _unloaded:
+            return self._publisher
         publisher = Publishers.get(self.conn, self.publisher_id)
         return publisher
 
     def get_copies(self):
+        if self._copies is not _unloaded:
+            return self._copies
         copies = Copies.get_copies_of(self.conn, self.book_id)
         return copies
 
     @classmethod
     def create_from_books(cls, conn, row):
-        return Book(conn, row[0], row[1], row[2], row[3], row[4])
+        book = _lookup(conn, Book, row[0])
+        if book is None:
+            book = _register(conn, Book(conn, row[0], row[1], row[2], row[3],
+                                        row[4]), row[0])
+        return book
 
 
 class Readers(Table):
@@ -234,14 +796,40 @@ class Readers(Table):
                 reader_id = c.lastrowid
         except sqlite3.Error as e:
             raise e
+        _invalidate(conn)
+
+        return _register(conn, Reader(conn, reader_id, name, address, phone),
+                         reader_id)
+
+    @classmethod
+    def add_many(cls, conn, readers):
+        """Insert (name, address, phone) tuples in one transaction and
+        return the new reader ids.
+        """
+        insert = """
+                 INSERT INTO Reader (name, address, phone)
+                 VALUES (?, ?, ?)
+                 """
+
+        try:
+            with conn:
+                c = conn.cursor()
+                c.executemany(insert, readers)
+                reader_ids = _inserted_ids(c)
+        except sqlite3.Error as e:
+            raise e
+        _invalidate(conn)
 
-        return Reader(conn, reader_id, name, address, phone)
+        return reader_ids
 
     @classmethod
     def get(cls, conn, reader_id):
         reader = None
         if reader_id is None:
             return reader
+        reader = _lookup(conn, Reader, reader_id)
+        if reader is not None:
+            return reader
 
         query = """
                 SELECT *
@@ -262,14 +850,19 @@ class Readers(Table):
         return reader
 
     @classmethod
-    def get_all(cls, conn):
+    def get_all(cls, conn, limit=None, after=None):
         query = """
                 SELECT *
                 FROM Reader
+                WHERE readerId > ?
+                ORDER BY readerId
+                LIMIT ?
                 """
+        values = _page_values(limit, after)
+
         try:
             c = conn.cursor()
-            c.execute(query)
+            c.execute(query, values)
             rows = c.fetchall()
         except sqlite3.Error as e:
             raise e
@@ -280,10 +873,41 @@ class Readers(Table):
         return readers
 
     @classmethod
-    def average_fine(cls, conn):
+    def iter_all(cls, conn, after=None, chunk_size=1000):
+        query = """
+                SELECT *
+                FROM Reader
+                WHERE readerId > ?
+                ORDER BY readerId
+                """
+        values = (after or 0,)
+
+        for row in _iter_rows(conn, query, values, chunk_size):
+            yield Reader(conn, row[0], row[1], row[2], row[3])
+
+    @classmethod
+    def get_many(cls, conn, reader_ids):
         query = """
                 SELECT *
-                FROM AverageFine
+                FROM Reader
+                WHERE readerId IN ({})
+                """
+        rows = _select_in(conn, query, reader_ids)
+
+        readers = [Reader.create_from_readers(conn, row)
+                   for row in rows]
+
+        return readers
+
+    @classmethod
+    def average_fine(cls, conn):
+        query = """
+                SELECT R.readerId, R.name, R.address, R.phone,
+                       SUM(B.fineCents), COUNT(B.fineCents)
+                FROM Reader R LEFT OUTER JOIN Borrowed B
+                  ON R.readerId = B.readerId
+                GROUP BY R.readerId
+                ORDER BY R.readerId
                 """
 
         try:
@@ -293,17 +917,114 @@ class Readers(Table):
         except sqlite3.Error:
             raise
 
-        result = [dict(reader=Readers.get(conn, row[0]), fine=Decimal('0') if row[1] is None else row[1])
+        # The mean of whole cents, in the same Decimal amounts as Borrow.fine
+        result = [dict(reader=Reader.create_from_readers(conn, row),
+                       fine=Decimal('0') if not row[5]
+                       else (Decimal(row[4]) / row[5]).scaleb(-2))
                   for row in rows]
 
         return result
 
+    # Copy, Book and Branch columns joined onto each active loan/reservation
+    _dashboard_columns = """
+                         C.copyId, C.number, C.bookId, C.libId,
+                         K.bookId, K.title, K.ISBN, K.publisherId,
+                         K.publishdate,
+                         L.libId, L.branch_name, L.location
+                         """
 
-class Reader(object):
+    @classmethod
+    def dashboard(cls, conn, reader, now=None):
+        """The active loans (with due dates and accrued fines) and active
+        reservations of ``reader``, each with its copy, book, branch and
+        authors.
+
+        Three queries whatever the length of the reader's history: only the
+        active rows are read, through the partial indexes.
+        """
+        loans_query = """
+                      SELECT B.borrowId, B.copyId, B.readerId, B.bDatetime,
+                             B.rDatetime, B.fineCents, {} AS days,
+                             {}
+                      FROM Borrowed B
+                        JOIN Copy C ON C.copyId = B.copyId
+                        JOIN Book K ON K.bookId = C.bookId
+                        JOIN Branch L ON L.libId = C.libId
+                      WHERE B.readerId = :reader_id
+                        AND B.rDatetime IS NULL
+                        AND B.fineCents IS NULL
+                      ORDER BY B.bDatetime
+                      """.format(Borrows._days_overdue, cls._dashboard_columns)
+
+        reserves_query = """
+                         SELECT R.reserveId, R.copyId, R.readerId,
+                                R.rvDatetime, R.isReserved,
+                                {}
+                         FROM Reserved R
+                           JOIN Copy C ON C.copyId = R.copyId
+                           JOIN Book K ON K.bookId = C.bookId
+                           JOIN Branch L ON L.libId = C.libId
+                         WHERE R.readerId = :reader_id
+                           AND R.isReserved = 1
+                         ORDER BY R.rvDatetime
+                         """.format(cls._dashboard_columns)
+
+        values = Borrows._fine_values(now)
+        values['reader_id'] = reader.reader_id
+
+        try:
+            c = conn.cursor()
+            c.execute(loans_query, values)
+            loan_rows = c.fetchall()
+            c.execute(reserves_query, values)
+            reserve_rows = c.fetchall()
+        except sqlite3.Error as e:
+            raise e
+
+        def copy_of(row):
+            copy = Copy.create_from_copies(conn, row[0:4])
+            copy._book = Book.create_from_books(conn, row[4:9])
+            copy._branch = Branch.create_from_branches(conn, row[9:12])
+            return copy
+
+        loans = []
+        for row in loan_rows:
+            loan = Borrows._overdue_from_row(conn, row)
+            loan['copy'] = copy = copy_of(row[7:])
+            loan['due'] = (loan['borrow'].b_datetime +
+                           timedelta(days=Borrows.max_borrow_days))
+            copy._borrower, copy._reserver = reader, None
+            loans.append(loan)
+
+        reserves = []
+        for row in reserve_rows:
+            copy = copy_of(row[5:])
+            copy._borrower, copy._reserver = None, reader
+            reserves.append(dict(reserve=Reserve.create_from_reserved(conn, row),
+                                 copy=copy))
+
+        books = dict((item['copy']._book.book_id, item['copy']._book)
+                     for item in loans + reserves)
+        authors = Authors.get_authors_of_many(conn, books)
+        for book_id, book in books.items():
+            book._authors = authors[book_id]
+
+        return dict(reader=reader, loans=loans, reserves=reserves,
+                    accrued_fine=sum((loan['fine'] for loan in loans),
+                                     Decimal('0.00')))
+
+
+class Reader(Entity):
+    __slots__ = ('reader_id', 'name', 'address', 'phone')
+    attributes = __slots__
 
     @classmethod
     def create_from_readers(cls, conn, row):
-        return Reader(conn, row[0], row[1], row[2], row[3])
+        reader = _lookup(conn, Reader, row[0])
+        if reader is None:
+            reader = _register(conn, Reader(conn, row[0], row[1], row[2],
+                                            row[3]), row[0])
+        return reader
 
     def __init__(self, conn, reader_id, name, address, phone):
         self.conn = conn
@@ -330,27 +1051,72 @@ class Reader(object):
     def get_reserves(self):
         return Reserves.get_all_reserved_by(self.conn, self)
 
+    def accrued_fine(self):
+        return Borrows.get_accrued_fine(self.conn, self)
+
+    def dashboard(self):
+        return Readers.dashboard(self.conn, self)
+
 
 class Copies(Table):
+    # Numbers the new copy in the same statement that inserts it, so the
+    # MAX() read happens under the write lock; the unique (bookId, libId,
+    # number) index turns it into a single index seek.
+    _insert_numbered = """
+             INSERT INTO Copy (number, bookId, libId)
+             SELECT COALESCE(MAX(number), 0) + 1, ?, ?
+             FROM Copy
+             WHERE bookId = ?
+               AND libId = ?
+             """
+
     @classmethod
     def add(cls, conn, book_id, lib_id):
-        number = cls.max_number(conn, book_id, lib_id) + 1
-        insert = """
-                 INSERT INTO Copy (number, bookId, libId)
-                 VALUES (?, ?, ?)
-                 """
-        values = (number, book_id, lib_id)
+        values = (book_id, lib_id, book_id, lib_id)
 
         try:
             with conn:
                 c = conn.cursor()
-                c.execute(insert, values)
+                if _has_returning:
+                    c.execute(cls._insert_numbered + """
+                              RETURNING copyId, number
+                              """, values)
+                    copy_id, number = c.fetchone()
+                else:
+                    c.execute(cls._insert_numbered, values)
+                    copy_id = c.lastrowid
+                    c.execute("""
+                              SELECT number
+                              FROM Copy
+                              WHERE copyId = ?
+                              """, (copy_id,))
+                    number = c.fetchone()[0]
         except sqlite3.Error as e:
             raise e
+        _invalidate(conn)
+
+        return _register(conn, Copy(conn, copy_id, number, book_id, lib_id),
+                         copy_id)
 
-        copy_id = c.lastrowid
+    @classmethod
+    def add_many(cls, conn, copies):
+        """Insert a copy for every (book_id, lib_id) pair in one transaction
+        and return the new copy ids. Copies of the same book in the same
+        branch are numbered consecutively.
+        """
+        values = ((book_id, lib_id, book_id, lib_id)
+                  for book_id, lib_id in copies)
+
+        try:
+            with conn:
+                c = conn.cursor()
+                c.executemany(cls._insert_numbered, values)
+                copy_ids = _inserted_ids(c)
+        except sqlite3.Error as e:
+            raise e
+        _invalidate(conn)
 
-        return Copy(conn, copy_id, number, book_id, lib_id)
+        return copy_ids
 
     @classmethod
     def max_number(cls, conn, book_id, lib_id):
@@ -378,6 +1144,10 @@ class Copies(Table):
 
     @classmethod
     def get(cls, conn, copy_id):
+        copy = _lookup(conn, Copy, copy_id)
+        if copy is not None:
+            return copy
+
         query = """
                 SELECT *
                 FROM Copy
@@ -420,7 +1190,99 @@ class Copies(Table):
         return copies
 
     @classmethod
-    def get_all(cls, conn, book_id=None, lib_id=None, number=None, available=None):
+    def get_many(cls, conn, copy_ids):
+        query = """
+                SELECT *
+                FROM Copy
+                WHERE copyId IN ({})
+                """
+        rows = _select_in(conn, query, copy_ids)
+
+        copies = [Copy.create_from_copies(conn, row)
+                  for row in rows]
+
+        return copies
+
+    @classmethod
+    def get_copies_of_many(cls, conn, book_ids):
+        query = """
+                SELECT *
+                FROM Copy
+                  WHERE bookId IN ({})
+                """
+        rows = _select_in(conn, query, book_ids)
+
+        copies = [Copy.create_from_copies(conn, row)
+                  for row in rows]
+
+        return copies
+
+    @classmethod
+    def prefetch(cls, conn, copies, book=True, branch=True, holders=True):
+        """Load the book, branch, borrower and reserver of every copy in
+        ``copies`` with a fixed number of queries. The relations turned off
+        (``holders`` being the borrower and reserver) are left to load
+        lazily.
+        """
+        copies = [copy for copy in copies if copy is not None]
+        if not copies:
+            return copies
+
+        if book:
+            books = dict((b.book_id, b) for b in Books.get_many(
+                conn, set(copy.book_id for copy in copies
+                          if copy._book is _unloaded)))
+            for copy in copies:
+                if copy._book is _unloaded:
+                    copy._book = books.get(copy.book_id)
+        if branch:
+            branches = dict((b.lib_id, b) for b in Branches.get_many(
+                conn, set(copy.lib_id for copy in copies)))
+            for copy in copies:
+                copy._branch = branches.get(copy.lib_id)
+        if holders:
+            copy_ids = set(copy.copy_id for copy in copies)
+            borrowers = Borrows.get_active_borrower_ids(conn, copy_ids)
+            reservers = Reserves.get_active_reserver_ids(conn, copy_ids)
+            readers = dict((reader.reader_id, reader)
+                           for reader in Readers.get_many(
+                               conn, set(borrowers.values()) | set(reservers.values())))
+            for copy in copies:
+                copy._borrower = readers.get(borrowers.get(copy.copy_id))
+                copy._reserver = readers.get(reservers.get(copy.copy_id))
+
+        return copies
+
+    @classmethod
+    def get_all(cls, conn, book_id=None, lib_id=None, number=None, available=None,
+                limit=None, after=None):
+        query, values = cls._select(book_id, lib_id, number, available, after)
+        query += '  LIMIT ?'
+        values.append(-1 if limit is None else limit)
+
+        try:
+            c = conn.cursor()
+            c.execute(query, tuple(values))
+            rows = c.fetchall()
+        except sqlite3.Error as e:
+            raise e
+
+        copies = [Copy.create_from_copies(conn, row)
+                  for row in rows]
+
+        return copies
+
+    @classmethod
+    def iter_all(cls, conn, book_id=None, lib_id=None, number=None, available=None,
+                 after=None, chunk_size=1000):
+        query, values = cls._select(book_id, lib_id, number, available, after)
+
+        for row in _iter_rows(conn, query, tuple(values), chunk_size):
+            yield Copy(conn, row[0], row[1], row[2], row[3])
+
+    @classmethod
+    def _select(cls, book_id=None, lib_id=None, number=None, available=None,
+                after=None):
         query = """
                 SELECT C.copyId, C.number, C.bookId, C.libId
                 FROM {}
@@ -430,42 +1292,9 @@ class Copies(Table):
         values = []
 
         if available is True:
-            query += """  AND NOT EXISTS (SELECT R.copyId
-                                         FROM Reserved R
-                                         WHERE C.copyId = R.copyID
-                                           AND R.isReserved = ?
-
-                                         UNION
-
-                                         SELECT B.copyId
-                                         FROM Borrowed B
-                                         WHERE C.copyId = B.copyId
-                                           AND B.rDatetime IS NULL)
-                     """
-            values.append(True)
+            query += "  AND C.state = 'available'"
         elif available is False:
-            query += """  AND NOT EXISTS (SELECT R.copyId
-                                          FROM Reserved R
-                                          WHERE C.copyId = R.copyID
-                                            AND R.isReserved = ?
-
-                                          UNION
-
-                                          SELECT B.copyId
-                                          FROM Borrowed B
-                                          WHERE C.copyId = B.copyId
-                                            AND B.rDatetime IS NOT NULL)
-                          AND EXISTS (SELECT B.copyId
-                                      FROM Borrowed B
-                                      WHERE C.copyId = B.copyId
-
-                                      UNION
-
-                                      SELECT R.copyId
-                                      FROM Reserved R
-                                      WHERE C.copyId = R.copyId)
-                     """
-            values.append(False)
+            query += "  AND C.state IN ('borrowed', 'reserved')"
         if book_id:
             query += '  AND C.bookId = ?'
             values.append(book_id)
@@ -475,87 +1304,125 @@ class Copies(Table):
         if number:
             query += '  AND C.number = ?'
             values.append(number)
+        query += '  AND C.copyId > ? ORDER BY C.copyId'
+        values.append(after or 0)
 
-        try:
-            c = conn.cursor()
-            c.execute(query.format(','.join(tables)), tuple(values))
-            rows = c.fetchall()
-        except sqlite3.Error as e:
-            raise e
-
-        copies = [Copy.create_from_copies(conn, row)
-                  for row in rows]
+        return query.format(','.join(tables)), values
 
-        return copies
 
+class Copy(Entity):
+    __slots__ = ('copy_id', 'number', 'book_id', 'lib_id',
+                 '_book', '_branch', '_borrower', '_reserver')
+    attributes = ('copy_id', 'number', 'book_id', 'lib_id')
 
-class Copy(object):
     def __init__(self, conn, copy_id, number, book_id, lib_id):
         self.conn = conn
         self.copy_id = copy_id
         self.number = number
         self.book_id = book_id
         self.lib_id = lib_id
+        self.expire()
+
+    def expire(self):
+        self._book = _unloaded
+        self._branch = _unloaded
+        self._borrower = _unloaded
+        self._reserver = _unloaded
 
     @classmethod
     def create_from_copies(cls, conn, row):
-        return cls(conn, row[0], row[1], row[2], row[3])
+        copy = _lookup(conn, cls, row[0])
+        if copy is None:
+            copy = _register(conn, cls(conn, row[0], row[1], row[2], row[3]),
+                             row[0])
+        return copy
 
     def get_book(self):
+        if self._book is not _unloaded:
+            return self._book
         return Books.get(self.conn, self.book_id)
 
     def get_branch(self):
+        if self._branch is not _unloaded:
+            return self._branch
         return Branches.get(self.conn, self.lib_id)
 
     def borrower(self):
+        if self._borrower is not _unloaded:
+            return self._borrower
         return Borrows.get_active_borrower(self.conn, self)
 
     def reserver(self):
+        if self._reserver is not _unloaded:
+            return self._reserver
         return Reserves.get_active_reserver(self.conn, self)
 
 
 class Borrows(Table):
     max_borrow_days = 20
     max_active_borrows = 10
+    fine_cents_per_day = 20
+    # Whole days past max_borrow_days between bDatetime and :now, by date
+    _days_overdue = """
+                    MAX(CAST(julianday(date(:now)) - julianday(date(bDatetime))
+                             AS INTEGER) - :max_borrow_days, 0)
+                    """
 
     @classmethod
     def add(cls, conn, copy, reader):
-
-        if cls.get_num_active_borrowed_by(conn, reader) > cls.max_active_borrows:
-            raise OverBorrowError
-
+        # The write lock is taken before anything is read, and the INSERT
+        # itself checks the borrow limit and that the copy is free or reserved
+        # by this reader, so two desks cannot lend the same copy
         insert = """
                  INSERT INTO
                    Borrowed (copyId, readerId, bDatetime, rDatetime)
-                 VALUES (?, ?, ?, NULL);
+                 SELECT copyId, ?, ?, NULL
+                 FROM Copy
+                 WHERE copyId = ?
+                   AND (state = 'available'
+                        OR (state = 'reserved' AND holderId = ?))
+                   AND (SELECT COUNT(*)
+                        FROM Borrowed
+                        WHERE readerId = ?
+                          AND rDatetime IS NULL
+                          AND fineCents IS NULL) <= ?
+                 """
+
+        cancel = """
+                 UPDATE Reserved
+                 SET isReserved = 0
+                 WHERE copyId = ?
+                   AND readerId = ?
+                   AND isReserved = 1
                  """
 
         now = datetime.utcnow()
+        values = (reader.reader_id, now, copy.copy_id, reader.reader_id,
+                  reader.reader_id, cls.max_active_borrows)
 
-        with conn:
-            reserve_by = copy.reserver()
-            if copy.borrower():
-                raise CopyNotAvailableError
-            elif not reserve_by or reserve_by.reader_id == reader.reader_id:
-                pass
-            elif copy.reserver():
+        c = conn.cursor()
+        try:
+            c.execute('BEGIN IMMEDIATE')
+            c.execute(insert, values)
+            if c.rowcount != 1:
+                if (cls.get_num_active_borrowed_by(conn, reader) >
+                        cls.max_active_borrows):
+                    raise OverBorrowError
                 raise CopyNotAvailableError
+            borrow_id = c.lastrowid
+            c.execute(cancel, (copy.copy_id, reader.reader_id))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        _invalidate(conn)
 
-            values = (copy.copy_id, reader.reader_id, now)
-            try:
-                c = conn.cursor()
-                c.execute(insert, values)
-                borrow_id = c.lastrowid
-                if reserve_by and reserve_by.reader_id == reader.reader_id:
-                    reader.cancel(copy)
-            except sqlite3.Error as e:
-                raise e
-            return Borrow(conn, borrow_id, copy.copy_id, reader.reader_id, now)
+        return Borrow(conn, borrow_id, copy.copy_id, reader.reader_id, now)
 
     @classmethod
     def get(cls, conn, borrow_id):
         query = """
-                SELECT *
+                SELECT borrowId, copyId, readerId, bDatetime, rDatetime, fineCents
                 FROM Borrowed
                 WHERE borrowId = ?
                 """
@@ -575,15 +1442,19 @@ class Borrows(Table):
         return borrow
 
     @classmethod
-    def get_all(cls, conn):
+    def get_all(cls, conn, limit=None, after=None):
         query = """
-                SELECT *
+                SELECT borrowId, copyId, readerId, bDatetime, rDatetime, fineCents
                 FROM Borrowed
+                WHERE borrowId > ?
+                ORDER BY borrowId
+                LIMIT ?
                 """
+        values = _page_values(limit, after)
 
         try:
             c = conn.cursor()
-            c.execute(query)
+            c.execute(query, values)
             rows = c.fetchall()
         except sqlite3.Error as e:
             raise e
@@ -593,10 +1464,23 @@ class Borrows(Table):
 
         return borrows
 
+    @classmethod
+    def iter_all(cls, conn, after=None, chunk_size=1000):
+        query = """
+                SELECT borrowId, copyId, readerId, bDatetime, rDatetime, fineCents
+                FROM Borrowed
+                WHERE borrowId > ?
+                ORDER BY borrowId
+                """
+        values = (after or 0,)
+
+        for row in _iter_rows(conn, query, values, chunk_size):
+            yield Borrow.create_from_borrowed(conn, row)
+
     @classmethod
     def get_all_borrowed_by(cls, conn, reader):
         query = """
-                SELECT *
+                SELECT borrowId, copyId, readerId, bDatetime, rDatetime, fineCents
                 FROM Borrowed
                 WHERE readerID = ?
                 """
@@ -621,6 +1505,7 @@ class Borrows(Table):
                 FROM Borrowed
                 WHERE readerID = ?
                   AND rDatetime IS NULL
+                  AND fineCents IS NULL
                 """
         values = (reader.reader_id,)
 
@@ -637,15 +1522,12 @@ class Borrows(Table):
     def get_active_borrower(cls, conn, copy):
         c = conn.cursor()
         query = """
-                SELECT readerID
-                FROM Copy C, Borrowed B
-                WHERE B.copyId = C.copyId
-                  AND C.copyId = ?
-                  AND bookId = ?
-                  AND rDatetime IS NULL
-                  AND fine IS NULL
+                SELECT holderId
+                FROM Copy
+                WHERE copyId = ?
+                  AND state = 'borrowed'
                 """
-        values = (copy.copy_id, copy.book_id,)
+        values = (copy.copy_id,)
 
         try:
             c.execute(query, values)
@@ -660,68 +1542,172 @@ class Borrows(Table):
         return borrower
 
     @classmethod
-    def retrn(cls, conn, copy, reader):
+    def get_active_borrower_ids(cls, conn, copy_ids):
         query = """
-                SELECT *
-                FROM Borrowed
-                WHERE copyId = ?
-                  AND readerID = ?
-                  AND rDatetime IS NULL
-                  AND fine IS NULL
+                SELECT copyId, holderId
+                FROM Copy
+                WHERE copyId IN ({})
+                  AND state = 'borrowed'
                 """
+        rows = _select_in(conn, query, copy_ids)
 
+        return dict((row[0], row[1]) for row in rows)
+
+    @classmethod
+    def retrn(cls, conn, copy, reader):
+        # The fine is worked out in SQL from bDatetime: every whole day past
+        # max_borrow_days costs fine_cents_per_day
         update = """
                  UPDATE Borrowed
-                 SET rDatetime = ?, fine = ?
-                 WHERE borrowId = ?
+                 SET rDatetime = :now,
+                     fineCents = {} * :fine_cents_per_day
+                 """.format(cls._days_overdue)
+
+        active = """
+                 WHERE copyId = :copy_id
+                   AND readerId = :reader_id
+                   AND rDatetime IS NULL
+                   AND fineCents IS NULL
                  """
 
-        now = datetime.utcnow()
+        values = cls._fine_values()
+        values.update(copy_id=copy.copy_id, reader_id=reader.reader_id)
 
         try:
             with conn:
                 c = conn.cursor()
-                q_values = (copy.copy_id, reader.reader_id)
-                c.execute(query, q_values)
-                row = c.fetchone()
+                if _has_returning:
+                    c.execute(update + active + """
+                              RETURNING borrowId, copyId, readerId, bDatetime,
+                                        rDatetime, fineCents
+                              """, values)
+                    row = c.fetchone()
+                else:
+                    c.execute('BEGIN IMMEDIATE')
+                    c.execute('SELECT borrowId FROM Borrowed' + active, values)
+                    row = c.fetchone()
+                    if row is not None:
+                        values['borrow_id'] = row[0]
+                        c.execute(update + 'WHERE borrowId = :borrow_id',
+                                  values)
+                        c.execute("""
+                                  SELECT borrowId, copyId, readerId, bDatetime,
+                                         rDatetime, fineCents
+                                  FROM Borrowed
+                                  WHERE borrowId = :borrow_id
+                                  """, values)
+                        row = c.fetchone()
                 if row is None:
                     raise CannotReturnCopyError
-                borrow = Borrows.get(conn, row[0])
-                u_values = (now, cls._calculate_fine(borrow, now),
-                            borrow.borrow_id)
-                c.execute(update, u_values)
+        except sqlite3.Error as e:
+            raise e
+        _invalidate(conn)
+
+        return Borrow.create_from_borrowed(conn, row)
+
+
+    @classmethod
+    def _fine_values(cls, now=None):
+        now = now or datetime.utcnow()
+        return dict(now=now,
+                    due_before=(now - timedelta(days=cls.max_borrow_days)).date(),
+                    max_borrow_days=cls.max_borrow_days,
+                    fine_cents_per_day=cls.fine_cents_per_day)
+
+    @classmethod
+    def _overdue_query(cls):
+        # bDatetime sorts as text, so comparing it to the due date finds the
+        # loans borrowed on an earlier day with a range scan of the index
+        return """
+               SELECT borrowId, copyId, readerId, bDatetime, rDatetime,
+                      fineCents, {} AS days
+               FROM Borrowed
+               WHERE rDatetime IS NULL
+                 AND fineCents IS NULL
+                 AND bDatetime < :due_before
+               ORDER BY bDatetime
+               """.format(cls._days_overdue)
+
+    @classmethod
+    def _overdue_from_row(cls, conn, row):
+        return dict(borrow=Borrow.create_from_borrowed(conn, row),
+                    days_overdue=row[6],
+                    fine=Decimal(row[6] * cls.fine_cents_per_day).scaleb(-2))
+
+    @classmethod
+    def get_overdue(cls, conn, now=None, limit=None):
+        """Active loans past max_borrow_days, longest overdue first, with
+        the days they are overdue and the fine accrued so far.
+        """
+        query = cls._overdue_query() + 'LIMIT :limit'
+        values = cls._fine_values(now)
+        values['limit'] = -1 if limit is None else limit
+
+        try:
+            c = conn.cursor()
+            c.execute(query, values)
+            rows = c.fetchall()
         except sqlite3.Error as e:
             raise e
 
-        return Borrows.get(conn, row[0])
+        return [cls._overdue_from_row(conn, row) for row in rows]
 
     @classmethod
-    def _calculate_fine(cls, borrow, now):
-        if now is None:
-            raise RuntimeError('cannot calculate fine')
+    def get_accrued_fine(cls, conn, reader, now=None):
+        """The fine ``reader`` would owe on returning everything now."""
+        query = """
+                SELECT TOTAL({})
+                FROM Borrowed
+                WHERE readerId = :reader_id
+                  AND rDatetime IS NULL
+                  AND fineCents IS NULL
+                """.format(cls._days_overdue)
+        values = cls._fine_values(now)
+        values['reader_id'] = reader.reader_id
 
-        date_delta = now.date() - borrow.b_datetime.date()
-        day_delta = date_delta.days - Borrows.max_borrow_days
-        days_overdue = day_delta if day_delta >= 0 else 0
-        fine = Decimal('0.2') * days_overdue
+        try:
+            c = conn.cursor()
+            c.execute(query, values)
+            row = c.fetchone()
+        except sqlite3.Error as e:
+            raise e
 
-        return str(fine)
+        return Decimal(int(row[0]) * cls.fine_cents_per_day).scaleb(-2)
 
 
-class Borrow(object):
+class Borrow(Entity):
+    __slots__ = ('borrow_id', 'copy_id', 'reader_id', '_b_datetime',
+                 '_r_datetime', '_fine')
+    attributes = ('borrow_id', 'copy_id', 'reader_id', 'b_datetime',
+                  'r_datetime', 'fine')
 
     def __init__(self, conn, borrow_id, copy_id, reader_id, b_datetime, r_datetime=None, fine=None):
         self.conn = conn
         self.borrow_id = borrow_id
         self.copy_id = copy_id
         self.reader_id = reader_id
-        if isinstance(b_datetime, basestring):
-            b_datetime = datetime.strptime(b_datetime, datetime_format)
-        self.b_datetime = b_datetime
-        if isinstance(r_datetime, basestring):
-            r_datetime = datetime.strptime(r_datetime, datetime_format)
-        self.r_datetime = r_datetime
-        self.fine = Decimal(fine) if fine else None
+        self._b_datetime = b_datetime
+        self._r_datetime = r_datetime
+        self._fine = fine
+
+    @property
+    def b_datetime(self):
+        if isinstance(self._b_datetime, basestring):
+            self._b_datetime = _parse_datetime(self._b_datetime)
+        return self._b_datetime
+
+    @property
+    def r_datetime(self):
+        if isinstance(self._r_datetime, basestring):
+            self._r_datetime = _parse_datetime(self._r_datetime)
+        return self._r_datetime
+
+    @property
+    def fine(self):
+        # Stored as whole cents; turned into a Decimal amount on first access
+        if isinstance(self._fine, (int, long)):
+            self._fine = Decimal(self._fine).scaleb(-2)
+        return self._fine
 
     def get_copy(self):
         return Copies.get(self.conn, self.copy_id)
@@ -743,7 +1729,8 @@ class Reserves(Table):
         if cls.get_num_active_reserved_by(conn, reader) > cls.max_active_reserves:
             raise OverReserveError
 
-        if copy.borrower() or copy.reserver():
+        if (Borrows.get_active_borrower(conn, copy) or
+                cls.get_active_reserver(conn, copy)):
             raise CopyNotAvailableError
 
         insert = """
@@ -760,6 +1747,7 @@ class Reserves(Table):
                 reserve_id = c.lastrowid
         except sqlite3.Error as e:
             raise e
+        _invalidate(conn)
 
         return Reserve(conn, reserve_id, copy.copy_id, reader.reader_id,
                        now, True)
@@ -787,15 +1775,19 @@ class Reserves(Table):
         return reserve
 
     @classmethod
-    def get_all(cls, conn):
+    def get_all(cls, conn, limit=None, after=None):
         query = """
                 SELECT *
                 FROM Reserved
+                WHERE reserveId > ?
+                ORDER BY reserveId
+                LIMIT ?
                 """
+        values = _page_values(limit, after)
 
         try:
             c = conn.cursor()
-            c.execute(query)
+            c.execute(query, values)
             rows = c.fetchall()
         except sqlite3.Error as e:
             raise e
@@ -805,6 +1797,19 @@ class Reserves(Table):
 
         return reserves
 
+    @classmethod
+    def iter_all(cls, conn, after=None, chunk_size=1000):
+        query = """
+                SELECT *
+                FROM Reserved
+                WHERE reserveId > ?
+                ORDER BY reserveId
+                """
+        values = (after or 0,)
+
+        for row in _iter_rows(conn, query, values, chunk_size):
+            yield Reserve.create_from_reserved(conn, row)
+
     @classmethod
     def get_all_reserved_by(cls, conn, reader):
         query = """
@@ -832,9 +1837,9 @@ class Reserves(Table):
                 SELECT COUNT(*)
                 FROM Reserved
                 WHERE readerID = ?
-                  AND isReserved = ?
+                  AND isReserved = 1
                 """
-        values = (reader.reader_id, True)
+        values = (reader.reader_id,)
 
         try:
             c = conn.cursor()
@@ -849,14 +1854,12 @@ class Reserves(Table):
     def get_active_reserver(cls, conn, copy):
         c = conn.cursor()
         query = """
-                SELECT readerID
-                FROM Copy C, Reserved R
-                WHERE R.copyId = C.copyId
-                  AND C.copyId = ?
-                  AND bookId = ?
-                  AND isReserved = ?
+                SELECT holderId
+                FROM Copy
+                WHERE copyId = ?
+                  AND state = 'reserved'
                 """
-        values = (copy.copy_id, copy.book_id, True)
+        values = (copy.copy_id,)
         try:
             c.execute(query, values)
             row = c.fetchone()
@@ -870,43 +1873,74 @@ class Reserves(Table):
         return reserver
 
     @classmethod
-    def cancel(cls, conn, copy, reader):
+    def get_active_reserver_ids(cls, conn, copy_ids):
         query = """
-                SELECT *
-                FROM Reserved
-                WHERE copyId = ?
-                  AND readerID = ?
-                  AND isReserved = ?
+                SELECT copyId, holderId
+                FROM Copy
+                WHERE copyId IN ({})
+                  AND state = 'reserved'
                 """
+        rows = _select_in(conn, query, copy_ids)
+
+        return dict((row[0], row[1]) for row in rows)
 
+    @classmethod
+    def cancel(cls, conn, copy, reader):
         update = """
                  UPDATE Reserved
-                 SET isReserved = ?
-                 WHERE reserveId = ?
+                 SET isReserved = 0
+                 """
+
+        active = """
+                 WHERE copyId = :copy_id
+                   AND readerId = :reader_id
+                   AND isReserved = 1
                  """
 
+        values = dict(copy_id=copy.copy_id, reader_id=reader.reader_id)
+
         try:
             with conn:
                 c = conn.cursor()
-                q_values = (copy.copy_id, reader.reader_id, True)
-                c.execute(query, q_values)
-                row = c.fetchone()
+                if _has_returning:
+                    c.execute(update + active + """
+                              RETURNING reserveId, copyId, readerId, rvDatetime,
+                                        isReserved
+                              """, values)
+                    row = c.fetchone()
+                else:
+                    c.execute('BEGIN IMMEDIATE')
+                    c.execute('SELECT reserveId FROM Reserved' + active, values)
+                    row = c.fetchone()
+                    if row is not None:
+                        values['reserve_id'] = row[0]
+                        c.execute(update + 'WHERE reserveId = :reserve_id',
+                                  values)
+                        c.execute("""
+                                  SELECT reserveId, copyId, readerId, rvDatetime,
+                                         isReserved
+                                  FROM Reserved
+                                  WHERE reserveId = :reserve_id
+                                  """, values)
+                        row = c.fetchone()
                 if row is None:
                     raise CannotCancelReservationError
-                reserve = Reserves.get(conn, row[0])
-                u_values = (False, reserve.reserve_id)
-                c.execute(update, u_values)
         except sqlite3.Error as e:
             raise e
+        _invalidate(conn)
 
-        return Reserves.get(conn, row[0])
+        return Reserve.create_from_reserved(conn, row)
 
 
 class CannotCancelReservationError(Exception):
     pass
 
 
-class Reserve(object):
+class Reserve(Entity):
+    __slots__ = ('reserve_id', 'copy_id', 'reader_id', '_rv_datetime',
+                 'is_reserved')
+    attributes = ('reserve_id', 'copy_id', 'reader_id', 'rv_datetime',
+                  'is_reserved')
 
     def __init__(self, conn, reserve_id, copy_id, reader_id,
                  rv_datetime, is_reserved=True):
@@ -914,12 +1948,15 @@ class Reserve(object):
         self.reserve_id = reserve_id
         self.copy_id = copy_id
         self.reader_id = reader_id
-        if isinstance(rv_datetime, basestring):
-            rv_datetime = datetime.strptime(rv_datetime,
-                                            datetime_format)
-        self.rv_datetime = rv_datetime
+        self._rv_datetime = rv_datetime
         self.is_reserved = is_reserved
 
+    @property
+    def rv_datetime(self):
+        if isinstance(self._rv_datetime, basestring):
+            self._rv_datetime = _parse_datetime(self._rv_datetime)
+        return self._rv_datetime
+
     def get_copy(self):
         return Copies.get(self.conn, self.copy_id)
 
@@ -948,9 +1985,28 @@ class Publishers(Table):
                 publisher_id = c.lastrowid
         except sqlite3.Error as e:
             raise e
+        _invalidate(conn)
 
         return Publisher(conn, publisher_id, name, address)
 
+    @classmethod
+    def add_many(cls, conn, publishers):
+        insert = """
+                 INSERT INTO Publisher (name, address)
+                 VALUES (?, ?)
+                 """
+
+        try:
+            with conn:
+                c = conn.cursor()
+                c.executemany(insert, publishers)
+                publisher_ids = _inserted_ids(c)
+        except sqlite3.Error as e:
+            raise e
+        _invalidate(conn)
+
+        return publisher_ids
+
     @classmethod
     def get(cls, conn, publisher_id):
         query = """
@@ -974,15 +2030,19 @@ class Publishers(Table):
         return publisher
 
     @classmethod
-    def get_all(cls, conn):
+    def get_all(cls, conn, limit=None, after=None):
         query = """
                 SELECT *
                 FROM Publisher
+                WHERE publisherId > ?
+                ORDER BY publisherId
+                LIMIT ?
                 """
+        values = _page_values(limit, after)
 
         try:
             c = conn.cursor()
-            c.execute(query)
+            c.execute(query, values)
             rows = c.fetchall()
         except sqlite3.Error as e:
             raise e
@@ -992,12 +2052,41 @@ class Publishers(Table):
 
         return publishers
 
+    @classmethod
+    def iter_all(cls, conn, after=None, chunk_size=1000):
+        query = """
+                SELECT *
+                FROM Publisher
+                WHERE publisherId > ?
+                ORDER BY publisherId
+                """
+        values = (after or 0,)
+
+        for row in _iter_rows(conn, query, values, chunk_size):
+            yield Publisher(conn, row[0], row[1], row[2])
+
+    @classmethod
+    def get_many(cls, conn, publisher_ids):
+        query = """
+                SELECT *
+                FROM Publisher
+                WHERE publisherId IN ({})
+                """
+        rows = _select_in(conn, query, publisher_ids)
+
+        publishers = [Publisher(conn, row[0], row[1], row[2])
+                      for row in rows]
+
+        return publishers
+
 
 class NoSuchPublisherError(Exception):
     pass
 
 
-class Publisher(object):
+class Publisher(Entity):
+    __slots__ = ('publisher_id', 'name', 'address')
+    attributes = __slots__
 
     def __init__(self, conn, publisher_id, name, address):
         self.conn = conn
@@ -1026,11 +2115,17 @@ class Branches(Table):
                 lib_id = c.lastrowid
         except sqlite3.Error:
             raise
+        _invalidate(conn)
 
-        return Branch(conn, lib_id, branch_name, location)
+        return _register(conn, Branch(conn, lib_id, branch_name, location),
+                         lib_id)
 
     @classmethod
     def get(cls, conn, lib_id):
+        branch = _lookup(conn, Branch, lib_id)
+        if branch is not None:
+            return branch
+
         query = """
                 SELECT *
                 FROM Branch
@@ -1047,31 +2142,64 @@ class Branches(Table):
 
         branch = None
         if row:
-            branch = Branch(conn, row[0], row[1], row[2])
+            branch = Branch.create_from_branches(conn, row)
 
         return branch
 
     @classmethod
-    def get_all(cls, conn):
+    def get_all(cls, conn, limit=None, after=None):
         query = """
                 SELECT *
                 FROM Branch
+                WHERE libId > ?
+                ORDER BY libId
+                LIMIT ?
                 """
+        values = _page_values(limit, after)
 
         try:
             c = conn.cursor()
-            c.execute(query)
+            c.execute(query, values)
             rows = c.fetchall()
         except sqlite3.Error as e:
             raise e
 
-        branches = [Branch(conn, row[0], row[1], row[2])
+        branches = [Branch.create_from_branches(conn, row)
+                    for row in rows]
+
+        return branches
+
+    @classmethod
+    def iter_all(cls, conn, after=None, chunk_size=1000):
+        query = """
+                SELECT *
+                FROM Branch
+                WHERE libId > ?
+                ORDER BY libId
+                """
+        values = (after or 0,)
+
+        for row in _iter_rows(conn, query, values, chunk_size):
+            yield Branch(conn, row[0], row[1], row[2])
+
+    @classmethod
+    def get_many(cls, conn, lib_ids):
+        query = """
+                SELECT *
+                FROM Branch
+                WHERE libId IN ({})
+                """
+        rows = _select_in(conn, query, lib_ids)
+
+        branches = [Branch.create_from_branches(conn, row)
                     for row in rows]
 
         return branches
 
 
-class Branch(object):
+class Branch(Entity):
+    __slots__ = ('lib_id', 'name', 'location')
+    attributes = __slots__
 
     def __init__(self, conn, lib_id, name, location):
         self.conn = conn
@@ -1079,27 +2207,34 @@ class Branch(object):
         self.name = name
         self.location = location
 
+    @classmethod
+    def create_from_branches(cls, conn, row):
+        branch = _lookup(conn, Branch, row[0])
+        if branch is None:
+            branch = _register(conn, Branch(conn, row[0], row[1], row[2]),
+                               row[0])
+        return branch
+
     def frequent_borrowers(self, limit=None):
         query = """
                 SELECT readerId, Times
                 FROM FrequentBorrower
                 WHERE libId = ?
+                ORDER BY Times DESC, readerId
+                LIMIT ?
                 """
-        values = [self.lib_id]
-
-        if limit:
-            query += ' LIMIT ?'
-            values.append(limit)
+        values = (self.lib_id, -1 if limit is None else limit)
 
         try:
             c = self.conn.cursor()
-            c.execute(query, tuple(values))
+            c.execute(query, values)
             rows = c.fetchall()
         except sqlite3.Error:
             raise
 
-        results = [dict(reader=Readers.get(self.conn, row[0]),
-                        times=row[1])
+        readers = dict((reader.reader_id, reader) for reader in
+                       Readers.get_many(self.conn, [row[0] for row in rows]))
+        results = [dict(reader=readers.get(row[0]), times=row[1])
                    for row in rows]
 
         return results
@@ -1108,27 +2243,73 @@ class Branch(object):
         query = """
                 SELECT bookId, Times
                 FROM MostBorrowed
-                  WHERE libId = ?
+                WHERE libId = ?
+                ORDER BY Times DESC, bookId
+                LIMIT ?
                 """
-        values = [self.lib_id]
-
-        if limit is not None:
-            query += ' LIMIT ?'
-            values.append(limit)
+        values = (self.lib_id, -1 if limit is None else limit)
 
         try:
             c = self.conn.cursor()
-            c.execute(query, tuple(values))
+            c.execute(query, values)
             rows = c.fetchall()
         except sqlite3.Error:
             raise
 
-        result = [dict(book=Books.get(self.conn, row[0]), times=row[1])
+        books = dict((book.book_id, book) for book in
+                     Books.get_many(self.conn, [row[0] for row in rows]))
+        result = [dict(book=books.get(row[0]), times=row[1])
                   for row in rows]
 
         return result
 
 
+def rebuild_borrow_counts(conn):
+    """Recount MostBorrowed and FrequentBorrower from the whole Borrowed
+    history, e.g. after loading loans with the triggers disabled.
+    """
+    script = """
+             DELETE FROM MostBorrowed;
+             DELETE FROM FrequentBorrower;
+
+             INSERT INTO MostBorrowed (libId, bookId, Times)
+               SELECT C.libId, C.bookId, COUNT(*)
+               FROM Borrowed B, Copy C
+               WHERE B.copyId = C.copyId
+               GROUP BY C.libId, C.bookId;
+
+             INSERT INTO FrequentBorrower (libId, readerId, Times)
+               SELECT C.libId, B.readerId, COUNT(*)
+               FROM Borrowed B, Copy C
+               WHERE B.copyId = C.copyId
+               GROUP BY C.libId, B.readerId;
+             """
+
+    try:
+        with conn:
+            c = conn.cursor()
+            for statement in script.split(';'):
+                if statement.strip():
+                    c.execute(statement)
+    except sqlite3.Error as e:
+        raise e
+
+
+def table_versions(conn, tables):
+    """(version, modified) of each of ``tables`` by name, as kept in
+    TableVersion by the write triggers. ``modified`` is a Unix timestamp.
+    """
+    try:
+        return dict((row[0], (row[1], row[2]))
+                    for row in _select_in(conn, """
+                        SELECT tableName, version, modified
+                        FROM TableVersion
+                        WHERE tableName IN ({})
+                        """, tables))
+    except sqlite3.Error as e:
+        raise e
+
+
 class AddBookError(Exception):
     pass
 
@@ -1149,24 +2330,281 @@ class OverReserveError(Exception):
     pass
 
 
+def write_overdue(conn, out, now=None):
+    """Write every overdue loan to ``out`` as CSV.
+
+    Meant for millions of loans, so the rows are streamed straight from the
+    query without building entities or Decimals.
+    """
+    writer = csv.writer(out)
+    writer.writerow(('borrow_id', 'reader_id', 'copy_id', 'b_datetime',
+                     'days_overdue', 'fine'))
+    rows = _iter_rows(conn, Borrows._overdue_query(),
+                      Borrows._fine_values(now))
+    for borrow_id, copy_id, reader_id, b_datetime, _, _, days in rows:
+        fine = '{}.{:02d}'.format(*divmod(days * Borrows.fine_cents_per_day,
+                                          100))
+        writer.writerow((borrow_id, reader_id, copy_id, b_datetime, days,
+                         fine))
+
+
 def create_tables(conn, create_script):
     c = conn.cursor()
     script = open(create_script).read()
     c.executescript(script)
     conn.commit()
+    migrations = list_migrations(migrations_dir_of(create_script))
+    if migrations:
+        c.execute('PRAGMA user_version = {:d}'.format(migrations[-1][0]))
+
+
+def migrations_dir_of(create_script):
+    return os.path.join(os.path.dirname(create_script), 'migrations')
+
+
+def list_migrations(migrations_dir):
+    """(version, path) of every NNN_name.sql script, oldest first."""
+    migrations = []
+    if os.path.isdir(migrations_dir):
+        for name in os.listdir(migrations_dir):
+            version = name.split('_', 1)[0]
+            if name.endswith('.sql') and version.isdigit():
+                migrations.append((int(version),
+                                   os.path.join(migrations_dir, name)))
+    return sorted(migrations)
+
+
+def migrate(conn, migrations_dir='migrations', target=None):
+    """Bring an existing database up to date with library.ddl.
+
+    The schema version lives in PRAGMA user_version; every migration script
+    newer than it (and not past ``target``, if given) runs in its own
+    transaction together with the version bump.
+    """
+    c = conn.cursor()
+    c.execute('PRAGMA user_version')
+    current = c.fetchone()[0]
+    for version, path in list_migrations(migrations_dir):
+        if target is not None and version > target:
+            break
+        if version > current:
+            script = open(path).read()
+            try:
+                c.executescript('BEGIN;\n{}\nPRAGMA user_version = {:d};\nCOMMIT;'
+                                .format(script, version))
+            except sqlite3.Error as e:
+                try:
+                    c.execute('ROLLBACK')
+                except sqlite3.Error:
+                    pass
+                raise e
+            current = version
+    return current
+
+
+# PRAGMA settings applied to every connection by start() and connect().
+# 'production' lets readers carry on while a checkout is being written (WAL)
+# and only syncs at checkpoints, which WAL keeps safe against corruption;
+# 'durable' also syncs every commit; 'default' leaves SQLite's own settings.
+profiles = {
+    'default': {},
+    'production': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -16000,       # KiB, i.e. about 16 MB of page cache
+        'mmap_size': 268435456,     # 256 MB
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,       # ms
+    },
+    'durable': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'cache_size': -16000,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,
+    },
+}
+
+_profile_pragmas = ('journal_mode', 'synchronous', 'cache_size', 'mmap_size',
+                    'temp_store', 'busy_timeout')
+
+
+def apply_profile(conn, profile='production'):
+    """Apply a profile, given by name or as a dict of PRAGMA settings."""
+    settings = profiles[profile] if isinstance(profile, basestring) else profile
+    for name, value in sorted(settings.items()):
+        if name not in _profile_pragmas:
+            raise ValueError('unknown PRAGMA in profile: {}'.format(name))
+        if isinstance(value, basestring) and not value.isalnum():
+            raise ValueError('bad value for PRAGMA {}: {}'.format(name, value))
+        conn.execute('PRAGMA {} = {}'.format(name, value)).fetchall()
+
+
+def connect(db_path='library.db', profile='production', **kwargs):
+    """Open a database whose schema is known to be up to date; extra keyword
+    arguments go to sqlite3.connect.
+    """
+    conn = sqlite3.connect(db_path, factory=LibraryConnection, **kwargs)
+    apply_profile(conn, profile)
+    conn.execute('PRAGMA FOREIGN_KEYS = 1;')
+    return conn
 
 
-def start(db_path='library.db', create_script='library.ddl'):
-    sqlite3.register_adapter(bool, int)
-    sqlite3.register_converter("BOOLEAN", lambda v: v != '0')
+def start(db_path='library.db', create_script='library.ddl',
+          profile='production', **kwargs):
     if os.path.isfile(db_path):
-        conn = sqlite3.connect(db_path)
+        conn = sqlite3.connect(db_path, factory=LibraryConnection, **kwargs)
+        apply_profile(conn, profile)
+        migrate(conn, migrations_dir_of(create_script))
     else:
-        conn = sqlite3.connect(db_path)
+        conn = sqlite3.connect(db_path, factory=LibraryConnection, **kwargs)
+        apply_profile(conn, profile)
         create_tables(conn, create_script)
     conn.execute('PRAGMA FOREIGN_KEYS = 1;')
     return conn
 
 
+class PoolTimeoutError(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    """Up to ``size`` connections to one database, each checked out by one
+    thread at a time.
+
+    A thread that acquires again before releasing gets the connection it
+    already holds. The connection goes back to the pool, with a fresh
+    identity map, when the outermost holder releases it.
+    """
+
+    def __init__(self, db_path='library.db', create_script='library.ddl',
+                 size=5, timeout=10.0, profile='production'):
+        self.db_path = db_path
+        self.create_script = create_script
+        self.profile = profile
+        self.size = size
+        self.timeout = timeout
+        self._idle = Queue.LifoQueue()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._started = False
+        self._closed = False
+
+    def acquire(self):
+        local = self._local
+        if getattr(local, 'depth', 0):
+            local.depth += 1
+            return local.conn
+        local.conn = self._checkout()
+        local.depth = 1
+        return local.conn
+
+    def release(self, conn):
+        local = self._local
+        if getattr(local, 'conn', None) is not conn:
+            raise ValueError('connection is not held by this thread')
+        local.depth -= 1
+        if local.depth == 0:
+            local.conn = None
+            self._checkin(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """Close the idle connections; busy ones are closed on release."""
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except Queue.Empty:
+                break
+            self._discard(conn)
+
+    def _checkout(self):
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except Queue.Empty:
+                conn = self._open()
+                if conn is None:
+                    try:
+                        conn = self._idle.get(timeout=self.timeout)
+                    except Queue.Empty:
+                        raise PoolTimeoutError
+            if self._healthy(conn):
+                return conn
+            self._discard(conn)
+
+    def _checkin(self, conn):
+        try:
+            conn.rollback()
+        except sqlite3.Error:
+            self._discard(conn)
+            return
+        if self._closed:
+            self._discard(conn)
+            return
+        conn.identity_map = IdentityMap()
+        conn.query_log = None
+        self._idle.put(conn)
+
+    def _open(self):
+        with self._lock:
+            if self._opened >= self.size:
+                return None
+            # The first connection creates or migrates the schema
+            if self._started:
+                conn = connect(self.db_path, self.profile,
+                               check_same_thread=False)
+            else:
+                conn = start(self.db_path, self.create_script, self.profile,
+                             check_same_thread=False)
+                self._started = True
+            self._opened += 1
+            return conn
+
+    def _healthy(self, conn):
+        try:
+            conn.execute('SELECT 1').fetchone()
+        except sqlite3.Error:
+            return False
+        return True
+
+    def _discard(self, conn):
+        with self._lock:
+            self._opened -= 1
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Library database tools.')
+    parser.add_argument('--db', default='library.db')
+    parser.add_argument('command', nargs='?',
+                        choices=('rebuild-counts', 'overdue'),
+                        help='rebuild-counts: recount the borrow summaries; '
+                             'overdue: write the overdue loans and their '
+                             'accrued fines as CSV')
+    args = parser.parse_args(argv)
+
+    conn = start(args.db)
+    try:
+        if args.command == 'rebuild-counts':
+            rebuild_borrow_counts(conn)
+        elif args.command == 'overdue':
+            write_overdue(conn, sys.stdout)
+    finally:
+        conn.close()
+
+
 if __name__ == '__main__':
-    start()
+    main()
@@ -1,11 +1,23 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from __future__ import print_function, unicode_literals
-from flask import Flask, g, abort, send_from_directory, session, redirect, url_for, request, make_response, flash, render_template, current_app, jsonify
-from flask.ext.restful import Resource, Api, fields, marshal, reqparse
+from flask import Flask, g, abort, send_from_directory, session, redirect, url_for, request, make_response, flash, render_template, current_app, jsonify, Response, stream_with_context, has_request_context
+from flask.ext.restful import Resource, Api, fields, reqparse
 from functools import wraps, update_wrapper
+from itertools import islice
 from library import *
+from library_profile import StackProfiler, prune_profiles, write_profile
+from library_serializers import select_fields, serialize
+from werkzeug.http import http_date, parse_date
+import json
+import logging
+import os
+import sqlite3
 import sys
+import tempfile
+import threading
+import time
+import uuid
 __author__ = 'shunghsiyu'
 
 
@@ -37,6 +49,10 @@ my_errors = {
     'OverReserveError': {
         'message': 'A reader cannot reserve more than 10 books',
         'status': 409
+    },
+    'PoolTimeoutError': {
+        'message': 'All database connections are busy, try again shortly',
+        'status': 503
     }
 }
 
@@ -57,6 +73,13 @@ class MyApi(Api):
         response.headers['WWW-Authenticate'] = challenge
         return response
 
+    def handle_error(self, e):
+        response = super(MyApi, self).handle_error(e)
+        if isinstance(e, PoolTimeoutError):
+            response.headers['Retry-After'] = str(
+                current_app.config.get('DB_POOL_RETRY_AFTER', 1))
+        return response
+
 api = MyApi(app, errors=my_errors)
 marshall_fields = {}
 
@@ -143,10 +166,36 @@ def admin_or_reader_login_required_json(func):
     return wrap
 
 
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        db_path = app.config['DB_PATH']
+        profile = app.config.get('DB_PROFILE', 'production')
+        if (_pool is None or _pool.db_path != db_path or
+                _pool.profile != profile):
+            if _pool is not None:
+                _pool.close()
+            _pool = ConnectionPool(db_path,
+                                   size=app.config.get('DB_POOL_SIZE', 5),
+                                   timeout=app.config.get('DB_POOL_TIMEOUT',
+                                                          10.0),
+                                   profile=profile)
+        return _pool
+
+
 def get_db():
+    # Contexts on one thread share the pooled connection and its identity
+    # map, which is reset once the outermost context hands it back
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = start(app.config['DB_PATH'])
+        g._database_pool = get_pool()
+        db = g._database = g._database_pool.acquire()
+        if has_request_context():
+            db.query_log = request.environ.get('library.query_log')
     return db
 
 
@@ -154,25 +203,227 @@ def get_db():
 def close_connection(exception):
     db = getattr(g, '_database', None)
     if db is not None:
-        db.close()
+        g._database_pool.release(db)
+
+
+slow_query_logger = logging.getLogger('library.slow_queries')
+
+
+@app.before_request
+def start_query_log():
+    """Record the statements of the request, unless QUERY_LOG is off."""
+    if app.config.get('QUERY_LOG', True):
+        slow_ms = app.config.get('SLOW_QUERY_MS', 100)
+        request.environ['library.query_log'] = QueryLog(
+            None if slow_ms is None else slow_ms / 1000.0)
+
+
+@app.after_request
+def add_query_headers(response):
+    log = request.environ.get('library.query_log')
+    # A stream runs most of its statements after this, so the headers would
+    # undercount them; they still reach the log, and the slow query log
+    if log is not None and not response.is_streamed:
+        response.headers['X-DB-Queries'] = str(log.count)
+        response.headers['X-DB-Time'] = '{:.3f}'.format(1000 * log.seconds)
+    return response
+
+
+@app.teardown_request
+def log_slow_queries(exception):
+    # After the response, so that the statements of a stream are in too
+    log = request.environ.get('library.query_log')
+    if log is None:
+        return
+    if log.unexplained:
+        # On a read-only connection of its own, as an EXPLAIN would commit
+        # whatever transaction the request's connection has open
+        conn = sqlite3.connect(app.config['DB_PATH'], timeout=1.0)
+        try:
+            conn.execute('PRAGMA query_only = ON')
+            log.explain(conn)
+        except sqlite3.Error as e:
+            slow_query_logger.warning('no plans: %s', e)
+        finally:
+            conn.close()
+    for statement in log.slow():
+        slow_query_logger.warning(
+            '%s %s: %.1f ms, %d rows, %d parameters\n  %s\n  %s',
+            request.method, request.path, 1000 * statement.seconds,
+            statement.rows, statement.parameters, statement.sql,
+            '\n  '.join(['plan: ' + detail
+                          for detail in statement.plan or ['(not read)']]))
+
+
+def profile_dir():
+    return app.config.get('PROFILE_DIR') or \
+        os.path.join(tempfile.gettempdir(), 'library-profiles')
+
+
+@app.before_request
+def start_profile():
+    """Profile the request when an admin sends ``X-Profile: 1``."""
+    if request.headers.get('X-Profile', '0') in ('', '0') or \
+            'admin' not in session:
+        return
+    if request.environ.get('library.query_log') is None:
+        request.environ['library.query_log'] = QueryLog()
+    name = '{}-{}'.format(time.strftime('%Y%m%d-%H%M%S'), uuid.uuid4().hex[:8])
+    profiler = StackProfiler()
+    request.environ['library.profile'] = (name, profiler)
+    profiler.start()
+
+
+def finish_profile():
+    name, profiler = request.environ.pop('library.profile')
+    profiler.stop()
+    log = request.environ['library.query_log']
+    # No status when an exception skipped after_request
+    title = '{} {} {}'.format(request.method, request.full_path.rstrip('?'),
+                              request.environ.get('library.profile_status',
+                                                  500))
+    write_profile(profiler, profile_dir(), name, title, log.seconds, log.count,
+                  top_n=app.config.get('PROFILE_TOP_N', 25))
+    prune_profiles(profile_dir(), app.config.get('PROFILE_KEEP', 20))
+
+
+@app.after_request
+def add_profile_headers(response):
+    profile = request.environ.get('library.profile')
+    if profile is None:
+        return response
+    name = profile[0]
+    request.environ['library.profile_status'] = response.status_code
+    response.headers['X-Profile-Stacks'] = url_for('profile_file',
+                                                   filename=name + '.collapsed')
+    response.headers['X-Profile-Summary'] = url_for('profile_file',
+                                                    filename=name + '.txt')
+    # The body of a stream is only made after this, so it is finished on
+    # teardown
+    if not response.is_streamed:
+        finish_profile()
+    return response
+
+
+@app.teardown_request
+def finish_streamed_profile(exception):
+    if 'library.profile' in request.environ:
+        finish_profile()
+
+
+@app.route('/api/profiles/<path:filename>')
+@admin_login_required_json
+def profile_file(filename):
+    return send_from_directory(profile_dir(), filename,
+                               mimetype='text/plain')
+
+
+def batch_items():
+    """The items of a batch POST (a JSON array body), or None."""
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        return None
+    max_batch_size = app.config.get('MAX_BATCH_SIZE')
+    if not items or (max_batch_size and len(items) > max_batch_size):
+        abort(400)
+    return items
+
+
+def batch_value(item, key, type=unicode):
+    try:
+        return type(item[key])
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+
+
+def collection_parser():
+    parser = reqparse.RequestParser()
+    parser.add_argument('limit', type=int)
+    parser.add_argument('after', type=int)
+    parser.add_argument('stream', type=str, choices=('ndjson', 'json'))
+    parser.add_argument('fields', type=str)
+    parser.add_argument('expand', type=str)
+    return parser
 
 
 class LibraryResource(Resource):
     method_decorators = [admin_or_reader_login_required_json]
     model = None
+    id_field = None
     envelope = None
     resource_fields = None
     uri_fields = None
+    # The fields of a batch POST's response; resources that take batches set
+    # them and define _batch_row, to turn one item into a row for add_many
+    batch_fields = None
+    stream_chunk_size = 500
+    # Tables whose writes can change a GET of this resource; their change
+    # counters make the ETag and Last-Modified of conditional GETs
+    depends_on = None
 
     def _get(self, identity):
+        if identity is None and request.args.get('stream'):
+            return self._stream()
         with app.app_context():
             if identity is not None:
-                return marshal(self._get_one(identity),
-                               self.resource_fields)
+                schema = self._selected(self.resource_fields)
             else:
-                return marshal(self._get_all(),
-                               self.uri_fields,
-                               envelope=self.envelope)
+                schema = self._selected(self.uri_fields)
+            # Versions read before the rows, so that the ETag is never newer
+            # than what it is sent with
+            headers = self._validators()
+            if identity is not None:
+                # A missing row is a 404 whatever the validators say
+                resource = self._get_one(identity)
+                if self._not_modified(headers):
+                    return Response(status=304, headers=headers)
+                self._prefetch([resource], schema)
+                return serialize(resource, schema), 200, headers
+            else:
+                if self._not_modified(headers):
+                    return Response(status=304, headers=headers)
+                collection = self._get_all()
+                self._prefetch(collection, schema)
+                result = serialize(collection, schema,
+                                   envelope=self.envelope)
+                result['next'] = self._next_uri(collection)
+                return result, 200, headers
+
+    def _selected(self, schema):
+        """The part of ``schema`` that the ``fields`` and ``expand`` query
+        parameters ask for.
+        """
+        try:
+            return select_fields(schema, request.args.get('fields'),
+                                 request.args.get('expand'))
+        except ValueError:
+            abort(400)
+
+    def _validators(self):
+        if not self.depends_on:
+            return {}
+        versions = table_versions(get_db(), self.depends_on)
+        modified = max(versions[table][1] for table in self.depends_on)
+        tag = '{}-{}'.format('.'.join(str(versions[table][0])
+                                      for table in self.depends_on),
+                             modified)
+        headers = {'ETag': 'W/"{}"'.format(tag),
+                   'Cache-Control': 'private, no-cache'}
+        # Writes can still land in the current second, so only a second that
+        # is over is safe for If-Modified-Since to be compared against
+        if modified < int(time.time()):
+            headers['Last-Modified'] = http_date(modified)
+        return headers
+
+    def _not_modified(self, headers):
+        if 'ETag' not in headers:
+            return False
+        if request.if_none_match:
+            return request.if_none_match.contains_weak(headers['ETag'][3:-1])
+        if request.if_modified_since and 'Last-Modified' in headers:
+            return (request.if_modified_since >=
+                    parse_date(headers['Last-Modified']))
+        return False
 
     def _get_one(self, identity):
         resource = self.model.get(get_db(), identity)
@@ -182,9 +433,96 @@ class LibraryResource(Resource):
             abort(404)
 
     def _get_all(self):
-        collection = self.model.get_all(get_db())
+        args = self._parse_collection_args()
+        collection = self.model.get_all(get_db(), limit=self._page_size(),
+                                        after=args['after'],
+                                        **self._filters(args))
         return collection
 
+    def _iter_all(self, args):
+        return self.model.iter_all(get_db(), after=args['after'],
+                                   chunk_size=self.stream_chunk_size,
+                                   **self._filters(args))
+
+    def _parse_collection_args(self):
+        return collection_parser().parse_args()
+
+    def _filters(self, args):
+        return {}
+
+    def _stream(self):
+        """Stream the whole collection as NDJSON (``?stream=ndjson``) or as
+        the usual enveloped JSON document (``?stream=json``), marshalling one
+        chunk of rows at a time.
+        """
+        args = self._parse_collection_args()
+        ndjson = args['stream'] == 'ndjson'
+        schema = self._selected(self.uri_fields)
+        with app.app_context():
+            headers = self._validators()
+        if self._not_modified(headers):
+            return Response(status=304, headers=headers)
+
+        def generate():
+            with app.app_context():
+                items = self._iter_all(args)
+                if not ndjson:
+                    yield '{{"{}": ['.format(self.envelope)
+                separator = ''
+                while True:
+                    chunk = list(islice(items, self.stream_chunk_size))
+                    if not chunk:
+                        break
+                    self._prefetch(chunk, schema)
+                    for item in serialize(chunk, schema):
+                        data = json.dumps(item)
+                        if ndjson:
+                            yield data + '\n'
+                        else:
+                            yield separator + data
+                            separator = ', '
+                    # Keep memory flat: forget the entities of this chunk
+                    get_db().identity_map.clear()
+                if not ndjson:
+                    yield ']}'
+
+        mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+        return Response(stream_with_context(generate()), mimetype=mimetype,
+                        headers=headers)
+
+    def _page_size(self):
+        limit = request.args.get('limit', type=int)
+        if limit is not None and limit < 1:
+            abort(400)
+        # Collections always come in pages; ?stream= is for all of one
+        if limit is None:
+            limit = app.config.get('PAGE_SIZE', 100)
+        max_page_size = app.config.get('MAX_PAGE_SIZE', 1000)
+        if max_page_size and limit > max_page_size:
+            limit = max_page_size
+        return limit
+
+    def _next_uri(self, collection):
+        if len(collection) < self._page_size():
+            return None
+        args = request.args.to_dict()
+        args['after'] = getattr(collection[-1], self.id_field)
+        return url_for(request.endpoint, **args)
+
+    def _prefetch(self, resources, schema):
+        pass
+
+    def _post_many(self, items):
+        if self.batch_fields is None:
+            abort(405)
+        rows = [self._batch_row(item) for item in items]
+        with app.app_context():
+            ids = self.model.add_many(get_db(), rows)
+            created = sorted(self.model.get_many(get_db(), ids),
+                             key=lambda resource: getattr(resource, self.id_field))
+            return serialize(created, self.batch_fields,
+                             envelope=self.envelope), 201
+
 
 marshall_fields['AuthorUri'] = {
     'author_id': fields.Integer,
@@ -254,9 +592,11 @@ marshall_fields['Author'] = {
 
 class AuthorResource(LibraryResource):
     model = Authors
+    id_field = 'author_id'
     envelope = 'authors'
     resource_fields = marshall_fields['Author']
     uri_fields = marshall_fields['AuthorUri']
+    depends_on = ('Author',)
 
     def get(self, author_id=None):
         return self._get(author_id)
@@ -268,8 +608,13 @@ class AuthorResource(LibraryResource):
         parser.add_argument('name', type=str, required=True)
         args = parser.parse_args(strict=True)
         with app.app_context():
-            return marshal(self.model.add(get_db(), args['name']),
-                           self.resource_fields), 201
+            return serialize(self.model.add(get_db(), args['name']),
+                             self.resource_fields), 201
+
+
+def branch_top_n():
+    """How many most borrowed books and frequent borrowers a branch lists."""
+    return app.config.get('BRANCH_TOP_N', 10)
 
 
 marshall_fields['BranchMostBorrowed'] = {
@@ -289,18 +634,20 @@ marshall_fields['Branch'] = {
     'name': fields.String,
     'location': fields.String,
     'most_borrowed': fields.Nested(marshall_fields['BranchMostBorrowed'],
-                                   attribute=lambda branch: branch.most_borrowed_books()),
+                                   attribute=lambda branch: branch.most_borrowed_books(branch_top_n())),
     'frequent_borrower': fields.Nested(marshall_fields['BranchFrequentBorrower'],
-                                       attribute=lambda branch: branch.frequent_borrowers()),
+                                       attribute=lambda branch: branch.frequent_borrowers(branch_top_n())),
     'uri': fields.Url('branchresource')
 }
 
 
 class BranchResource(LibraryResource):
     model = Branches
+    id_field = 'lib_id'
     envelope = 'branches'
     resource_fields = marshall_fields['Branch']
     uri_fields = marshall_fields['BranchUri']
+    depends_on = ('Branch', 'Book', 'Reader', 'Copy', 'Borrowed')
 
     def get(self, lib_id=None):
         return self._get(lib_id)
@@ -317,6 +664,10 @@ marshall_fields['CopySimple'] = {
     'uri': fields.Url('copyresource')
 }
 
+# The fields of a copy that need its borrower and reserver
+copy_holder_fields = frozenset(['reserver', 'borrower', 'is_reserved',
+                                'is_borrowed', 'is_available'])
+
 marshall_fields['Book'] = {
     'book_id': fields.Integer,
     'title': fields.String,
@@ -332,9 +683,13 @@ marshall_fields['Book'] = {
 
 class BookResource(LibraryResource):
     model = Books
+    id_field = 'book_id'
     envelope = 'books'
     resource_fields = marshall_fields['Book']
     uri_fields = marshall_fields['Book']
+    depends_on = ('Book', 'Publisher', 'Author', 'Wrote', 'Copy', 'Branch',
+                  'Borrowed', 'Reserved')
+    batch_fields = marshall_fields['BookUri']
 
     def get(self, book_id=None):
         return self._get(book_id)
@@ -342,6 +697,9 @@ class BookResource(LibraryResource):
     def post(self, book_id=None):
         if book_id is not None:
             abort(405)
+        items = batch_items()
+        if items is not None:
+            return self._post_many(items)
         parser = reqparse.RequestParser()
         parser.add_argument('title', type=str, required=True)
         parser.add_argument('ISBN', type=str, required=True)
@@ -353,18 +711,59 @@ class BookResource(LibraryResource):
             book = self.model.add(get_db(), args['title'],
                                   args['ISBN'], args['publisher_id'],
                                   publish_date)
-            return marshal(book, self.resource_fields), 201
+            return serialize(book, self.resource_fields), 201
 
-    def _get_all(self):
-        parser = reqparse.RequestParser()
+    def _batch_row(self, item):
+        publish_date = datetime.strptime(batch_value(item, 'publish_date'),
+                                         '%Y-%m-%d')
+        return (batch_value(item, 'title'), batch_value(item, 'ISBN'),
+                batch_value(item, 'publisher_id', int), publish_date)
+
+    def _parse_collection_args(self):
+        parser = collection_parser()
         parser.add_argument('book_id', type=int)
         parser.add_argument('title', type=str)
         parser.add_argument('publisher_name', type=str)
-        args = parser.parse_args()
-        books = self.model.get_all(get_db(), args['book_id'],
-                                   args['title'],
-                                   args['publisher_name'])
-        return books
+        parser.add_argument('q', type=unicode)
+        parser.add_argument('offset', type=int)
+        return parser.parse_args()
+
+    def _filters(self, args):
+        return dict(book_id=args['book_id'], title=args['title'],
+                    publisher_name=args['publisher_name'])
+
+    def _get_all(self):
+        args = self._parse_collection_args()
+        if args['q'] is None:
+            return super(BookResource, self)._get_all()
+        return self.model.search(get_db(), args['q'],
+                                 limit=self._page_size(),
+                                 offset=args['offset'])
+
+    def _iter_all(self, args):
+        if args['q'] is None:
+            return super(BookResource, self)._iter_all(args)
+        return iter(self.model.search(get_db(), args['q'],
+                                      offset=args['offset']))
+
+    def _next_uri(self, collection):
+        # Search results are ranked, so they page by offset instead of id
+        args = request.args.to_dict()
+        if 'q' not in args:
+            return super(BookResource, self)._next_uri(collection)
+        if len(collection) < self._page_size():
+            return None
+        args['offset'] = int(args.get('offset') or 0) + len(collection)
+        return url_for(request.endpoint, **args)
+
+    def _prefetch(self, books, schema):
+        copy_fields = set(schema['copies'].nested) if 'copies' in schema \
+            else set()
+        self.model.prefetch(get_db(), books, publisher='publisher' in schema,
+                            authors='authors' in schema,
+                            copies='copies' in schema,
+                            copy_branch='branch' in copy_fields,
+                            copy_holders=bool(copy_holder_fields & copy_fields))
 
 
 marshall_fields['Publisher'] = {
@@ -379,9 +778,11 @@ marshall_fields['Publisher'] = {
 
 class PublisherResource(LibraryResource):
     model = Publishers
+    id_field = 'publisher_id'
     envelope = 'publishers'
     resource_fields = marshall_fields['Publisher']
     uri_fields = marshall_fields['PublisherUri']
+    depends_on = ('Publisher', 'Book')
 
     def get(self, publisher_id=None):
         return self._get(publisher_id)
@@ -396,15 +797,18 @@ marshall_fields['Reader'] = {
                               attribute=lambda reader: reader.get_reserves()),
     'borrows': fields.Nested(marshall_fields['BorrowUri'],
                              attribute=lambda reader: reader.get_borrows()),
+    'accrued_fine': fields.String(attribute=lambda reader: reader.accrued_fine()),
     'uri': fields.Url('readerresource')
 }
 
 
 class ReaderResource(LibraryResource):
     model = Readers
+    id_field = 'reader_id'
     envelope = 'readers'
     resource_fields = marshall_fields['Reader']
     uri_fields = marshall_fields['ReaderUri']
+    batch_fields = marshall_fields['ReaderUri']
 
     def get(self, reader_id=None):
         return self._get(reader_id)
@@ -417,28 +821,28 @@ class ReaderResource(LibraryResource):
                 pass
             else:
                 abort(403)
-            with app.app_context():
-                return marshal(self._get_one(reader_id),
-                               self.resource_fields)
-        else:
-            with app.app_context():
-                return marshal(self._get_all(),
-                               self.uri_fields,
-                               envelope=self.envelope)
+        return super(ReaderResource, self)._get(reader_id)
 
     def post(self, reader_id=None):
         if reader_id is not None:
             abort(405)
+        items = batch_items()
+        if items is not None:
+            return self._post_many(items)
         parser = reqparse.RequestParser()
         parser.add_argument('name', type=str, required=True)
         parser.add_argument('address', type=str, required=True)
         parser.add_argument('phone', type=str, required=True)
         args = parser.parse_args(strict=True)
         with app.app_context():
-            return marshal(self.model.add(get_db(), args['name'],
-                                          args['address'],
-                                          args['phone']),
-                           self.resource_fields), 201
+            return serialize(self.model.add(get_db(), args['name'],
+                                            args['address'],
+                                            args['phone']),
+                             self.resource_fields), 201
+
+    def _batch_row(self, item):
+        return (batch_value(item, 'name'), batch_value(item, 'address'),
+                batch_value(item, 'phone'))
 
 
 marshall_fields['CopySimple'] = {
@@ -470,9 +874,12 @@ marshall_fields['Copy'] = {
 
 class CopyResource(LibraryResource):
     model = Copies
+    id_field = 'copy_id'
     envelope = 'copies'
     resource_fields = marshall_fields['Copy']
     uri_fields = marshall_fields['CopySimple']
+    depends_on = ('Copy', 'Book', 'Branch', 'Reader', 'Borrowed', 'Reserved')
+    batch_fields = marshall_fields['CopyUri']
 
     def get(self, copy_id=None):
         return self._get(copy_id)
@@ -480,6 +887,9 @@ class CopyResource(LibraryResource):
     def post(self, copy_id=None):
         if copy_id is not None:
             abort(405)
+        items = batch_items()
+        if items is not None:
+            return self._post_many(items)
         parser = reqparse.RequestParser()
         parser.add_argument('book_id', type=int, required=True)
         parser.add_argument('lib_id', type=int, required=True)
@@ -487,25 +897,34 @@ class CopyResource(LibraryResource):
         with app.app_context():
             copy = self.model.add(get_db(), args['book_id'],
                                   args['lib_id'])
-            return marshal(copy, self.uri_fields), 201
+            return serialize(copy, self.uri_fields), 201
 
-    def _get_all(self):
-        parser = reqparse.RequestParser()
+    def _batch_row(self, item):
+        return (batch_value(item, 'book_id', int),
+                batch_value(item, 'lib_id', int))
+
+    def _parse_collection_args(self):
+        parser = collection_parser()
         parser.add_argument('book_id', type=int)
         parser.add_argument('lib_id', type=int)
         parser.add_argument('number', type=int)
         parser.add_argument('availability', type=str)
-        args = parser.parse_args(strict=True)
+        return parser.parse_args(strict=True)
+
+    def _filters(self, args):
         available = None
         if 'availability' in args:
             if args['availability'] == 'available':
                 available = True
             elif args['availability'] == 'unavailable':
                 available = False
-        copies = self.model.get_all(get_db(), args['book_id'],
-                                    args['lib_id'], args['number'],
-                                    available)
-        return copies
+        return dict(book_id=args['book_id'], lib_id=args['lib_id'],
+                    number=args['number'], available=available)
+
+    def _prefetch(self, copies, schema):
+        self.model.prefetch(get_db(), copies, book='book' in schema,
+                            branch='branch' in schema,
+                            holders=bool(copy_holder_fields & set(schema)))
 
 marshall_fields['Borrow'] = {
     'borrow_id': fields.Integer,
@@ -522,9 +941,11 @@ marshall_fields['Borrow'] = {
 
 class BorrowResource(LibraryResource):
     model = Borrows
+    id_field = 'borrow_id'
     envelope = 'borrows'
     resource_fields = marshall_fields['Borrow']
     uri_fields = marshall_fields['BorrowUri']
+    depends_on = ('Borrowed', 'Copy', 'Book', 'Branch', 'Reader', 'Reserved')
 
     def get(self, borrow_id=None):
         return self._get(borrow_id)
@@ -544,9 +965,11 @@ marshall_fields['Reserve'] = {
 
 class ReserveResource(LibraryResource):
     model = Reserves
+    id_field = 'reserve_id'
     envelope = 'reserves'
     resource_fields = marshall_fields['Reserve']
     uri_fields = marshall_fields['ReserveUri']
+    depends_on = ('Reserved', 'Copy', 'Book', 'Branch', 'Reader', 'Borrowed')
 
     def get(self, reserve_id=None):
         return self._get(reserve_id)
@@ -568,8 +991,8 @@ class ReaderActionResource(Resource):
             if copy is None:
                 abort(400)
             to_return = self.action(reader, copy)
-            return marshal(to_return,
-                           self.resource_field), 201
+            return serialize(to_return,
+                             self.resource_field), 201
 
     def action(self, reader, copy):
         pass
@@ -613,9 +1036,84 @@ class AverageFineResource(Resource):
 
     def get(self):
         with app.app_context():
-            return marshal(Readers.average_fine(get_db()),
-                           self.resource_field,
-                           envelope=self.envelope)
+            return serialize(Readers.average_fine(get_db()),
+                             self.resource_field,
+                             envelope=self.envelope)
+
+
+class OverdueResource(Resource):
+    method_decorators = [admin_login_required_json]
+    resource_field = {
+        'borrow': fields.Nested(marshall_fields['BorrowUri'],
+                                attribute=lambda t: t['borrow']),
+        'reader_id': fields.Integer(attribute=lambda t: t['borrow'].reader_id),
+        'copy_id': fields.Integer(attribute=lambda t: t['borrow'].copy_id),
+        'days_overdue': fields.Integer(attribute=lambda t: t['days_overdue']),
+        'fine': fields.String(attribute=lambda t: t['fine'])
+    }
+    envelope = 'overdue'
+
+    def get(self):
+        parser = reqparse.RequestParser()
+        parser.add_argument('limit', type=int)
+        args = parser.parse_args()
+        with app.app_context():
+            return serialize(Borrows.get_overdue(get_db(), limit=args['limit']),
+                             self.resource_field,
+                             envelope=self.envelope)
+
+
+marshall_fields['DashboardCopy'] = {
+    'copy_id': fields.Integer,
+    'number': fields.Integer,
+    'book': fields.Nested({
+        'book_id': fields.Integer,
+        'title': fields.String,
+        'ISBN': fields.String(attribute='isbn'),
+        'authors': fields.Nested(marshall_fields['AuthorUri'],
+                                 attribute=lambda book: book.get_authors()),
+        'uri': fields.Url('bookresource')
+    }, attribute=lambda copy: copy.get_book()),
+    'branch': fields.Nested(marshall_fields['BranchUri'],
+                            attribute=lambda copy: copy.get_branch()),
+    'uri': fields.Url('copyresource')
+}
+
+marshall_fields['Dashboard'] = {
+    'reader': fields.Nested(marshall_fields['ReaderUri'],
+                            attribute=lambda t: t['reader']),
+    'loans': fields.Nested({
+        'borrow': fields.Nested(marshall_fields['BorrowUri'],
+                                attribute=lambda t: t['borrow']),
+        'copy': fields.Nested(marshall_fields['DashboardCopy'],
+                              attribute=lambda t: t['copy']),
+        'due': fields.DateTime(dt_format='iso8601', attribute=lambda t: t['due']),
+        'days_overdue': fields.Integer(attribute=lambda t: t['days_overdue']),
+        'fine': fields.String(attribute=lambda t: t['fine'])
+    }, attribute=lambda t: t['loans']),
+    'reserves': fields.Nested({
+        'reserve': fields.Nested(marshall_fields['ReserveUri'],
+                                 attribute=lambda t: t['reserve']),
+        'copy': fields.Nested(marshall_fields['DashboardCopy'],
+                              attribute=lambda t: t['copy'])
+    }, attribute=lambda t: t['reserves']),
+    'accrued_fine': fields.String(attribute=lambda t: t['accrued_fine'])
+}
+
+
+class ReaderDashboardResource(Resource):
+    """Everything the reader's home page shows, in a fixed number of
+    queries however long the reader's history is.
+    """
+    method_decorators = [reader_id_same]
+    resource_field = marshall_fields['Dashboard']
+
+    def get(self, reader_id):
+        with app.app_context():
+            reader = Readers.get(get_db(), reader_id)
+            if reader is None:
+                abort(404)
+            return serialize(reader.dashboard(), self.resource_field)
 
 
 api.add_resource(AuthorResource, '/api/authors/', '/api/authors/<int:author_id>')
@@ -630,7 +1128,9 @@ api.add_resource(CopyCheckoutResource, '/api/readers/<int:reader_id>/checkout')
 api.add_resource(CopyReturnResource, '/api/readers/<int:reader_id>/return')
 api.add_resource(CopyReserveResource, '/api/readers/<int:reader_id>/reserve')
 api.add_resource(CopyCancelResource, '/api/readers/<int:reader_id>/cancel')
+api.add_resource(ReaderDashboardResource, '/api/readers/<int:reader_id>/dashboard')
 api.add_resource(AverageFineResource, '/api/readers/average_fine')
+api.add_resource(OverdueResource, '/api/borrows/overdue')
 
 
 @app.route('/api/info')
@@ -733,8 +1233,13 @@ def index():
 app.secret_key = 'thisisaSECRET'
 
 
-def run(db_path='library.db', debug=False):
+def run(db_path='library.db', debug=False, profile='production'):
+    """Serve the app; ``profile`` names an entry of library.profiles or is a
+    dict of PRAGMA settings.
+    """
     app.config['DB_PATH'] = db_path
+    app.config['DB_PROFILE'] = profile
+    logging.basicConfig()
     if debug:
         app.run(debug=True)
     else:
@@ -0,0 +1,817 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import print_function, unicode_literals
+from datetime import datetime, timedelta
+from library import *
+import argparse
+import gc
+import itertools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+__author__ = 'shunghsiyu'
+
+
+class BenchDB(object):
+    """A throwaway on-disk library database."""
+
+    def __init__(self, create_script='library.ddl', profile='production'):
+        self.directory = tempfile.mkdtemp(prefix='library_bench')
+        self.path = os.path.join(self.directory, 'library.db')
+        self.profile = profile
+        self.conn = start(self.path, create_script, profile)
+
+    def close(self):
+        self.conn.close()
+        shutil.rmtree(self.directory)
+
+
+def populate_borrowed(conn, n, readers=1000, copies=1000):
+    """Fill Borrowed with ``n`` returned loans spread over a year."""
+    with conn:
+        c = conn.cursor()
+        c.execute("INSERT INTO Publisher (name, address) VALUES ('P', 'P')")
+        c.execute("INSERT INTO Branch (branch_name, location) VALUES ('B', 'B')")
+        c.execute("""
+                  INSERT INTO Book (title, ISBN, publisherId, publishdate)
+                  VALUES ('T', 'I', 1, '2015-01-01')
+                  """)
+        c.executemany("INSERT INTO Copy (number, bookId, libId) VALUES (?, 1, 1)",
+                      ((number,) for number in range(1, copies + 1)))
+        c.executemany("INSERT INTO Reader (name, address, phone) VALUES ('R', 'A', ?)",
+                      ((str(i),) for i in range(readers)))
+
+    first = datetime(2015, 1, 1, 9, 30, 0, 1)
+
+    def rows():
+        for i in range(n):
+            b_datetime = first + timedelta(minutes=i)
+            r_datetime = b_datetime + timedelta(days=i % 30)
+            fine_cents = (Borrows.fine_cents_per_day *
+                          max(i % 30 - Borrows.max_borrow_days, 0))
+            yield (i % copies + 1, i % readers + 1, b_datetime, r_datetime,
+                   fine_cents)
+
+    with conn:
+        conn.executemany("""
+                         INSERT INTO
+                           Borrowed (copyId, readerId, bDatetime, rDatetime, fineCents)
+                         VALUES (?, ?, ?, ?, ?)
+                         """, rows())
+
+
+def footprint(objects):
+    """Approximate bytes held by ``objects`` and the attribute values they own."""
+    seen = set()
+    total = 0
+    for obj in objects:
+        total += sys.getsizeof(obj)
+        if hasattr(obj, '__dict__'):
+            total += sys.getsizeof(obj.__dict__)
+            values = obj.__dict__.values()
+        else:
+            values = [getattr(obj, name) for name in obj.__slots__
+                      if hasattr(obj, name)]
+        for value in values:
+            if id(value) not in seen and not isinstance(value, sqlite3.Connection):
+                seen.add(id(value))
+                total += sys.getsizeof(value)
+    return total
+
+
+def bench_borrowed_memory(n=100000):
+    """Load the whole Borrowed table and report its size and load time."""
+    db = BenchDB()
+    try:
+        populate_borrowed(db.conn, n)
+        gc.collect()
+        started = time.time()
+        borrows = Borrows.get_all(db.conn)
+        load_seconds = time.time() - started
+        ids_bytes = footprint(borrows)
+        started = time.time()
+        for borrow in borrows:
+            borrow.b_datetime, borrow.r_datetime, borrow.fine
+        decode_seconds = time.time() - started
+        decoded_bytes = footprint(borrows)
+    finally:
+        db.close()
+
+    return dict(rows=n,
+                load_seconds=round(load_seconds, 3),
+                bytes_per_row=ids_bytes // n,
+                decode_seconds=round(decode_seconds, 3),
+                bytes_per_row_decoded=decoded_bytes // n)
+
+
+def api_client(db_path):
+    """A test client of the web API, logged in as the administrator."""
+    import library_api
+    library_api.app.config['DB_PATH'] = db_path
+    client = library_api.app.test_client()
+    with client.session_transaction() as session:
+        session['admin'] = True
+    return client
+
+
+def bench_average_fine(readers=100000):
+    """Time GET /api/readers/average_fine over ``readers`` readers with two
+    returned loans each.
+    """
+    db = BenchDB()
+    try:
+        populate_borrowed(db.conn, 2 * readers, readers=readers)
+        started = time.time()
+        Readers.average_fine(db.conn)
+        query_seconds = time.time() - started
+        db.conn.close()
+        client = api_client(db.path)
+        started = time.time()
+        response = client.get('/api/readers/average_fine')
+        seconds = time.time() - started
+        assert response.status_code == 200
+    finally:
+        db.close()
+
+    return dict(readers=readers,
+                query_seconds=round(query_seconds, 3),
+                seconds=round(seconds, 3),
+                response_bytes=len(response.data))
+
+
+def bench_overdue(n=1000000, readers=1000):
+    """Time the overdue CSV report over ``n`` active loans, one every ten
+    seconds, most of them overdue.
+    """
+    db = BenchDB()
+    try:
+        populate_borrowed(db.conn, 0, readers=readers)
+        first = datetime(2015, 1, 1, 9, 30, 0, 1)
+        with db.conn:
+            db.conn.executemany("""
+                                INSERT INTO Borrowed (copyId, readerId, bDatetime)
+                                VALUES (1, ?, ?)
+                                """,
+                                ((i % readers + 1, first + timedelta(seconds=10 * i))
+                                 for i in range(n)))
+        now = first + timedelta(seconds=10 * n, days=Borrows.max_borrow_days)
+        with open(os.devnull, 'w') as out:
+            started = time.time()
+            write_overdue(db.conn, out, now)
+            seconds = time.time() - started
+        started = time.time()
+        Borrows.get_accrued_fine(db.conn, Readers.get(db.conn, 1), now)
+        reader_seconds = time.time() - started
+    finally:
+        db.close()
+
+    return dict(loans=n,
+                seconds=round(seconds, 3),
+                reader_seconds=round(reader_seconds, 4))
+
+
+def populate_catalog(conn, books=50):
+    """One branch holding a copy of each of ``books`` books, and a reader."""
+    publisher = Publishers.add(conn, 'Publisher', 'Address')
+    branch = Branches.add(conn, 'Branch', 'Location')
+    book_ids = Books.add_many(conn, [('Title {}'.format(i), str(i),
+                                      publisher.publisher_id,
+                                      datetime(2015, 1, 1))
+                                     for i in range(books)])
+    Copies.add_many(conn, [(book_id, branch.lib_id) for book_id in book_ids])
+    Readers.add(conn, 'Reader', 'Address', '1')
+
+
+def bench_requests(n=1000, urls=('/api/books/1', '/api/copies/1',
+                                 '/api/readers/1')):
+    """Requests per second of ``n`` sequential GETs to each of ``urls``."""
+    db = BenchDB()
+    try:
+        populate_catalog(db.conn)
+        db.conn.close()
+        client = api_client(db.path)
+        result = {}
+        for url in urls:
+            started = time.time()
+            for i in range(n):
+                assert client.get(url).status_code == 200
+            result[url] = round(n / (time.time() - started), 1)
+    finally:
+        db.close()
+
+    return result
+
+
+def bench_dashboard(history=10000, n=10, target_ms=50):
+    """Milliseconds per reader home page for a reader with ``history``
+    returned loans plus the maximum of active loans and reservations: one
+    GET of the dashboard, against the reader detail followed by a GET of
+    every active borrow and reservation as js/reader.js does.
+
+    The dashboard should stay under ``target_ms`` whatever the history.
+    """
+    db = BenchDB()
+    try:
+        populate_borrowed(db.conn, history, readers=1,
+                          copies=Borrows.max_active_borrows +
+                          Reserves.max_active_reserves)
+        reader = Readers.get(db.conn, 1)
+        copies = Copies.get_all(db.conn)
+        for copy in copies[:Borrows.max_active_borrows]:
+            reader.checkout(copy)
+        for copy in copies[Borrows.max_active_borrows:]:
+            reader.reserve(copy)
+        db.conn.close()
+        client = api_client(db.path)
+
+        def detail_pages():
+            data = json.loads(client.get('/api/readers/1').data)
+            for borrow in data['borrows']:
+                if borrow['r_datetime'] is None:
+                    client.get(borrow['uri'])
+            for reserve in data['reserves']:
+                if reserve['is_reserved']:
+                    client.get(reserve['uri'])
+
+        def dashboard():
+            assert client.get('/api/readers/1/dashboard').status_code == 200
+
+        result = dict(history=history, target_ms=target_ms)
+        for name, fetch in (('detail_ms', detail_pages),
+                            ('dashboard_ms', dashboard)):
+            started = time.time()
+            for i in range(n):
+                fetch()
+            result[name] = round(1000 * (time.time() - started) / n, 2)
+    finally:
+        db.close()
+
+    return result
+
+
+def bench_serialize(n=100000, books=1000):
+    """Seconds to turn ``n`` prefetched copies into the /api/copies/ list,
+    with Flask-RESTful's marshal and with the compiled serializer, which
+    must dump to the same JSON.
+    """
+    import library_api
+    from flask.ext.restful import marshal
+    from library_serializers import serialize
+    db = BenchDB()
+    try:
+        populate_catalog(db.conn, books)
+        Copies.add_many(db.conn, [(i % books + 1, 1)
+                                  for i in range(n - books)])
+        copies = Copies.prefetch(db.conn, Copies.get_all(db.conn))
+        schema = library_api.CopyResource.uri_fields
+        result = dict(copies=len(copies))
+        dumped = {}
+        with library_api.app.test_request_context():
+            for name, function in (('marshal', marshal),
+                                   ('serialize', serialize)):
+                gc.collect()
+                started = time.time()
+                data = function(copies, schema, envelope='copies')
+                result[name + '_seconds'] = round(time.time() - started, 3)
+                dumped[name] = json.dumps(data)
+        assert dumped['marshal'] == dumped['serialize']
+        result['speedup'] = round(result['marshal_seconds'] /
+                                  result['serialize_seconds'], 1)
+    finally:
+        db.close()
+
+    return result
+
+
+def bench_mixed(seconds=3.0, readers=4):
+    """Read and write throughput of ``readers`` threads listing copies and
+    books while one thread checks a copy out and back in, per profile.
+    """
+    result = {}
+    for name in sorted(profiles):
+        db = BenchDB(profile=name)
+        try:
+            populate_catalog(db.conn, books=200)
+            counts = dict(reads=0, writes=0, errors=0)
+            lock = threading.Lock()
+            deadline = time.time() + seconds
+
+            def count(key):
+                with lock:
+                    counts[key] += 1
+
+            def read():
+                conn = connect(db.path, name, check_same_thread=False)
+                try:
+                    while time.time() < deadline:
+                        try:
+                            Copies.get_all(conn, available=True, limit=20)
+                            Books.get_all(conn, limit=20)
+                            count('reads')
+                        except sqlite3.Error:
+                            count('errors')
+                finally:
+                    conn.close()
+
+            def write():
+                conn = connect(db.path, name, check_same_thread=False)
+                try:
+                    reader = Readers.get(conn, 1)
+                    copy_ids = [copy.copy_id for copy in Copies.get_all(conn)]
+                    i = 0
+                    while time.time() < deadline:
+                        copy = Copies.get(conn, copy_ids[i % len(copy_ids)])
+                        i += 1
+                        try:
+                            reader.checkout(copy)
+                            reader.retrn(copy)
+                            count('writes')
+                        except sqlite3.Error:
+                            conn.rollback()
+                            count('errors')
+                finally:
+                    conn.close()
+
+            threads = [threading.Thread(target=read) for i in range(readers)]
+            threads.append(threading.Thread(target=write))
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            db.close()
+        result[name] = dict(reads_per_second=round(counts['reads'] / seconds, 1),
+                            writes_per_second=round(counts['writes'] / seconds, 1),
+                            errors=counts['errors'])
+
+    return result
+
+
+def bench_checkout(seconds=3.0, threads=(1, 4)):
+    """Checkouts per second with each thread lending (and taking back) its
+    own copies to its own reader, so only the write lock is contended.
+    """
+    result = {}
+    for thread_count in threads:
+        db = BenchDB()
+        try:
+            populate_catalog(db.conn, books=thread_count * 10)
+            reader_ids = Readers.add_many(db.conn,
+                                          [('R', 'A', 'lender {}'.format(i))
+                                           for i in range(thread_count)])
+            copy_ids = [copy.copy_id for copy in Copies.get_all(db.conn)]
+            checkouts = []
+            deadline = time.time() + seconds
+
+            def lend(reader_id, copy_ids):
+                conn = connect(db.path, check_same_thread=False)
+                try:
+                    reader = Readers.get(conn, reader_id)
+                    copies = [Copies.get(conn, copy_id) for copy_id in copy_ids]
+                    done = 0
+                    while time.time() < deadline:
+                        for copy in copies:
+                            reader.checkout(copy)
+                            reader.retrn(copy)
+                            done += 1
+                    checkouts.append(done)
+                finally:
+                    conn.close()
+
+            workers = [threading.Thread(target=lend,
+                                        args=(reader_id, copy_ids[i::thread_count]))
+                       for i, reader_id in enumerate(reader_ids)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        finally:
+            db.close()
+        result['{}_threads'.format(thread_count)] = round(sum(checkouts) / seconds, 1)
+
+    return result
+
+
+# Default size of the synthetic library; ``scale`` multiplies all but the
+# per_item_sizes, which are averages per book or per reader
+library_sizes = dict(branches=5, publishers=50, authors=500, books=2000,
+                     copies_per_book=3, readers=2000, active_readers=200,
+                     loans_per_reader_year=12, reserves_per_reader_year=4)
+per_item_sizes = ('copies_per_book', 'loans_per_reader_year',
+                  'reserves_per_reader_year')
+
+title_words = ('river', 'night', 'garden', 'empire', 'silent', 'winter',
+               'stone', 'history', 'ocean', 'light', 'city', 'secret',
+               'machine', 'forest', 'letters', 'shadow', 'journey', 'house',
+               'war', 'children', 'island', 'glass', 'mountain', 'song')
+
+
+def generate_library(conn, scale=1.0, seed=0, years=3,
+                     until=datetime(2016, 1, 1)):
+    """Fill the empty database behind ``conn`` with a synthetic library of
+    ``scale`` times ``library_sizes`` and ``years`` of borrow and reserve
+    history ending at ``until``. The same ``seed`` gives the same library.
+
+    Entities are created through the ``add_many`` methods and the current
+    loans and reservations through ``checkout``/``reserve``; only the
+    history, which those cannot backdate, is inserted directly.
+    """
+    rnd = random.Random(seed)
+    sizes = dict((key, value if key in per_item_sizes
+                  else max(1, int(round(value * scale))))
+                 for key, value in library_sizes.items())
+
+    lib_ids = [Branches.add(conn, 'Branch {}'.format(i),
+                            'Location {}'.format(i)).lib_id
+               for i in range(sizes['branches'])]
+    publisher_ids = Publishers.add_many(
+        conn, [('Publisher {}'.format(i), 'Address {}'.format(i))
+               for i in range(sizes['publishers'])])
+    author_ids = Authors.add_many(
+        conn, ['Author {}'.format(i) for i in range(sizes['authors'])])
+
+    def title():
+        return ' '.join(rnd.choice(title_words).title()
+                        for i in range(rnd.randint(1, 4)))
+
+    book_ids = Books.add_many(
+        conn, [(title(), 'ISBN-{:09d}'.format(i), rnd.choice(publisher_ids),
+                datetime(1950, 1, 1) + timedelta(days=rnd.randint(0, 24000)))
+               for i in range(sizes['books'])])
+    with conn:
+        conn.executemany('INSERT INTO Wrote (authorId, bookId) VALUES (?, ?)',
+                         [(author_id, book_id) for book_id in book_ids
+                          for author_id in rnd.sample(author_ids,
+                                                      rnd.randint(1, 3))])
+    copy_ids = Copies.add_many(
+        conn, [(book_id, rnd.choice(lib_ids)) for book_id in book_ids
+               for i in range(rnd.randint(1, 2 * sizes['copies_per_book'] - 1))])
+    reader_ids = Readers.add_many(
+        conn, [('Reader {}'.format(i), 'Address {}'.format(i),
+                'Phone {}'.format(i)) for i in range(sizes['readers'])])
+
+    since = until - timedelta(days=365 * years)
+    span = int((until - since).total_seconds()) - 31 * 24 * 3600
+
+    def moments(n):
+        return sorted(since + timedelta(seconds=rnd.randint(0, span))
+                      for i in range(n))
+
+    def loans():
+        for b_datetime in moments(sizes['loans_per_reader_year'] *
+                                  sizes['readers'] * years):
+            days = rnd.randint(1, 30)
+            fine_cents = (Borrows.fine_cents_per_day *
+                          max(days - Borrows.max_borrow_days, 0))
+            yield (rnd.choice(copy_ids), rnd.choice(reader_ids), b_datetime,
+                   b_datetime + timedelta(days=days), fine_cents)
+
+    def reserves():
+        for rv_datetime in moments(sizes['reserves_per_reader_year'] *
+                                   sizes['readers'] * years):
+            yield rnd.choice(copy_ids), rnd.choice(reader_ids), rv_datetime
+
+    with conn:
+        conn.executemany("""
+                         INSERT INTO
+                           Borrowed (copyId, readerId, bDatetime, rDatetime, fineCents)
+                         VALUES (?, ?, ?, ?, ?)
+                         """, loans())
+        conn.executemany("""
+                         INSERT INTO
+                           Reserved (copyId, readerId, rvDatetime, isReserved)
+                         VALUES (?, ?, ?, 0)
+                         """, reserves())
+
+    # Current activity, borrowed up to 40 days before ``until``
+    available = list(copy_ids)
+    rnd.shuffle(available)
+    active = dict(loans=0, reserves=0)
+    for reader_id in reader_ids[:sizes['active_readers']]:
+        reader = Readers.get(conn, reader_id)
+        for i in range(rnd.randint(1, 5)):
+            borrow = reader.checkout(Copies.get(conn, available.pop()))
+            with conn:
+                conn.execute('UPDATE Borrowed SET bDatetime = ? '
+                             'WHERE borrowId = ?',
+                             (until - timedelta(minutes=rnd.randint(0, 57600)),
+                              borrow.borrow_id))
+            active['loans'] += 1
+        for i in range(rnd.randint(0, 2)):
+            reader.reserve(Copies.get(conn, available.pop()))
+            active['reserves'] += 1
+
+    sizes.update(copies=len(copy_ids), active_loans=active['loans'],
+                 active_reserves=active['reserves'])
+    return sizes
+
+
+def timed(call, repeat, setup=None):
+    """Best and median milliseconds of ``repeat`` calls of ``call``, each
+    after ``setup`` (untimed) if given.
+    """
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.time()
+        call()
+        times.append(time.time() - started)
+    times.sort()
+    return dict(min_ms=round(1000 * times[0], 3),
+                median_ms=round(1000 * times[len(times) // 2], 3))
+
+
+def table_methods():
+    """'Table.method' for every public classmethod of the Table classes."""
+    names = set()
+    for table in Table.__subclasses__():
+        for name, value in vars(table).items():
+            if isinstance(value, classmethod) and not name.startswith('_'):
+                names.add('{}.{}'.format(table.__name__, name))
+    return names
+
+
+def api_routes():
+    """'METHOD /api/...' for every GET and POST route of library_api. A
+    LibraryResource only takes POSTs on its collection, so its POSTs to
+    single items are left out.
+    """
+    import library_api
+    routes = set()
+    for rule in library_api.app.url_map.iter_rules():
+        if not rule.rule.startswith('/api/'):
+            continue
+        view = library_api.app.view_functions[rule.endpoint]
+        item = (rule.arguments and
+                issubclass(getattr(view, 'view_class', object),
+                           library_api.LibraryResource))
+        for method in rule.methods & set(['GET', 'POST']):
+            if not (method == 'POST' and item):
+                routes.add('{} {}'.format(method, rule.rule))
+    return routes
+
+
+def bench_table_methods(conn, repeat):
+    """Time every Table method against the generated library."""
+    reader = Readers.get(conn, 1)
+    borrowed = Copies.get_all(conn, available=False, limit=1)[0]
+    book_ids = [book.book_id for book in Books.get_all(conn, limit=100)]
+    copy_ids = [copy.copy_id for copy in Copies.get_all(conn, limit=100)]
+    counter = itertools.count()
+    clear = conn.identity_map.clear
+
+    def unique(prefix):
+        return '{} {}'.format(prefix, next(counter))
+
+    calls = {
+        'Authors.add': lambda: Authors.add(conn, unique('Bench Author')),
+        'Authors.add_many': lambda: Authors.add_many(
+            conn, [unique('Bench Author') for i in range(100)]),
+        'Authors.get': lambda: Authors.get(conn, 1),
+        'Authors.get_all': lambda: Authors.get_all(conn, limit=100),
+        'Authors.get_authors_of': lambda: Authors.get_authors_of(conn, 1),
+        'Authors.get_authors_of_many': lambda: Authors.get_authors_of_many(
+            conn, book_ids),
+        'Authors.iter_all': lambda: list(Authors.iter_all(conn)),
+        'Books.add': lambda: Books.add(conn, 'Bench Book', unique('ISBN'), 1,
+                                       datetime(2015, 1, 1)),
+        'Books.add_many': lambda: Books.add_many(
+            conn, [('Bench Book', unique('ISBN'), 1, datetime(2015, 1, 1))
+                   for i in range(100)]),
+        'Books.get': lambda: Books.get(conn, 1),
+        'Books.get_all': lambda: Books.get_all(conn, limit=100),
+        'Books.get_many': lambda: Books.get_many(conn, book_ids),
+        'Books.iter_all': lambda: list(Books.iter_all(conn)),
+        'Books.prefetch': lambda: Books.prefetch(conn,
+                                                 Books.get_many(conn, book_ids)),
+        'Books.search': lambda: Books.search(conn, 'river night', limit=20),
+        'Borrows.get': lambda: Borrows.get(conn, 1),
+        'Borrows.get_accrued_fine': lambda: Borrows.get_accrued_fine(conn, reader),
+        'Borrows.get_active_borrower': lambda: Borrows.get_active_borrower(
+            conn, borrowed),
+        'Borrows.get_active_borrower_ids': lambda:
+            Borrows.get_active_borrower_ids(conn, copy_ids),
+        'Borrows.get_all': lambda: Borrows.get_all(conn, limit=100),
+        'Borrows.get_all_borrowed_by': lambda: Borrows.get_all_borrowed_by(
+            conn, reader),
+        'Borrows.get_num_active_borrowed_by': lambda:
+            Borrows.get_num_active_borrowed_by(conn, reader),
+        'Borrows.get_overdue': lambda: Borrows.get_overdue(conn, limit=100),
+        'Borrows.iter_all': lambda: list(Borrows.iter_all(conn)),
+        'Branches.add': lambda: Branches.add(conn, unique('Bench Branch'),
+                                             unique('Bench Location')),
+        'Branches.get': lambda: Branches.get(conn, 1),
+        'Branches.get_all': lambda: Branches.get_all(conn),
+        'Branches.get_many': lambda: Branches.get_many(conn, [1, 2, 3]),
+        'Branches.iter_all': lambda: list(Branches.iter_all(conn)),
+        'Copies.add': lambda: Copies.add(conn, 1, 1),
+        'Copies.add_many': lambda: Copies.add_many(
+            conn, [(book_id, 1) for book_id in book_ids]),
+        'Copies.get': lambda: Copies.get(conn, 1),
+        'Copies.get_all': lambda: Copies.get_all(conn, available=True,
+                                                 limit=100),
+        'Copies.get_copies_of': lambda: Copies.get_copies_of(conn, 1),
+        'Copies.get_copies_of_many': lambda: Copies.get_copies_of_many(
+            conn, book_ids),
+        'Copies.get_many': lambda: Copies.get_many(conn, copy_ids),
+        'Copies.iter_all': lambda: list(Copies.iter_all(conn)),
+        'Copies.max_number': lambda: Copies.max_number(conn, 1, 1),
+        'Copies.prefetch': lambda: Copies.prefetch(conn,
+                                                   Copies.get_many(conn, copy_ids)),
+        'Publishers.add': lambda: Publishers.add(conn, unique('Bench Publisher'),
+                                                 unique('Bench Address')),
+        'Publishers.add_many': lambda: Publishers.add_many(
+            conn, [(unique('Bench Publisher'), unique('Bench Address'))
+                   for i in range(100)]),
+        'Publishers.get': lambda: Publishers.get(conn, 1),
+        'Publishers.get_all': lambda: Publishers.get_all(conn, limit=100),
+        'Publishers.get_many': lambda: Publishers.get_many(conn, range(1, 51)),
+        'Publishers.iter_all': lambda: list(Publishers.iter_all(conn)),
+        'Readers.add': lambda: Readers.add(conn, 'Bench Reader', 'Address',
+                                           unique('Bench Phone')),
+        'Readers.add_many': lambda: Readers.add_many(
+            conn, [('Bench Reader', 'Address', unique('Bench Phone'))
+                   for i in range(100)]),
+        'Readers.average_fine': lambda: Readers.average_fine(conn),
+        'Readers.dashboard': lambda: Readers.dashboard(conn, reader),
+        'Readers.get': lambda: Readers.get(conn, 1),
+        'Readers.get_all': lambda: Readers.get_all(conn, limit=100),
+        'Readers.get_many': lambda: Readers.get_many(conn, range(1, 101)),
+        'Readers.iter_all': lambda: list(Readers.iter_all(conn)),
+        'Reserves.get': lambda: Reserves.get(conn, 1),
+        'Reserves.get_active_reserver': lambda: Reserves.get_active_reserver(
+            conn, borrowed),
+        'Reserves.get_active_reserver_ids': lambda:
+            Reserves.get_active_reserver_ids(conn, copy_ids),
+        'Reserves.get_all': lambda: Reserves.get_all(conn, limit=100),
+        'Reserves.get_all_reserved_by': lambda: Reserves.get_all_reserved_by(
+            conn, reader),
+        'Reserves.get_num_active_reserved_by': lambda:
+            Reserves.get_num_active_reserved_by(conn, reader),
+        'Reserves.iter_all': lambda: list(Reserves.iter_all(conn)),
+    }
+    result = dict((name, timed(call, repeat, clear))
+                  for name, call in sorted(calls.items()))
+
+    # The lending methods change state, so each is timed over its own
+    # fresh (reader, available copy) pairs, in the order a loan goes
+    readers = Readers.get_many(conn, Readers.add_many(
+        conn, [('Bench Lender', 'Address', unique('Bench Phone'))
+               for i in range(repeat)]))
+    pairs = zip(Copies.get_all(conn, available=True, limit=repeat), readers)
+    for name, action in (('Borrows.add', Borrows.add),
+                         ('Borrows.retrn', Borrows.retrn),
+                         ('Reserves.add', Reserves.add),
+                         ('Reserves.cancel', Reserves.cancel)):
+        todo = iter(pairs)
+        result[name] = timed(lambda: action(conn, *next(todo)), len(pairs))
+
+    return result
+
+
+def bench_resources(client, ids, repeat):
+    """Time every /api/ route of library_api through the test client."""
+    import library_api
+    counter = itertools.count()
+
+    def unique(prefix):
+        return '{} {}'.format(prefix, next(counter))
+
+    def expect(status_code, response):
+        assert response.status_code == status_code, (status_code,
+                                                     response.data)
+
+    bodies = {
+        'authorresource': lambda: dict(name=unique('Bench Author')),
+        'bookresource': lambda: dict(title='Bench Book',
+                                     ISBN=unique('Bench ISBN'),
+                                     publisher_id=ids['publisher_id'],
+                                     publish_date='2015-01-01'),
+        'copyresource': lambda: dict(book_id=ids['book_id'],
+                                     lib_id=ids['lib_id']),
+        'readerresource': lambda: dict(name='Bench Reader', address='Address',
+                                       phone=unique('Bench Phone')),
+    }
+
+    result = {}
+    rules = sorted((rule for rule in library_api.app.url_map.iter_rules()
+                    if rule.rule.startswith('/api/')),
+                   key=lambda rule: rule.rule)
+    for rule in rules:
+        # Routes taking anything but the ids of rows, such as the profile
+        # files' names, are left untimed
+        if not all('<int:{}>'.format(argument) in rule.rule and
+                   argument in ids for argument in rule.arguments):
+            continue
+        url = rule.rule
+        for argument in rule.arguments:
+            url = url.replace('<int:{}>'.format(argument),
+                              str(ids[argument]))
+        if 'GET' in rule.methods:
+            result['GET ' + rule.rule] = timed(
+                lambda: expect(200, client.get(url + '?limit=50')), repeat)
+        if ('POST' in rule.methods and not rule.arguments and
+                rule.endpoint in bodies):
+            body = bodies[rule.endpoint]
+            result['POST ' + rule.rule] = timed(
+                lambda: expect(201, client.post(url, data=body())), repeat)
+    result['GET /api/books/?q'] = timed(
+        lambda: expect(200, client.get('/api/books/?q=river+night&limit=50')),
+        repeat)
+
+    # Lend fresh copies to the session's reader in batches that fit next to
+    # the up to 5 loans and 2 reservations generate_library gave them
+    batch = min(repeat, Borrows.max_active_borrows - 5,
+                Reserves.max_active_reserves - 2)
+    verbs = ('checkout', 'return', 'reserve', 'cancel')
+    times = dict((verb, []) for verb in verbs)
+    for i in range(0, repeat, batch):
+        copy_ids = [int(copy['copy_id']) for copy in json.loads(
+            client.get('/api/copies/?availability=available&limit={}'
+                       .format(batch)).data)['copies']]
+        for verb in verbs:
+            for copy_id in copy_ids:
+                url = '/api/readers/{}/{}'.format(ids['reader_id'], verb)
+                started = time.time()
+                response = client.post(url, data=dict(copy_id=copy_id))
+                times[verb].append(time.time() - started)
+                expect(201, response)
+    for verb in verbs:
+        spent = sorted(times[verb])
+        result['POST /api/readers/<int:reader_id>/' + verb] = dict(
+            min_ms=round(1000 * spent[0], 3),
+            median_ms=round(1000 * spent[len(spent) // 2], 3))
+
+    return result
+
+
+def bench_suite(scale=0.1, seed=0, repeat=5):
+    """Generate a synthetic library and time every Table method and every
+    API route against it. The result also records the sizes, the seed and
+    the versions involved so that runs can be compared across releases.
+    """
+    db = BenchDB()
+    try:
+        started = time.time()
+        sizes = generate_library(db.conn, scale, seed)
+        generate_seconds = time.time() - started
+        tables = bench_table_methods(db.conn, repeat)
+        db.conn.close()
+
+        ids = dict(author_id=1, book_id=1, lib_id=1, publisher_id=1,
+                   reader_id=1, copy_id=1, borrow_id=1, reserve_id=1)
+        client = api_client(db.path)
+        with client.session_transaction() as session:
+            session['reader_id'] = ids['reader_id']
+        resources = bench_resources(client, ids, repeat)
+    finally:
+        db.close()
+
+    return dict(scale=scale, seed=seed, repeat=repeat, sizes=sizes,
+                generate_seconds=round(generate_seconds, 3),
+                python_version=sys.version.split()[0],
+                sqlite_version=sqlite3.sqlite_version,
+                tables=tables, resources=resources,
+                untimed=sorted((table_methods() - set(tables)) |
+                               (api_routes() - set(resources))))
+
+
+benchmarks = {
+    'average_fine': bench_average_fine,
+    'borrowed_memory': bench_borrowed_memory,
+    'checkout': bench_checkout,
+    'dashboard': bench_dashboard,
+    'mixed': bench_mixed,
+    'overdue': bench_overdue,
+    'requests': bench_requests,
+    'serialize': bench_serialize,
+    'suite': bench_suite,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run benchmarks, printing one JSON line each.')
+    parser.add_argument('names', nargs='*', metavar='benchmark',
+                        help=', '.join(sorted(benchmarks)))
+    parser.add_argument('--scale', type=float, default=0.1,
+                        help='suite: library size relative to library_sizes')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='suite: seed of the generated library')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='suite: timed calls of each method and route')
+    args = parser.parse_args()
+    for name in args.names or sorted(benchmarks):
+        if name == 'suite':
+            result = bench_suite(args.scale, args.seed, args.repeat)
+        else:
+            result = benchmarks[name]()
+        result['benchmark'] = name
+        print(json.dumps(result, sort_keys=True))
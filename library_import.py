@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Bulk import of a book catalog from CSV or JSON lines.
+
+Every record is one book::
+
+    title, isbn, publish_date (YYYY-MM-DD), publisher, publisher_address,
+    authors, copies
+
+In CSV the authors are separated by ``;`` and the copies are written as
+``Branch name=count`` separated by ``;``; in JSON lines ``authors`` is a
+list of names and ``copies`` an object of counts by branch name.
+Publishers and authors are matched by name and created when missing; the
+branches must already exist. ``publisher_address`` is only needed for new
+publishers.
+"""
+from __future__ import print_function
+from datetime import datetime
+from itertools import islice
+from library import *
+from library import _inserted_ids, _invalidate, _select_in
+import argparse
+import csv
+import json
+import sys
+
+__author__ = 'shunghsiyu'
+
+
+class RejectedRecord(Exception):
+    pass
+
+
+def _text(value):
+    if value is None:
+        return u''
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    return unicode(value).strip()
+
+
+def _unique(items):
+    """The distinct ``items`` in the order they first appear."""
+    seen = set()
+    unique = []
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            unique.append(item)
+    return unique
+
+
+def _split(value):
+    return [part.strip() for part in _text(value).split(u';') if part.strip()]
+
+
+def parse_csv_copies(value):
+    copies = []
+    for part in _split(value):
+        branch, equals, count = part.rpartition(u'=')
+        if not equals:
+            branch, count = part, 1
+        copies.append((branch.strip(), count))
+    return copies
+
+
+def read_csv(lines):
+    """Yield (line number, record) for the rows of a CSV catalog."""
+    reader = csv.DictReader(lines)
+    for row in reader:
+        yield reader.line_num, dict(row,
+                                    authors=_split(row.get('authors')),
+                                    copies=parse_csv_copies(row.get('copies')))
+
+
+def read_json_lines(lines):
+    """Yield (line number, record) for a catalog of one JSON object per
+    line, with a RejectedRecord as the record of a line that is not one.
+    """
+    for line_num, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            record['copies'] = sorted((record.get('copies') or {}).items())
+        except (ValueError, AttributeError, TypeError) as e:
+            record = RejectedRecord(u'not a JSON object: {}'.format(e))
+        yield line_num, record
+
+
+readers = {
+    'csv': read_csv,
+    'jsonl': read_json_lines,
+}
+
+
+def clean(record, lib_ids):
+    """The book ``record`` as a dict of decoded values, or RejectedRecord."""
+    book = dict((key, _text(record.get(key)))
+                for key in ('title', 'isbn', 'publish_date', 'publisher',
+                            'publisher_address'))
+    for key in ('title', 'isbn', 'publish_date', 'publisher'):
+        if not book[key]:
+            raise RejectedRecord('missing {}'.format(key))
+    try:
+        book['publish_date'] = datetime.strptime(book['publish_date'],
+                                                 date_format)
+    except ValueError:
+        raise RejectedRecord('publish_date is not YYYY-MM-DD')
+
+    book['authors'] = _unique(_text(name)
+                              for name in record.get('authors') or ()
+                              if _text(name))
+    book['copies'] = []
+    for branch, count in record.get('copies') or ():
+        lib_id = lib_ids.get(_text(branch))
+        if lib_id is None:
+            raise RejectedRecord(u'no branch named {}'.format(branch))
+        try:
+            count = int(count)
+        except (TypeError, ValueError):
+            raise RejectedRecord(u'bad copy count for {}'.format(branch))
+        book['copies'].extend([lib_id] * count)
+    return book
+
+
+def _ids_by_name(conn, query, names):
+    return dict((row[1], row[0]) for row in _select_in(conn, query, names))
+
+
+def import_batch(conn, batch, stats, report):
+    """Insert the cleaned ``batch`` of (line number, book) in a single
+    transaction, creating the publishers and authors it names.
+    """
+    with conn:
+        c = conn.cursor()
+        c.execute('BEGIN IMMEDIATE')
+        # Looked up under the write lock, so that no other writer can add one
+        # of these ISBNs before they are inserted
+        existing = set(row[0] for row in _select_in(conn, """
+            SELECT ISBN
+            FROM Book
+            WHERE ISBN IN ({})
+            """, [book['isbn'] for line_num, book in batch]))
+        books = []
+        for line_num, book in batch:
+            if book['isbn'] in existing:
+                report(line_num, book['isbn'], 'duplicate ISBN')
+                stats['duplicates'] += 1
+            else:
+                existing.add(book['isbn'])
+                books.append((line_num, book))
+        if not books:
+            return
+
+        publisher_ids = _ids_by_name(conn, """
+            SELECT publisherId, name
+            FROM Publisher
+            WHERE name IN ({})
+            """, set(book['publisher'] for line_num, book in books))
+        addresses = {}
+        for line_num, book in books:
+            if book['publisher'] not in publisher_ids:
+                addresses.setdefault(book['publisher'],
+                                     book['publisher_address'])
+        # Addresses are unique too: a new publisher needs an unused one
+        taken = set(row[0] for row in _select_in(conn, """
+            SELECT address
+            FROM Publisher
+            WHERE address IN ({})
+            """, addresses.values()))
+        new_publishers = []
+        for name in _unique(book['publisher'] for line_num, book in books
+                            if book['publisher'] in addresses):
+            if addresses[name] and addresses[name] not in taken:
+                taken.add(addresses[name])
+                new_publishers.append((name, addresses[name]))
+        c.executemany('INSERT INTO Publisher (name, address) VALUES (?, ?)',
+                      new_publishers)
+        publisher_ids.update(zip([name for name, address in new_publishers],
+                                 _inserted_ids(c)))
+        stats['publishers'] += len(new_publishers)
+        for line_num, book in books:
+            if book['publisher'] not in publisher_ids:
+                report(line_num, book['isbn'],
+                       'new publisher needs an unused publisher_address')
+                stats['rejected'] += 1
+        books = [(line_num, book) for line_num, book in books
+                 if book['publisher'] in publisher_ids]
+
+        names = set(name for line_num, book in books
+                    for name in book['authors'])
+        author_ids = _ids_by_name(conn, """
+            SELECT MIN(authorId), name
+            FROM Author
+            WHERE name IN ({})
+            GROUP BY name
+            """, names)
+        new_authors = sorted(names - set(author_ids))
+        c.executemany('INSERT INTO Author (name) VALUES (?)',
+                      ((name,) for name in new_authors))
+        author_ids.update(zip(new_authors, _inserted_ids(c)))
+        stats['authors'] += len(new_authors)
+
+        c.executemany("""
+                      INSERT INTO Book (title, ISBN, publisherId, publishdate)
+                      VALUES (?, ?, ?, ?)
+                      """,
+                      ((book['title'], book['isbn'],
+                        publisher_ids[book['publisher']],
+                        book['publish_date'].strftime(date_format))
+                       for line_num, book in books))
+        book_ids = _inserted_ids(c)
+        stats['books'] += len(book_ids)
+
+        c.executemany('INSERT INTO Wrote (authorId, bookId) VALUES (?, ?)',
+                      ((author_ids[name], book_id)
+                       for (line_num, book), book_id in zip(books, book_ids)
+                       for name in book['authors']))
+        c.executemany(Copies._insert_numbered,
+                      ((book_id, lib_id, book_id, lib_id)
+                       for (line_num, book), book_id in zip(books, book_ids)
+                       for lib_id in book['copies']))
+        stats['copies'] += max(c.rowcount, 0)
+    _invalidate(conn)
+
+
+def import_catalog(conn, records, batch_size=1000, report=None):
+    """Import the (line number, record) pairs of ``records``, a batch at a
+    time, and return how many rows of each kind were added or skipped.
+
+    Only one batch is held in memory. Duplicate ISBNs (against the database
+    or earlier in the input), invalid records and the RejectedRecords a
+    reader gives for lines it could not read are passed to
+    ``report(line number, isbn, problem)`` and skipped.
+    """
+    report = report or (lambda line_num, isbn, problem: None)
+    lib_ids = dict((branch.name, branch.lib_id)
+                   for branch in Branches.iter_all(conn))
+    stats = dict(books=0, copies=0, publishers=0, authors=0, duplicates=0,
+                 rejected=0)
+
+    def cleaned():
+        for line_num, record in records:
+            if isinstance(record, RejectedRecord):
+                report(line_num, u'', record.args[0])
+                stats['rejected'] += 1
+                continue
+            try:
+                yield line_num, clean(record, lib_ids)
+            except RejectedRecord as e:
+                report(line_num, _text(record.get('isbn')), e.args[0])
+                stats['rejected'] += 1
+
+    books = cleaned()
+    while True:
+        batch = list(islice(books, batch_size))
+        if not batch:
+            break
+        import_batch(conn, batch, stats, report)
+
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('catalog', help="CSV or JSON lines file, '-' for stdin")
+    parser.add_argument('--db', default='library.db')
+    parser.add_argument('--format', choices=sorted(readers),
+                        help='default: from the file extension')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--report', help='CSV of skipped records '
+                                         '(default: stderr)')
+    args = parser.parse_args(argv)
+
+    format = args.format or ('csv' if args.catalog.endswith('.csv')
+                             else 'jsonl')
+    catalog = sys.stdin if args.catalog == '-' else open(args.catalog, 'rb')
+    report_file = open(args.report, 'wb') if args.report else sys.stderr
+    report_writer = csv.writer(report_file)
+    report_writer.writerow(('line', 'isbn', 'problem'))
+
+    def report(line_num, isbn, problem):
+        report_writer.writerow((line_num, isbn.encode('utf-8'),
+                                problem.encode('utf-8')))
+
+    conn = start(args.db)
+    try:
+        stats = import_catalog(conn, readers[format](catalog),
+                               args.batch_size, report)
+    finally:
+        conn.close()
+        catalog.close()
+        if args.report:
+            report_file.close()
+    print(json.dumps(stats, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
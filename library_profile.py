@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Profiling of single requests.
+
+``StackProfiler`` follows every Python and builtin call of the thread that
+starts it through ``sys.setprofile`` and adds up the time spent in each
+distinct call stack. ``write_profile`` turns that into two files: the
+stacks in the collapsed format of flamegraph.pl and speedscope
+(``frame;frame;frame microseconds`` per line), and a text summary that
+splits the time between SQL and Python and lists the hottest functions.
+
+The profiler slows down what it watches several times over, so it is only
+meant to be turned on for one request at a time.
+"""
+from __future__ import print_function
+from collections import defaultdict
+import os
+import sys
+import time
+
+__author__ = 'shunghsiyu'
+
+
+class StackProfiler(object):
+
+    def __init__(self):
+        # Own seconds by stack, a tuple of frame labels from the outermost
+        self.stacks = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.files = {}
+        self.seconds = None
+        self._labels = {}
+        self._stack = ()
+        self._last = None
+
+    def start(self):
+        self._last = time.time()
+        sys.setprofile(self._event)
+
+    def stop(self):
+        sys.setprofile(None)
+        self.stacks[self._stack] += time.time() - self._last
+        # The time between events, less the profiler's own
+        self.seconds = sum(self.stacks.values())
+
+    def _event(self, frame, event, arg):
+        now = time.time()
+        self.stacks[self._stack] += now - self._last
+        if event == 'call':
+            label = self._label(frame.f_code)
+            self._stack += (label,)
+            self.calls[label] += 1
+        elif event == 'c_call':
+            label = self._c_label(arg)
+            self._stack += (label,)
+            self.calls[label] += 1
+        elif self._stack:
+            # A return; those of the frames entered before start are
+            # ignored, as they were never pushed
+            self._stack = self._stack[:-1]
+        # Leave the profiler's own time out
+        self._last = time.time()
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = '{} ({}:{})'.format(code.co_name,
+                                        os.path.basename(code.co_filename),
+                                        code.co_firstlineno).replace(';', ',')
+            self._labels[code] = label
+            self.files[label] = code.co_filename
+        return label
+
+    def _c_label(self, function):
+        # Bound builtins hash by the object they are bound to, which may be
+        # unhashable, so they are told apart by its type and their name
+        owner = getattr(function, '__self__', None)
+        if owner is None or isinstance(owner, type(sys)):
+            owner = getattr(function, '__module__', None) or 'builtin'
+        else:
+            owner = type(owner).__name__
+        key = (owner, function.__name__)
+        label = self._labels.get(key)
+        if label is None:
+            label = self._labels[key] = '{}.{}'.format(*key).replace(';', ',')
+            self.files[label] = None
+        return label
+
+    def collapsed(self, root):
+        """The lines of the collapsed stacks under a ``root`` frame, with
+        their own time in microseconds.
+        """
+        root = root.replace(';', ',')
+        for stack, seconds in sorted(self.stacks.items()):
+            microseconds = int(round(seconds * 1e6))
+            if microseconds:
+                yield '{} {}\n'.format(';'.join((root,) + stack),
+                                       microseconds)
+
+    def functions(self):
+        """(label, own seconds, cumulative seconds, calls) of every frame
+        label seen.
+        """
+        own = defaultdict(float)
+        cumulative = defaultdict(float)
+        for stack, seconds in self.stacks.items():
+            if stack:
+                own[stack[-1]] += seconds
+            for label in set(stack):
+                cumulative[label] += seconds
+        return [(label, own[label], cumulative[label], self.calls[label])
+                for label in cumulative]
+
+    def inclusive(self, in_frame):
+        """Seconds spent with at least one frame on the stack whose
+        (label, filename) ``in_frame`` is true for.
+        """
+        return sum(seconds for stack, seconds in self.stacks.items()
+                   if any(in_frame(label, self.files.get(label))
+                          for label in stack))
+
+
+def _in_library(label, filename):
+    return filename is not None and os.path.basename(filename) == 'library.py'
+
+
+def _in_serialization(label, filename):
+    if filename is None:
+        return False
+    if os.path.basename(filename) == 'library_serializers.py':
+        return True
+    return 'flask_restful' in filename and label.startswith('marshal ')
+
+
+def summary(profiler, title, sql_seconds, sql_statements, top_n=25):
+    """The text summary of ``profiler``, for a request that spent
+    ``sql_seconds`` in ``sql_statements`` SQL statements.
+    """
+    total = profiler.seconds or 0.0
+
+    def share(seconds):
+        return '{:9.1f} ms {:5.1f}%'.format(
+            1000 * seconds, 100 * seconds / total if total else 0.0)
+
+    lines = [title,
+             '{:.1f} ms profiled, without the profiler\'s own time'
+             .format(1000 * total),
+             '',
+             'SQL           {} in {} statements'.format(share(sql_seconds),
+                                                        sql_statements),
+             'Python        {}'.format(share(max(total - sql_seconds, 0.0))),
+             'library.py    {}'.format(share(profiler.inclusive(_in_library))),
+             'serialization {}'.format(
+                 share(profiler.inclusive(_in_serialization))),
+             '',
+             'Top {} functions by own time'.format(top_n),
+             '{:>10} {:>10} {:>8}  {}'.format('own ms', 'cum ms', 'calls',
+                                              'function')]
+    functions = sorted(profiler.functions(), key=lambda f: f[1],
+                       reverse=True)
+    for label, own, cumulative, calls in functions[:top_n]:
+        lines.append('{:10.2f} {:10.2f} {:8d}  {}'.format(
+            1000 * own, 1000 * cumulative, calls, label))
+    return '\n'.join(lines) + '\n'
+
+
+def prune_profiles(directory, keep):
+    """Delete all but the ``keep`` newest profiles in ``directory``."""
+    profiles = {}
+    for filename in os.listdir(directory):
+        name, extension = os.path.splitext(filename)
+        if extension in ('.collapsed', '.txt'):
+            path = os.path.join(directory, filename)
+            try:
+                modified = os.path.getmtime(path)
+            except OSError:
+                continue
+            profiles.setdefault(name, []).append((modified, path))
+    newest_first = sorted(profiles.values(), key=max, reverse=True)
+    for paths in newest_first[keep:]:
+        for _, path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                # Pruned by another request already
+                pass
+
+
+def write_profile(profiler, directory, name, title, sql_seconds,
+                  sql_statements, top_n=25):
+    """Write ``name``.collapsed and ``name``.txt into ``directory``."""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(os.path.join(directory, name + '.collapsed'), 'w') as out:
+        out.writelines(profiler.collapsed(title))
+    with open(os.path.join(directory, name + '.txt'), 'w') as out:
+        out.write(summary(profiler, title, sql_seconds, sql_statements,
+                          top_n))
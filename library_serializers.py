@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Compiled versions of the ``marshall_fields`` schemas of the web API.
+
+``serialize(data, fields, envelope)`` returns what Flask-RESTful's
+``marshal`` does, and dumps to the same JSON, but compiles each schema once
+into plain functions: the field types, attributes and defaults are looked
+at when compiling instead of for every object, ``fields.Url`` becomes a
+prefix found with one ``url_for`` per call plus the object's id, and the
+objects are built as ``Record`` dicts, which are ordered by their schema
+without the cost of an OrderedDict.
+
+Fields the compiler has no shortcut for fall back to their own ``output``.
+``select_fields`` cuts a schema down to the ``fields=`` and ``expand=`` of a
+request before it is compiled, so what is left out is never computed.
+"""
+from __future__ import print_function
+from collections import OrderedDict
+from flask import current_app, request, url_for
+from flask.ext.restful import fields
+from inspect import isfunction
+from library import Entity
+from urlparse import urlparse, urlunparse
+import re
+
+__author__ = 'shunghsiyu'
+
+
+class Record(dict):
+    """A dict that iterates in the order of its schema's fields, like the
+    OrderedDict ``marshal`` returns. Keys added later come last.
+    """
+    __slots__ = ()
+    order = ()
+
+    def __iter__(self):
+        if len(self) == len(self.order):
+            return iter(self.order)
+        order = set(self.order)
+        return iter([key for key in self.order if key in self] +
+                    [key for key in dict.__iter__(self) if key not in order])
+
+    iterkeys = __iter__
+
+    def keys(self):
+        return list(self)
+
+    def iteritems(self):
+        return ((key, self[key]) for key in self)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def itervalues(self):
+        return (self[key] for key in self)
+
+    def values(self):
+        return list(self.itervalues())
+
+    def copy(self):
+        return type(self)(self)
+
+    def __repr__(self):
+        return 'Record({!r})'.format(self.items())
+
+
+def _record_class(keys):
+    return type(str('Record'), (Record,),
+                {'__slots__': (), 'order': tuple(keys)})
+
+
+# The fields whose format is one builtin call, and the builtin
+_formats = {
+    fields.String: unicode,
+    fields.Integer: int,
+    fields.Boolean: bool,
+    fields.Float: float,
+}
+
+# The builtin Raw.output, to tell whether a field class overrides it
+_raw_output = fields.Raw.output.__func__
+
+_indexable = {}
+
+
+def _getter(key):
+    """``fields.get_value(key, obj)`` for a fixed key."""
+    if isfunction(key):
+        return key
+    if type(key) == int or '.' in key:
+        return lambda obj: fields.get_value(key, obj)
+
+    def get(obj):
+        cls = type(obj)
+        indexable = _indexable.get(cls)
+        if indexable is None:
+            indexable = _indexable[cls] = \
+                fields.is_indexable_but_not_string(obj)
+        if indexable:
+            try:
+                return obj[key]
+            except (IndexError, TypeError, KeyError):
+                pass
+        return getattr(obj, key, None)
+    return get
+
+
+def _compile_field(key, field):
+    """A function of (obj, urls) giving what ``field.output(key, obj)``
+    would.
+    """
+    if isinstance(field, type):
+        field = field()
+    cls = type(field)
+    get = _getter(key if field.attribute is None else field.attribute)
+
+    if cls is fields.Nested:
+        nested = compile_fields(field.nested)
+        allow_null = field.allow_null
+        default = field.default
+
+        def output(obj, urls):
+            value = get(obj)
+            if value is None:
+                if allow_null:
+                    return None
+                elif default is not None:
+                    return default
+            return nested(value, urls)
+        return output
+
+    if cls is fields.Url and field.endpoint is not None and \
+            not field.absolute:
+        endpoint = field.endpoint
+
+        def output(obj, urls):
+            template = urls[endpoint]
+            if template is not None:
+                url = template.url_of(obj)
+                if url is not None:
+                    return url
+            return field.output(key, obj)
+        return output
+
+    if cls.output.__func__ is not _raw_output:
+        return lambda obj, urls: field.output(key, obj)
+
+    format = _formats.get(cls, field.format)
+    default = field.default
+
+    def output(obj, urls):
+        value = get(obj)
+        if value is None:
+            return default
+        return format(value)
+    return output
+
+
+_compiled = {}
+# Selections make new schemas per query string, so the caches are bounded
+_max_cached = 512
+
+
+def compile_fields(schema):
+    """The function of (data, urls) that marshals ``data``, one object or a
+    list of them, with the fields of ``schema``.
+    """
+    compiled = _compiled.get(id(schema))
+    if compiled is not None and compiled[0] is schema:
+        return compiled[1]
+    if len(_compiled) >= _max_cached:
+        _compiled.clear()
+
+    keys = list(schema)
+    outputs = []
+    for key in keys:
+        field = schema[key]
+        if isinstance(field, dict):
+            outputs.append(compile_fields(field))
+        else:
+            outputs.append(_compile_field(key, field))
+    record = _record_class(keys)
+    pairs = zip(keys, outputs)
+
+    def marshal_one(data, urls):
+        if isinstance(data, (list, tuple)):
+            return [marshal_one(item, urls) for item in data]
+        result = record()
+        for key, output in pairs:
+            result[key] = output(data, urls)
+        return result
+
+    _compiled[id(schema)] = (schema, marshal_one)
+    return marshal_one
+
+
+def parse_selection(value):
+    """The tree of the comma separated, dotted names in ``value``, e.g.
+    ``{'title': {}, 'copies': {'branch': {}}}`` for ``title,copies.branch``.
+    """
+    if value is None:
+        return None
+    tree = {}
+    for path in value.split(','):
+        node = tree
+        for name in path.strip().split('.'):
+            if name:
+                node = node.setdefault(name, {})
+    return tree
+
+
+def _nested_schema(field):
+    if isinstance(field, dict):
+        return field
+    if isinstance(field, fields.Nested):
+        return field.nested
+    return None
+
+
+def _select(schema, only, expand):
+    for name in only or ():
+        if name not in schema:
+            raise ValueError('no field {}'.format(name))
+    for name in expand or ():
+        if _nested_schema(schema.get(name)) is None:
+            raise ValueError('no nested field {}'.format(name))
+
+    selected = OrderedDict()
+    for key in schema:
+        field = schema[key]
+        if only is not None and key not in only:
+            continue
+        nested = _nested_schema(field)
+        if nested is not None:
+            if expand is not None and key not in expand:
+                continue
+            sub_only = only[key] or None if only is not None else None
+            sub_expand = expand[key] or None if expand is not None else None
+            if sub_only is not None or sub_expand is not None:
+                nested = _select(nested, sub_only, sub_expand)
+                if isinstance(field, dict):
+                    field = nested
+                else:
+                    field = fields.Nested(nested, allow_null=field.allow_null,
+                                          default=field.default,
+                                          attribute=field.attribute)
+        selected[key] = field
+    return selected
+
+
+_selections = {}
+
+
+def select_fields(schema, only=None, expand=None):
+    """The part of ``schema`` that the ``fields=`` and ``expand=`` query
+    values ``only`` and ``expand`` ask for, in the schema's order.
+
+    Keys not named in ``only`` are left out, and nested keys are left out
+    unless named in ``expand``, so they are never computed. Dotted names
+    select inside nested fields; a nested name on its own keeps all of it.
+    Either value None means no restriction. Raises ValueError for names
+    the schema does not have.
+    """
+    if only is None and expand is None:
+        return schema
+    key = (id(schema), only, expand)
+    selection = _selections.get(key)
+    if selection is not None and selection[0] is schema:
+        return selection[1]
+    selected = _select(schema, parse_selection(only),
+                       parse_selection(expand))
+    if len(_selections) >= _max_cached:
+        _selections.clear()
+    _selections[key] = (schema, selected)
+    return selected
+
+
+def _path(url):
+    return urlunparse(('', '', urlparse(url).path, '', '', ''))
+
+
+def _marshals_attributes(cls):
+    """Whether ``fields.Url`` sees instances of ``cls`` as the dict of
+    their ``attributes``.
+    """
+    return (issubclass(cls, Entity) and
+            cls.__marshallable__.__func__ is Entity.__marshallable__.__func__)
+
+
+class UrlTemplate(object):
+    """The URL of an endpoint routed as ``/prefix/<int:arg>``, and possibly
+    also as a bare ``/prefix/`` for objects without the argument, the way
+    ``url_for`` picks between them.
+    """
+    _rule = re.compile(r'^[^<>]*<int:(\w+)>$')
+    _templates = {}
+
+    def __init__(self, arg, prefix, bare):
+        self.arg = arg
+        self.prefix = prefix
+        self.bare = bare
+        # How to read arg from objects of each class: True to get it as a
+        # key, False as an attribute, None when it is absent
+        self.access = {}
+
+    @classmethod
+    def of(cls, endpoint):
+        """The template of ``endpoint`` for the current request, or None
+        when its rules need the full ``url_for``.
+        """
+        key = (endpoint, request.script_root)
+        try:
+            return cls._templates[key]
+        except KeyError:
+            template = cls._templates[key] = cls._build(endpoint)
+            return template
+
+    @classmethod
+    def _build(cls, endpoint):
+        url_map = current_app.url_map
+        if url_map.host_matching:
+            return None
+        rules = list(url_map.iter_rules(endpoint))
+        if not rules or len(rules) > 2:
+            return None
+        for rule in rules:
+            if rule.defaults or rule.alias or rule.subdomain:
+                return None
+        match = cls._rule.match(rules[0].rule)
+        if match is None or \
+                rules[0]._converters[match.group(1)].fixed_digits:
+            return None
+        arg = match.group(1)
+        bare = None
+        if len(rules) == 2:
+            if rules[1].arguments:
+                return None
+            bare = _path(url_for(endpoint))
+        probe = _path(url_for(endpoint, **{arg: 0}))
+        if not probe.endswith('0'):
+            return None
+        return cls(arg, probe[:-1], bare)
+
+    def url_of(self, obj):
+        """The URL of ``obj``, or None to leave it to ``fields.Url``."""
+        cls = type(obj)
+        try:
+            access = self.access[cls]
+        except KeyError:
+            if cls is dict:
+                access = True
+            elif _marshals_attributes(cls):
+                access = False if self.arg in cls.attributes else None
+            else:
+                return None
+            self.access[cls] = access
+        if access:
+            value = obj.get(self.arg)
+        elif access is None:
+            value = None
+        else:
+            value = getattr(obj, self.arg)
+        if value is None:
+            # url_for leaves out None values
+            return self.bare
+        return self.prefix + str(int(value))
+
+
+class Urls(dict):
+    """URL templates by endpoint, looked up once per ``serialize`` call."""
+
+    def __missing__(self, endpoint):
+        template = self[endpoint] = UrlTemplate.of(endpoint)
+        return template
+
+
+def serialize(data, fields, envelope=None):
+    """``marshal(data, fields, envelope)`` with the compiled ``fields``.
+    Call it while handling a request, as URLs are made for it.
+    """
+    result = compile_fields(fields)(data, Urls())
+    return OrderedDict([(envelope, result)]) if envelope else result
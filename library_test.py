@@ -1,14 +1,40 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from __future__ import print_function, unicode_literals
-from datetime import datetime
+from datetime import datetime, timedelta
 from library import *
+import library
+import io
+import json
+import logging
+import os
+import shutil
+import sys
 import sqlite3
+import tempfile
+import threading
 import unittest
 
 __author__ = 'shunghsiyu'
 
 
+class RecordingCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        self.connection.statements.append((sql, parameters))
+        return super(RecordingCursor, self).execute(sql, parameters)
+
+
+class RecordingConnection(LibraryConnection):
+    """Remembers every statement run through its cursors."""
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingConnection, self).__init__(*args, **kwargs)
+        self.statements = []
+
+    def cursor(self, factory=RecordingCursor):
+        return super(RecordingConnection, self).cursor(factory)
+
+
 class LibrarySQL(unittest.TestCase):
     db_path = ':memory:'
     create_script = 'library.ddl'
@@ -156,6 +182,16 @@ class LibrarySQL(unittest.TestCase):
         self.assertIsNotNone(copy.number)
         self.assertEqual(copy.book_id, book_id)
         self.assertEqual(copy.lib_id, lib_id)
+        has_returning = library._has_returning
+        try:
+            for library._has_returning in (True, False):
+                previous = copy
+                copy = Copies.add(self.conn, book_id, lib_id)
+                self.assertEqual(copy.number, previous.number + 1)
+                self.assertEqual(Copies.get(self.conn, copy.copy_id).number,
+                                 copy.number)
+        finally:
+            library._has_returning = has_returning
 
     def test_get_copies(self):
         publisher_id = self.add_publisher()
@@ -276,6 +312,39 @@ class LibrarySQL(unittest.TestCase):
         self.assertIsNotNone(reserve)
         self.assertIsNone(copy.reserver())
 
+    def test_copy_state_follows_history(self):
+        reader = Readers.get(self.conn, self.add_reader())
+        other = Readers.get(self.conn, self.add_reader(phone='5550000'))
+        publisher_id = self.add_publisher()
+        book_id = self.add_book(publisher_id=publisher_id)
+        lib_id = self.add_branch()
+        copy = Copies.add(self.conn, book_id, lib_id)
+        idle = Copies.add(self.conn, book_id, lib_id)
+
+        def state():
+            return self.conn.execute('SELECT state, holderId FROM Copy '
+                                     'WHERE copyId = ?',
+                                     (copy.copy_id,)).fetchone()
+
+        self.assertEqual(state(), ('available', None))
+        reader.reserve(copy)
+        self.assertEqual(state(), ('reserved', reader.reader_id))
+        with self.assertRaises(CopyNotAvailableError):
+            other.checkout(copy)
+        self.assertEqual(state(), ('reserved', reader.reader_id))
+        reader.checkout(copy)
+        self.assertEqual(state(), ('borrowed', reader.reader_id))
+        self.assertEqual(copy.borrower().reader_id, reader.reader_id)
+        self.assertIsNone(copy.reserver())
+        self.assertEqual([c.copy_id for c in
+                          Copies.get_all(self.conn, available=False)],
+                         [copy.copy_id])
+        self.assertEqual([c.copy_id for c in
+                          Copies.get_all(self.conn, available=True)],
+                         [idle.copy_id])
+        reader.retrn(copy)
+        self.assertEqual(state(), ('available', None))
+
     def test_borrow_get_borrows_reader(self):
         start_time = datetime.utcnow()
         reader = Readers.get(self.conn, self.add_reader())
@@ -320,6 +389,503 @@ class LibrarySQL(unittest.TestCase):
         self.assertIsNotNone(checkout.fine)
         self.assertEqual(checkout.fine, Decimal('0'))
 
+    def test_retrn_overdue_fine(self):
+        reader = Readers.get(self.conn, self.add_reader())
+        publisher_id = self.add_publisher()
+        book_id = self.add_book(publisher_id=publisher_id)
+        lib_id = self.add_branch()
+        copy = Copies.add(self.conn, book_id, lib_id)
+        has_returning = library._has_returning
+        try:
+            for library._has_returning in (True, False):
+                borrow = Borrows.add(self.conn, copy, reader)
+                with self.conn:
+                    self.conn.execute('UPDATE Borrowed SET bDatetime = ? '
+                                      'WHERE borrowId = ?',
+                                      (borrow.b_datetime - timedelta(days=25),
+                                       borrow.borrow_id))
+                returned = reader.retrn(copy)
+                self.assertEqual(returned.borrow_id, borrow.borrow_id)
+                self.assertEqual(returned.fine, Decimal('1.00'))
+                with self.assertRaises(CannotReturnCopyError):
+                    reader.retrn(copy)
+                reader.reserve(copy)
+                cancelled = reader.cancel(copy)
+                self.assertFalse(cancelled.is_reserved)
+                with self.assertRaises(CannotCancelReservationError):
+                    reader.cancel(copy)
+        finally:
+            library._has_returning = has_returning
+
+    def test_overdue_borrows(self):
+        reader = Readers.get(self.conn, self.add_reader())
+        publisher_id = self.add_publisher()
+        book_id = self.add_book(publisher_id=publisher_id)
+        lib_id = self.add_branch()
+        now = datetime(2015, 3, 1, 12, 0)
+        borrow_ids = []
+        for days in (21, 25, 20):
+            borrow = reader.checkout(Copies.add(self.conn, book_id, lib_id))
+            with self.conn:
+                self.conn.execute('UPDATE Borrowed SET bDatetime = ? '
+                                  'WHERE borrowId = ?',
+                                  (now - timedelta(days=days, hours=1),
+                                   borrow.borrow_id))
+            borrow_ids.append(borrow.borrow_id)
+
+        overdue = Borrows.get_overdue(self.conn, now)
+        self.assertEqual([(o['borrow'].borrow_id, o['days_overdue'], o['fine'])
+                          for o in overdue],
+                         [(borrow_ids[1], 5, Decimal('1.00')),
+                          (borrow_ids[0], 1, Decimal('0.20'))])
+        self.assertEqual(len(Borrows.get_overdue(self.conn, now, limit=1)), 1)
+        self.assertEqual(Borrows.get_accrued_fine(self.conn, reader, now),
+                         Decimal('1.20'))
+        self.assertEqual(reader.accrued_fine(),
+                         Borrows.get_accrued_fine(self.conn, reader))
+        out = io.BytesIO()
+        write_overdue(self.conn, out, now)
+        self.assertEqual(len(out.getvalue().splitlines()), 3)
+
+    def test_add_many_readers(self):
+        first_id = self.add_reader()
+        reader_ids = Readers.add_many(self.conn, [('B', 'An Address', '1'),
+                                                  ('C', 'An Address', '2')])
+        self.assertEqual(reader_ids, [first_id + 1, first_id + 2])
+        self.assertEqual(Readers.get(self.conn, reader_ids[1]).name, 'C')
+
+    def test_add_many_books_fail(self):
+        publisher_id = self.add_publisher()
+        rows = [('A Book', '1', publisher_id, datetime(2015, 1, 1)),
+                ('A Book', '1', publisher_id, datetime(2015, 1, 1))]
+        with self.assertRaises(AddBookError):
+            Books.add_many(self.conn, rows)
+        self.assertEqual(Books.get_all(self.conn), [])
+
+    def test_add_many_copies_numbered(self):
+        publisher_id = self.add_publisher()
+        book_id = self.add_book(publisher_id=publisher_id)
+        lib_id = self.add_branch()
+        self.add_copy(1, book_id, lib_id)
+        copy_ids = Copies.add_many(self.conn, [(book_id, lib_id)] * 3)
+        self.assertEqual([Copies.get(self.conn, copy_id).number
+                          for copy_id in copy_ids], [2, 3, 4])
+
+    def test_add_copies_concurrently(self):
+        directory = tempfile.mkdtemp()
+        db_path = os.path.join(directory, 'library.db')
+        try:
+            conn = start(db_path, self.create_script)
+            with conn:
+                conn.execute("INSERT INTO Publisher VALUES (1, 'P', 'A')")
+                conn.execute("INSERT INTO Branch VALUES (1, 'B', 'L')")
+                conn.execute("INSERT INTO Book VALUES (1, 'T', 'I', 1, '2015-01-01')")
+            errors = []
+
+            def add_copies():
+                thread_conn = start(db_path, self.create_script)
+                try:
+                    for i in range(10):
+                        Copies.add(thread_conn, 1, 1)
+                        Copies.add_many(thread_conn, [(1, 1)] * 5)
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    thread_conn.close()
+
+            threads = [threading.Thread(target=add_copies) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            numbers = [copy.number for copy in Copies.get_all(conn)]
+            conn.close()
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(numbers), list(range(1, 4 * 10 * 6 + 1)))
+
+    def test_checkout_concurrently(self):
+        directory = tempfile.mkdtemp()
+        db_path = os.path.join(directory, 'library.db')
+        try:
+            conn = start(db_path, self.create_script)
+            publisher = Publishers.add(conn, 'P', 'A')
+            book = Books.add(conn, 'T', 'I', publisher.publisher_id,
+                             datetime(2015, 1, 1))
+            branch = Branches.add(conn, 'B', 'L')
+            copy_ids = Copies.add_many(conn, [(book.book_id, branch.lib_id)]
+                                       * 30)
+            reader_ids = Readers.add_many(conn, [('R', 'A', str(i))
+                                                 for i in range(6)])
+            Readers.get(conn, reader_ids[0]).reserve(
+                Copies.get(conn, copy_ids[0]))
+            errors = []
+
+            def checkout(reader_id):
+                thread_conn = connect(db_path)
+                try:
+                    reader = Readers.get(thread_conn, reader_id)
+                    for copy_id in copy_ids:
+                        try:
+                            reader.checkout(Copies.get(thread_conn, copy_id))
+                        except (CopyNotAvailableError, OverBorrowError):
+                            pass
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    thread_conn.close()
+
+            threads = [threading.Thread(target=checkout, args=(reader_id,))
+                       for reader_id in reader_ids]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            lent = conn.execute('SELECT copyId, readerId FROM Borrowed'
+                                ).fetchall()
+            conn.close()
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(lent), len(set(copy_id for copy_id, _ in lent)))
+        self.assertIn((copy_ids[0], reader_ids[0]), lent)
+        for reader_id in reader_ids:
+            self.assertLessEqual(sum(1 for _, r in lent if r == reader_id),
+                                 Borrows.max_active_borrows + 1)
+
+    def test_average_fine_readers(self):
+        publisher_id = self.add_publisher()
+        book_id = self.add_book(publisher_id=publisher_id)
+        copy_id = self.add_copy(1, book_id, self.add_branch())
+        fined = self.add_reader()
+        idle = self.add_reader(phone='5550000')
+        with self.conn:
+            self.conn.executemany("""
+                                  INSERT INTO
+                                    Borrowed (copyId, readerId, bDatetime,
+                                              rDatetime, fineCents)
+                                  VALUES (?, ?, ?, ?, ?)
+                                  """,
+                                  [(copy_id, fined, datetime(2015, 1, 1),
+                                    datetime(2015, 2, 1), 220),
+                                   (copy_id, fined, datetime(2015, 3, 1),
+                                    datetime(2015, 3, 2), 0)])
+        results = Readers.average_fine(self.conn)
+        self.assertEqual([(result['reader'].reader_id, result['fine'])
+                          for result in results],
+                         [(fined, Decimal('1.1')), (idle, Decimal('0'))])
+        self.assertTrue(all(isinstance(result['fine'], Decimal)
+                            for result in results))
+        self.assertIs(results[0]['reader'], Readers.get(self.conn, fined))
+
+    def test_branch_borrow_counts(self):
+        publisher_id = self.add_publisher()
+        popular = Books.get(self.conn, self.add_book(isbn='1',
+                                                     publisher_id=publisher_id))
+        other = Books.get(self.conn, self.add_book(isbn='2',
+                                                   publisher_id=publisher_id))
+        branch = Branches.get(self.conn, self.add_branch())
+        reader = Readers.get(self.conn, self.add_reader())
+        copy = Copies.add(self.conn, popular.book_id, branch.lib_id)
+        for i in range(3):
+            reader.checkout(copy)
+            reader.retrn(copy)
+        reader.checkout(Copies.add(self.conn, other.book_id, branch.lib_id))
+
+        expected = [(popular.book_id, 3), (other.book_id, 1)]
+        self.assertEqual([(row['book'].book_id, row['times'])
+                          for row in branch.most_borrowed_books()], expected)
+        self.assertEqual([(row['book'].book_id, row['times'])
+                          for row in branch.most_borrowed_books(1)],
+                         expected[:1])
+        self.assertEqual([(row['reader'].reader_id, row['times'])
+                          for row in branch.frequent_borrowers()],
+                         [(reader.reader_id, 4)])
+
+        with self.conn:
+            self.conn.execute('DELETE FROM MostBorrowed')
+        rebuild_borrow_counts(self.conn)
+        self.assertEqual([(row['book'].book_id, row['times'])
+                          for row in branch.most_borrowed_books()], expected)
+
+    def test_connection_pool(self):
+        directory = tempfile.mkdtemp()
+        try:
+            pool = ConnectionPool(os.path.join(directory, 'library.db'),
+                                  self.create_script, size=2, timeout=0.01)
+            with pool.connection() as conn:
+                self.assertIs(pool.acquire(), conn)
+                pool.release(conn)
+                Readers.add(conn, 'A Reader', 'An Address', '1')
+                self.assertIsNotNone(Readers.get(conn, 1))
+                held = []
+
+                def acquire():
+                    try:
+                        held.append(pool.acquire())
+                    except PoolTimeoutError as e:
+                        held.append(e)
+
+                for i in range(2):
+                    thread = threading.Thread(target=acquire)
+                    thread.start()
+                    thread.join()
+                self.assertIsNot(held[0], conn)
+                self.assertIsInstance(held[1], PoolTimeoutError)
+            self.assertIsNone(conn.identity_map.get(Reader, 1))
+
+            conn.close()
+            with pool.connection() as healthy:
+                self.assertIsNot(healthy, conn)
+                self.assertEqual(Readers.get(healthy, 1).name, 'A Reader')
+            pool.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_start_profiles(self):
+        directory = tempfile.mkdtemp()
+        try:
+            db_path = os.path.join(directory, 'library.db')
+            conn = start(db_path, self.create_script)
+            self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone(),
+                             ('wal',))
+            self.assertEqual(conn.execute('PRAGMA busy_timeout').fetchone(),
+                             (5000,))
+            conn.close()
+            conn = connect(db_path, {'synchronous': 'OFF'})
+            self.assertEqual(conn.execute('PRAGMA synchronous').fetchone(),
+                             (0,))
+            with self.assertRaises(ValueError):
+                apply_profile(conn, {'journal_mode': 'OFF; DROP TABLE Book'})
+            with self.assertRaises(ValueError):
+                apply_profile(conn, {'writable_schema': 1})
+            conn.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def query_plans(self, call):
+        """EXPLAIN QUERY PLAN of every SELECT and UPDATE that ``call`` runs."""
+        del self.conn.statements[:]
+        call()
+        plans = []
+        for sql, values in list(self.conn.statements):
+            if sql.strip().upper().startswith(('SELECT', 'UPDATE')):
+                rows = self.conn.execute('EXPLAIN QUERY PLAN ' + sql,
+                                         values).fetchall()
+                plans.append(' | '.join(row[-1] for row in rows))
+        return plans
+
+    def assertPlanUses(self, call, index):
+        plans = self.query_plans(call)
+        self.assertTrue(any(index in plan for plan in plans),
+                        '{} not used by {}'.format(index, plans))
+
+    def test_active_queries_use_partial_indexes(self):
+        self.conn.close()
+        self.conn = sqlite3.connect(':memory:', factory=RecordingConnection)
+        create_tables(self.conn, self.create_script)
+        reader = Readers.get(self.conn, self.add_reader())
+        publisher_id = self.add_publisher()
+        book_id = self.add_book(publisher_id=publisher_id)
+        copy = Copies.add(self.conn, book_id, self.add_branch())
+
+        reader.reserve(copy)
+        self.assertPlanUses(
+            lambda: Reserves.get_num_active_reserved_by(self.conn, reader),
+            'COVERING INDEX idx_reserved__active')
+        self.assertPlanUses(
+            lambda: Reserves.get_active_reserver(self.conn, copy),
+            'Copy USING INTEGER PRIMARY KEY')
+        self.assertPlanUses(lambda: reader.cancel(copy),
+                            'idx_reserved__active')
+
+        reader.checkout(copy)
+        self.assertPlanUses(
+            lambda: Borrows.get_num_active_borrowed_by(self.conn, reader),
+            'COVERING INDEX idx_borrowed__active')
+        self.assertPlanUses(
+            lambda: Borrows.get_active_borrower(self.conn, copy),
+            'Copy USING INTEGER PRIMARY KEY')
+        self.assertPlanUses(lambda: reader.retrn(copy),
+                            'idx_borrowed__active')
+        self.assertPlanUses(lambda: Borrows.get_overdue(self.conn),
+                            'COVERING INDEX idx_borrowed__active_bdatetime')
+
+    def test_reader_dashboard(self):
+        self.conn.close()
+        self.conn = sqlite3.connect(':memory:', factory=RecordingConnection)
+        create_tables(self.conn, self.create_script)
+        reader = Readers.get(self.conn, self.add_reader())
+        publisher_id = self.add_publisher()
+        lib_id = self.add_branch()
+        copies = []
+        for i in range(4):
+            book_id = self.add_book(isbn=str(i), publisher_id=publisher_id)
+            copies.append(Copies.add(self.conn, book_id, lib_id))
+        author = Authors.add(self.conn, 'An Author')
+        with self.conn:
+            self.conn.execute('INSERT INTO Wrote (authorId, bookId) '
+                              'VALUES (?, ?)',
+                              (author.author_id, copies[0].book_id))
+        for i in range(5):
+            reader.checkout(copies[3])
+            reader.retrn(copies[3])
+        borrow = reader.checkout(copies[0])
+        reader.checkout(copies[1])
+        reader.reserve(copies[2])
+        with self.conn:
+            self.conn.execute('UPDATE Borrowed SET bDatetime = ? '
+                              'WHERE borrowId = ?',
+                              (borrow.b_datetime - timedelta(days=22),
+                               borrow.borrow_id))
+
+        del self.conn.statements[:]
+        dashboard = reader.dashboard()
+        self.assertEqual(len(self.conn.statements), 3)
+        self.assertEqual([loan['copy'].copy_id for loan in dashboard['loans']],
+                         [copies[0].copy_id, copies[1].copy_id])
+        self.assertEqual([loan['days_overdue'] for loan in dashboard['loans']],
+                         [2, 0])
+        self.assertEqual(dashboard['accrued_fine'], Decimal('0.40'))
+        self.assertEqual([item['copy'].copy_id
+                          for item in dashboard['reserves']],
+                         [copies[2].copy_id])
+        del self.conn.statements[:]
+        loan = dashboard['loans'][0]
+        self.assertEqual([a.name for a in loan['copy'].get_book().get_authors()],
+                         ['An Author'])
+        self.assertEqual(loan['copy'].get_branch().lib_id, lib_id)
+        self.assertIs(loan['copy'].borrower(), reader)
+        self.assertIsNone(dashboard['reserves'][0]['copy'].borrower())
+        self.assertEqual(self.conn.statements, [])
+
+        plans = self.query_plans(reader.dashboard)
+        self.assertIn('idx_borrowed__active', plans[0])
+        self.assertIn('idx_reserved__active', plans[1])
+
+    def test_serialize_same_json_as_marshal(self):
+        from flask.ext.restful import marshal
+        from library_api import app, marshall_fields
+        from library_serializers import serialize
+        import json
+        book_id = self.add_book(publisher_id=self.add_publisher())
+        self.add_wrote(self.add_author(), book_id)
+        lib_id = self.add_branch()
+        copies = [Copies.add(self.conn, book_id, lib_id) for i in range(3)]
+        reader = Readers.get(self.conn, self.add_reader())
+        borrow = reader.checkout(copies[0])
+        reader.retrn(copies[0])
+        reserve = reader.reserve(copies[1])
+        cases = [(Books.get_all(self.conn), 'Book'),
+                 (copies, 'Copy'),
+                 (copies, 'CopySimple'),
+                 (Borrows.get(self.conn, borrow.borrow_id), 'Borrow'),
+                 (reserve, 'Reserve'),
+                 (reader, 'Reader'),
+                 (reader.dashboard(), 'Dashboard'),
+                 ({'name': 'No id'}, 'AuthorUri')]
+        with app.test_request_context():
+            for data, name in cases:
+                self.assertEqual(
+                    json.dumps(serialize(data, marshall_fields[name],
+                                         envelope='items')),
+                    json.dumps(marshal(data, marshall_fields[name],
+                                       envelope='items')))
+
+    def test_select_fields(self):
+        from library_api import marshall_fields
+        from library_serializers import select_fields
+        book = marshall_fields['Book']
+        self.assertIs(select_fields(book), book)
+        self.assertEqual(list(select_fields(book, 'title,uri')),
+                         [key for key in book if key in ('title', 'uri')])
+        self.assertEqual(set(select_fields(book, expand='')),
+                         set(['book_id', 'title', 'ISBN', 'publish_date',
+                              'uri']))
+        selected = select_fields(book, 'title,copies.number', 'copies')
+        self.assertEqual(set(selected), set(['title', 'copies']))
+        self.assertEqual(list(selected['copies'].nested), ['number'])
+        selected = select_fields(book, expand='copies.branch')
+        self.assertNotIn('authors', selected)
+        self.assertIn('branch', selected['copies'].nested)
+        self.assertIn('is_available', selected['copies'].nested)
+        self.assertIs(select_fields(book, expand='copies.branch'), selected)
+        self.assertRaises(ValueError, select_fields, book, 'nope')
+        self.assertRaises(ValueError, select_fields, book, None, 'title')
+
+    def test_import_catalog(self):
+        from library_import import import_catalog, read_csv, read_json_lines
+        self.add_publisher()
+        lib_id = self.add_branch()
+        self.add_book(publisher_id=1)
+        catalog = io.BytesIO(
+            'title,isbn,publish_date,publisher,publisher_address,authors,copies\n'
+            'Old,123-457-1576,2015-01-01,A Publisher,,,\n'
+            'New,1,2015-02-01,New Publisher,1 Road,Ann; Bob,A Branch=2\n'
+            'Again,1,2015-03-01,A Publisher,,Ann,\n'
+            'Lost,2,2015-03-01,A Publisher,,,Nowhere=1\n'
+            'Late,3,March 2015,A Publisher,,,\n'
+            'Addressless,4,2015-03-01,Other Publisher,,,\n'
+            'Next,5,2015-04-01,New Publisher,,Bob,A Branch\n'.encode('utf-8'))
+        reports = []
+        stats = import_catalog(self.conn, read_csv(catalog), batch_size=2,
+                               report=lambda *args: reports.append(args))
+        self.assertEqual(stats, dict(books=2, copies=3, publishers=1,
+                                     authors=2, duplicates=2, rejected=3))
+        self.assertEqual([(line_num, isbn) for line_num, isbn, problem
+                          in sorted(reports)],
+                         [(2, '123-457-1576'), (4, '1'), (5, '2'), (6, '3'),
+                          (7, '4')])
+        new, following = Books.get_all(self.conn, publisher_name='New Publisher')
+        self.assertEqual([author.name for author in new.get_authors()],
+                         ['Ann', 'Bob'])
+        self.assertEqual([author.name for author in following.get_authors()],
+                         ['Bob'])
+        self.assertEqual([(copy.lib_id, copy.number)
+                          for copy in new.get_copies()],
+                         [(lib_id, 1), (lib_id, 2)])
+        self.assertEqual(set(book.book_id
+                             for book in Books.search(self.conn, 'bob')),
+                         set([new.book_id, following.book_id]))
+
+        # A line that is not a JSON object is reported and skipped
+        catalog = io.BytesIO(
+            '{"title": "Json", "isbn": "6", "publish_date": "2015-05-01",'
+            ' "publisher": "A Publisher", "authors": ["Cy"],'
+            ' "copies": {"A Branch": 2}}\n'
+            '{"title": "Broken", \n'
+            '\n'
+            '["not", "an", "object"]\n'
+            '{"title": "Copies", "isbn": "7", "copies": [1]}\n'
+            '{"title": "Json", "isbn": "6", "publish_date": "2015-05-01",'
+            ' "publisher": "A Publisher"}\n'.encode('utf-8'))
+        reports = []
+        stats = import_catalog(self.conn, read_json_lines(catalog),
+                               report=lambda *args: reports.append(args))
+        self.assertEqual(stats, dict(books=1, copies=2, publishers=0,
+                                     authors=1, duplicates=1, rejected=3))
+        self.assertEqual([(line_num, isbn) for line_num, isbn, problem
+                          in sorted(reports)],
+                         [(2, ''), (4, ''), (5, ''), (6, '6')])
+        json_book, = Books.get_all(self.conn, title='Json')
+        self.assertEqual([author.name for author in json_book.get_authors()],
+                         ['Cy'])
+
+    def test_migrate_copy_numbers(self):
+        self.conn.execute('DROP INDEX idx_copy__bookid_libid_number')
+        self.conn.execute('PRAGMA user_version = 0')
+        publisher_id = self.add_publisher()
+        book_id = self.add_book(publisher_id=publisher_id)
+        lib_id = self.add_branch()
+        copy_ids = [self.add_copy(number, book_id, lib_id)
+                    for number in (1, 1, 2)]
+        migrate(self.conn, target=1)
+        self.assertEqual([Copies.get(self.conn, copy_id).number
+                          for copy_id in copy_ids], [1, 3, 2])
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.add_copy(1, book_id, lib_id)
+
     def test_search_title_books_empty(self):
         publisher_id = self.add_publisher()
         self.add_book(publisher_id=publisher_id)
@@ -364,6 +930,242 @@ class LibrarySQL(unittest.TestCase):
         self.assertEqual(books[0].publisher_id, book.publisher_id)
         self.assertEqual(books[0].publish_date, book.publish_date)
 
+    def test_search_books_ranked(self):
+        publisher_id = self.add_publisher(name='Darkside Press')
+        by_publisher = self.add_book(title='Some Book', isbn='1',
+                                     publisher_id=publisher_id)
+        by_title = self.add_book(title='Darkness Falls', isbn='2',
+                                 publisher_id=publisher_id)
+        by_author = self.add_book(title='Other Book', isbn='3',
+                                  publisher_id=publisher_id)
+        self.add_wrote(self.add_author(name='Ann Darke'), by_author)
+        self.assertEqual([book.book_id for book in
+                          Books.search(self.conn, 'dark')],
+                         [by_title, by_author, by_publisher])
+        self.assertEqual([book.book_id for book in
+                          Books.search(self.conn, 'dark', limit=1, offset=1)],
+                         [by_author])
+        self.assertEqual([book.book_id for book in
+                          Books.search(self.conn, 'ann other')], [by_author])
+        self.assertEqual(Books.search(self.conn, '"*'), [])
+
+    def test_search_books_follows_renames(self):
+        publisher_id = self.add_publisher()
+        book_id = self.add_book(publisher_id=publisher_id)
+        author_id = self.add_author()
+        self.add_wrote(author_id, book_id)
+        with self.conn:
+            self.conn.execute('UPDATE Author SET name = ? WHERE authorId = ?',
+                              ('Renamed Writer', author_id))
+            self.conn.execute('UPDATE Publisher SET name = ? '
+                              'WHERE publisherId = ?',
+                              ('Renamed House', publisher_id))
+        self.assertEqual(Books.search(self.conn, 'author'), [])
+        self.assertEqual([book.book_id for book in
+                          Books.search(self.conn, 'writer house')], [book_id])
+
+    def test_prefetch_books(self):
+        publisher_id = self.add_publisher()
+        book_id = self.add_book(publisher_id=publisher_id)
+        lib_id = self.add_branch()
+        author_id = self.add_author()
+        self.add_wrote(author_id, book_id)
+        borrowed_id = self.add_copy(1, book_id, lib_id)
+        reserved_id = self.add_copy(2, book_id, lib_id)
+        reader = Readers.get(self.conn, self.add_reader())
+        reader.checkout(Copies.get(self.conn, borrowed_id))
+        reader.reserve(Copies.get(self.conn, reserved_id))
+        books = Books.prefetch(self.conn, Books.get_all(self.conn))
+        # Prefetched relations must not go back to the database
+        self.conn.close()
+        self.assertEqual(len(books), 1)
+        book = books[0]
+        self.assertEqual(book.get_publisher().publisher_id, publisher_id)
+        self.assertEqual([a.author_id for a in book.get_authors()],
+                         [author_id])
+        copies = dict((copy.copy_id, copy) for copy in book.get_copies())
+        self.assertEqual(set(copies), set([borrowed_id, reserved_id]))
+        for copy in copies.values():
+            self.assertIs(copy.get_book(), book)
+            self.assertEqual(copy.get_branch().lib_id, lib_id)
+        self.assertEqual(copies[borrowed_id].borrower().reader_id,
+                         reader.reader_id)
+        self.assertIsNone(copies[borrowed_id].reserver())
+        self.assertEqual(copies[reserved_id].reserver().reader_id,
+                         reader.reader_id)
+        self.assertIsNone(copies[reserved_id].borrower())
+
+    def test_identity_map_same_instance(self):
+        publisher_id = self.add_publisher()
+        book_id = self.add_book(publisher_id=publisher_id)
+        lib_id = self.add_branch()
+        copy_id = self.add_copy(1, book_id, lib_id)
+        reader_id = self.add_reader()
+        self.assertIs(Readers.get(self.conn, reader_id),
+                      Readers.get(self.conn, reader_id))
+        self.assertIs(Branches.get(self.conn, lib_id),
+                      Branches.get_all(self.conn)[0])
+        self.assertIs(Books.get(self.conn, book_id),
+                      Books.get_all(self.conn)[0])
+        copy = Copies.get(self.conn, copy_id)
+        self.assertIs(copy, Copies.get_copies_of(self.conn, book_id)[0])
+        self.assertIs(copy.get_branch(), Branches.get(self.conn, lib_id))
+
+    def test_identity_map_invalidated_by_writes(self):
+        publisher_id = self.add_publisher()
+        book_id = self.add_book(publisher_id=publisher_id)
+        lib_id = self.add_branch()
+        copy_id = self.add_copy(1, book_id, lib_id)
+        reader = Readers.get(self.conn, self.add_reader())
+        book = Books.prefetch(self.conn, [Books.get(self.conn, book_id)])[0]
+        copy = Copies.get(self.conn, copy_id)
+        self.assertIs(copy, book.get_copies()[0])
+        self.assertIsNone(copy.borrower())
+        reader.checkout(copy)
+        self.assertIsNot(Copies.get(self.conn, copy_id), copy)
+        self.assertEqual(copy.borrower().reader_id, reader.reader_id)
+        Copies.add(self.conn, book_id, lib_id)
+        self.assertEqual(len(book.get_copies()), 2)
+
+    def test_table_versions_follow_writes(self):
+        tables = ('Book', 'Copy', 'Borrowed', 'Reader')
+        before = table_versions(self.conn, tables)
+        self.assertEqual(set(before), set(tables))
+        publisher_id = self.add_publisher()
+        book_id = self.add_book(publisher_id=publisher_id)
+        copy = Copies.get(self.conn, self.add_copy(1, book_id,
+                                                   self.add_branch()))
+        added = table_versions(self.conn, tables)
+        self.assertEqual(added['Book'][0], before['Book'][0] + 1)
+        self.assertEqual(added['Copy'][0], before['Copy'][0] + 1)
+        self.assertEqual(added['Borrowed'], before['Borrowed'])
+        Readers.get(self.conn, self.add_reader()).checkout(copy)
+        borrowed = table_versions(self.conn, tables)
+        self.assertEqual(borrowed['Book'], added['Book'])
+        self.assertGreater(borrowed['Copy'][0], added['Copy'][0])
+        self.assertGreater(borrowed['Borrowed'][0], added['Borrowed'][0])
+
+    def test_query_log(self):
+        reader_ids = [self.add_reader(phone=str(i)) for i in range(3)]
+        self.conn.query_log = log = QueryLog()
+        self.assertEqual(len(Readers.get_many(self.conn, reader_ids)), 3)
+        library._invalidate(self.conn)
+        self.assertEqual(Readers.get(self.conn, reader_ids[0]).reader_id,
+                         reader_ids[0])
+        Readers.add_many(self.conn, [('A', 'B', 'x'), ('C', 'D', 'y')])
+        self.assertEqual(log.count, 4)
+        select_many, select_one, insert, last_id = log.statements
+        self.assertIn('IN (?...)', select_many.sql)
+        self.assertNotIn('\n', select_many.sql)
+        self.assertEqual((select_many.parameters, select_many.rows), (3, 3))
+        self.assertEqual((select_one.parameters, select_one.rows), (1, 1))
+        self.assertEqual((insert.parameters, insert.rows), (6, 2))
+        self.assertEqual(log.slow(), [])
+        self.assertTrue(log.seconds > 0)
+
+        self.conn.query_log = log = QueryLog(slow_seconds=0)
+        Readers.get(self.conn, reader_ids[1])
+        self.assertEqual(len(log.slow()), 1)
+        self.assertIsNone(log.slow()[0].plan)
+        log.explain(self.conn)
+        self.assertIn('USING INTEGER PRIMARY KEY', log.slow()[0].plan[0])
+        self.conn.query_log = None
+        Readers.get(self.conn, reader_ids[2])
+        self.assertEqual(log.count, 1)
+
+    def test_stack_profiler(self):
+        from library_profile import StackProfiler, summary
+        reader_id = self.add_reader()
+        profiler = StackProfiler()
+        profiler.start()
+        Readers.get(self.conn, reader_id)
+        profiler.stop()
+        self.assertIsNone(sys.getprofile())
+
+        lines = list(profiler.collapsed('GET /x'))
+        self.assertTrue(all(line.startswith('GET /x') for line in lines))
+        get = 'get (library.py:{})'.format(
+            Readers.get.__func__.__code__.co_firstlineno)
+        self.assertTrue(any(';' + get in line for line in lines))
+        # Each stack is rounded to a microsecond
+        self.assertAlmostEqual(sum(int(line.rsplit(' ', 1)[1])
+                                   for line in lines),
+                               profiler.seconds * 1e6, delta=len(lines))
+        calls = dict((label, calls) for label, _, _, calls
+                     in profiler.functions())
+        self.assertEqual(calls[get], 1)
+        text = summary(profiler, 'GET /x', 0.0, 0, top_n=3)
+        self.assertIn('library.py', text)
+        self.assertEqual(len(text.splitlines()), 10 + 3)
+
+    def test_slow_query_keeps_transaction(self):
+        # Explaining a slow statement must not commit its transaction
+        publisher_id = self.add_publisher()
+        rows = [('A Book', '1', publisher_id, datetime(2015, 1, 1)),
+                ('A Book', '1', publisher_id, datetime(2015, 1, 1))]
+        self.conn.query_log = log = QueryLog(slow_seconds=0)
+        with self.assertRaises(AddBookError):
+            Books.add_many(self.conn, rows)
+        self.conn.query_log = None
+        self.assertEqual(Books.get_all(self.conn), [])
+        log.explain(self.conn)
+        self.assertTrue(log.slow()[-1].plan)
+
+    def test_get_all_readers_paginated(self):
+        reader_ids = [self.add_reader(phone=str(i)) for i in range(5)]
+        page = Readers.get_all(self.conn, limit=2)
+        self.assertEqual([r.reader_id for r in page], reader_ids[:2])
+        page = Readers.get_all(self.conn, limit=2, after=page[-1].reader_id)
+        self.assertEqual([r.reader_id for r in page], reader_ids[2:4])
+        page = Readers.get_all(self.conn, limit=2, after=page[-1].reader_id)
+        self.assertEqual([r.reader_id for r in page], reader_ids[4:])
+        self.assertEqual(len(Readers.get_all(self.conn)), 5)
+
+    def test_get_all_copies_paginated(self):
+        publisher_id = self.add_publisher()
+        book_id = self.add_book(publisher_id=publisher_id)
+        lib_id = self.add_branch()
+        copy_ids = [self.add_copy(number, book_id, lib_id)
+                    for number in range(1, 4)]
+        page = Copies.get_all(self.conn, book_id=book_id, limit=2,
+                              after=copy_ids[0])
+        self.assertEqual([c.copy_id for c in page], copy_ids[1:])
+
+    def test_iter_all_borrows(self):
+        reader = Readers.get(self.conn, self.add_reader())
+        publisher_id = self.add_publisher()
+        book_id = self.add_book(publisher_id=publisher_id)
+        lib_id = self.add_branch()
+        for number in range(1, 6):
+            copy = Copies.get(self.conn, self.add_copy(number, book_id, lib_id))
+            reader.checkout(copy)
+        borrows = list(Borrows.iter_all(self.conn, chunk_size=2))
+        self.assertEqual([b.borrow_id for b in borrows],
+                         [b.borrow_id for b in Borrows.get_all(self.conn)])
+        borrows = list(Borrows.iter_all(self.conn, after=borrows[2].borrow_id))
+        self.assertEqual(len(borrows), 2)
+
+    def test_iter_all_copies_filtered(self):
+        publisher_id = self.add_publisher()
+        book_id = self.add_book(publisher_id=publisher_id)
+        other_book_id = self.add_book(isbn='1', publisher_id=publisher_id)
+        lib_id = self.add_branch()
+        copy_ids = [self.add_copy(1, book_id, lib_id),
+                    self.add_copy(2, book_id, lib_id)]
+        self.add_copy(1, other_book_id, lib_id)
+        copies = list(Copies.iter_all(self.conn, book_id=book_id, chunk_size=1))
+        self.assertEqual([c.copy_id for c in copies], copy_ids)
+
+    def test_borrow_lazy_decoding(self):
+        borrow = Borrow(self.conn, 1, 1, 1, '2015-01-01 10:00:00.000001',
+                        '2015-01-30 10:00:00', 180)
+        self.assertFalse(hasattr(borrow, '__dict__'))
+        self.assertEqual(borrow.b_datetime, datetime(2015, 1, 1, 10, 0, 0, 1))
+        self.assertEqual(borrow.r_datetime, datetime(2015, 1, 30, 10, 0, 0))
+        self.assertEqual(borrow.fine, Decimal('1.8'))
+        self.assertIs(borrow.fine, borrow.fine)
+        self.assertIsNone(Borrow(self.conn, 1, 1, 1, datetime.utcnow()).fine)
+
     dummy_reader = {'name': 'A Reader',
                     'address': 'An Address',
                     'phone': '1234567890'}
@@ -424,6 +1226,25 @@ class LibrarySQL(unittest.TestCase):
                             publish_date.strftime(date_format)))
         return c.lastrowid
 
+    dummy_author = {'name': 'An Author'}
+
+    def add_author(self, name=dummy_author['name']):
+        with self.conn as conn:
+            c = conn.cursor()
+            c.execute("""
+                      INSERT INTO Author (name)
+                      VALUES (?)
+                      """, (name,))
+        return c.lastrowid
+
+    def add_wrote(self, author_id, book_id):
+        with self.conn as conn:
+            c = conn.cursor()
+            c.execute("""
+                      INSERT INTO Wrote (authorId, bookId)
+                      VALUES (?, ?)
+                      """, (author_id, book_id))
+
     def add_copy(self, number, book_id, lib_id):
         with self.conn as conn:
             c = conn.cursor()
@@ -434,5 +1255,241 @@ class LibrarySQL(unittest.TestCase):
             copy_id = c.lastrowid
         return copy_id
 
+
+class LibraryAPI(unittest.TestCase):
+    """The web API through Flask's test client, logged in as the
+    administrator, on a database file of its own.
+    """
+
+    def setUp(self):
+        from library_api import app
+        self.directory = tempfile.mkdtemp(prefix='library_api_test')
+        self.db_path = os.path.join(self.directory, 'library.db')
+        self.conn = start(self.db_path, 'library.ddl')
+        self.app = app
+        self.config = dict(app.config)
+        app.config['DB_PATH'] = self.db_path
+        self.client = app.test_client()
+        with self.client.session_transaction() as session:
+            session['admin'] = True
+
+    def tearDown(self):
+        import library_api
+        self.conn.close()
+        library_api.get_pool().close()
+        self.app.config.clear()
+        self.app.config.update(self.config)
+        shutil.rmtree(self.directory)
+
+    def add_books(self, n):
+        publisher = Publishers.add(self.conn, 'A Publisher', 'An Address')
+        return Books.add_many(self.conn, [('Book {}'.format(i), str(i),
+                                           publisher.publisher_id,
+                                           datetime(2015, 1, 1))
+                                          for i in range(n)])
+
+    def get_json(self, url, status=200, **kwargs):
+        response = self.client.get(url, **kwargs)
+        self.assertEqual(response.status_code, status)
+        return json.loads(response.data)
+
+    def test_conditional_get(self):
+        book_id = self.add_books(1)[0]
+        url = '/api/books/{}'.format(book_id)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        self.assertTrue(etag.startswith('W/"'))
+        self.assertEqual(response.headers['Cache-Control'],
+                         'private, no-cache')
+
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        # Copy is in BookResource.depends_on
+        branch = Branches.add(self.conn, 'A Branch', 'A Location')
+        Copies.add(self.conn, book_id, branch.lib_id)
+        response = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+        # Last-Modified is only sent once the second of the last write is over
+        with self.conn:
+            self.conn.execute('UPDATE TableVersion SET modified = modified - 10')
+        response = self.client.get(url)
+        etag = response.headers['ETag']
+        modified = response.headers['Last-Modified']
+        response = self.client.get(url, headers={'If-Modified-Since': modified})
+        self.assertEqual(response.status_code, 304)
+
+        missing = '/api/books/{}'.format(book_id + 1)
+        response = self.client.get(missing, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(missing,
+                                   headers={'If-Modified-Since': modified})
+        self.assertEqual(response.status_code, 404)
+
+    def test_batch_post(self):
+        from library_api import AuthorResource
+        from werkzeug.exceptions import MethodNotAllowed
+        publisher = Publishers.add(self.conn, 'A Publisher', 'An Address')
+        items = [{'title': 'Book {}'.format(i), 'ISBN': str(i),
+                  'publisher_id': publisher.publisher_id,
+                  'publish_date': '2015-01-01'} for i in range(3)]
+        response = self.client.post('/api/books/', data=json.dumps(items),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        created = json.loads(response.data)['books']
+        self.assertEqual([book['ISBN'] for book in created], ['0', '1', '2'])
+
+        # One bad item and none of them are added
+        items = [dict(items[0], ISBN='3'), dict(items[0], ISBN='4'),
+                 dict(items[0], ISBN='0')]
+        response = self.client.post('/api/books/', data=json.dumps(items),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(len(Books.get_all(self.conn)), 3)
+
+        with self.app.test_request_context():
+            with self.assertRaises(MethodNotAllowed):
+                AuthorResource()._post_many(items)
+
+    def test_collections_paged_by_default(self):
+        book_ids = self.add_books(10)
+        self.app.config['PAGE_SIZE'] = 3
+        seen = []
+        url = '/api/books/'
+        while url is not None:
+            page = self.get_json(url)
+            self.assertLessEqual(len(page['books']), 3)
+            seen.extend(book['book_id'] for book in page['books'])
+            url = page['next']
+        self.assertEqual(seen, book_ids)
+
+        self.app.config['MAX_PAGE_SIZE'] = 5
+        self.assertEqual(len(self.get_json('/api/books/?limit=8')['books']), 5)
+
+    def test_stream(self):
+        import library_api
+        book_ids = self.add_books(7)
+        self.app.config['SLOW_QUERY_MS'] = 0
+        logged = []
+        handler = logging.Handler()
+        handler.emit = logged.append
+        library_api.slow_query_logger.addHandler(handler)
+        try:
+            response = self.client.get('/api/books/?stream=ndjson',
+                                       buffered=True)
+        finally:
+            library_api.slow_query_logger.removeHandler(handler)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line)['book_id']
+                          for line in response.data.splitlines()], book_ids)
+        self.assertNotIn('X-DB-Queries', response.headers)
+        # The statements of the body are logged after it is sent
+        self.assertTrue(any('FROM Book' in record.getMessage()
+                            for record in logged))
+
+        page = self.get_json('/api/books/?stream=json')
+        self.assertEqual([book['book_id'] for book in page['books']],
+                         book_ids)
+        self.assertIn('X-DB-Queries', self.client.get('/api/books/').headers)
+        # The searches of the web pages stream with their filters
+        page = self.get_json('/api/books/?stream=json&book_id={}'
+                             .format(book_ids[2]))
+        self.assertEqual([book['book_id'] for book in page['books']],
+                         book_ids[2:3])
+
+    def test_field_selection(self):
+        book_id = self.add_books(1)[0]
+        url = '/api/books/{}'.format(book_id)
+        book = self.get_json(url + '?fields=book_id,title')
+        self.assertEqual(sorted(book), ['book_id', 'title'])
+
+        book = self.get_json(url + '?fields=title,publisher.name')
+        self.assertEqual(sorted(book), ['publisher', 'title'])
+        self.assertEqual(book['publisher'], {'name': 'A Publisher'})
+
+        book = self.get_json(url + '?expand=authors')
+        self.assertIn('authors', book)
+        self.assertNotIn('copies', book)
+        self.assertNotIn('publisher', book)
+        self.assertEqual(book['title'], 'Book 0')
+
+        page = self.get_json('/api/books/?fields=uri')
+        self.assertEqual(page['books'], [{'uri': url}])
+
+        self.get_json(url + '?fields=title,nope', status=400)
+        self.get_json(url + '?expand=title', status=400)
+
+    def test_profile(self):
+        book_id = self.add_books(1)[0]
+        url = '/api/books/{}'.format(book_id)
+        profiles = os.path.join(self.directory, 'profiles')
+        self.app.config['PROFILE_DIR'] = profiles
+        self.app.config['PROFILE_KEEP'] = 2
+
+        reader = self.app.test_client()
+        with reader.session_transaction() as session:
+            session['reader_id'] = 1
+        response = reader.get(url, headers={'X-Profile': '1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('X-Profile-Summary', response.headers)
+        self.assertFalse(os.path.exists(profiles))
+
+        response = self.client.get(url, headers={'X-Profile': '1'})
+        self.assertEqual(response.status_code, 200)
+        summary = self.client.get(response.headers['X-Profile-Summary'])
+        self.assertEqual(summary.status_code, 200)
+        self.assertTrue(summary.data.startswith(
+            'GET {} 200\n'.format(url).encode()))
+        stacks = self.client.get(response.headers['X-Profile-Stacks'])
+        self.assertEqual(stacks.status_code, 200)
+        self.assertEqual(reader.get(response.headers['X-Profile-Stacks'])
+                         .status_code, 401)
+
+        for i in range(3):
+            self.client.get(url, headers={'X-Profile': '1'})
+        self.assertEqual(len(os.listdir(profiles)), 2 * 2)
+        self.assertEqual(self.client.get(response.headers['X-Profile-Summary'])
+                         .status_code, 404)
+
+    def test_pool_exhausted(self):
+        import library_api
+        book_id = self.add_books(1)[0]
+        self.app.config['DB_POOL_SIZE'] = 1
+        self.app.config['DB_POOL_TIMEOUT'] = 0.01
+        pool = library_api.get_pool()
+        held = threading.Event()
+        done = threading.Event()
+
+        def hold():
+            with pool.connection():
+                held.set()
+                done.wait()
+        thread = threading.Thread(target=hold)
+        thread.start()
+        try:
+            held.wait()
+            response = self.client.get('/api/books/{}'.format(book_id))
+        finally:
+            done.set()
+            thread.join()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.assertEqual(self.client.get('/api/books/{}'.format(book_id))
+                         .status_code, 200)
+
+    def test_bench_suite(self):
+        # Every route has to be either timed or listed as untimed, so a new
+        # one cannot break the suite unnoticed
+        import library_bench
+        result = library_bench.bench_suite(scale=0.01, repeat=1)
+        self.assertIn('GET /api/books/<int:book_id>', result['resources'])
+        self.assertIn('GET /api/profiles/<path:filename>', result['untimed'])
+
+
 if __name__ == '__main__':
     unittest.main()
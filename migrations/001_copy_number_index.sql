@@ -0,0 +1,15 @@
+-- Give duplicated copy numbers (left behind by concurrent Copies.add calls)
+-- the next free number of their book and branch, then make them unique.
+UPDATE Copy
+SET number = (SELECT MAX(C2.number)
+              FROM Copy C2
+              WHERE C2.bookId = Copy.bookId
+                AND C2.libId = Copy.libId) + 1
+WHERE EXISTS (SELECT *
+              FROM Copy C3
+              WHERE C3.bookId = Copy.bookId
+                AND C3.libId = Copy.libId
+                AND C3.number = Copy.number
+                AND C3.copyId < Copy.copyId);
+
+CREATE UNIQUE INDEX IF NOT EXISTS "idx_copy__bookid_libid_number" ON "Copy" ("bookId", "libId", "number");
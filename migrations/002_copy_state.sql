@@ -0,0 +1,72 @@
+ALTER TABLE "Copy" ADD COLUMN "state" TEXT NOT NULL DEFAULT 'available' CHECK ("state" IN ('available', 'borrowed', 'reserved'));
+
+ALTER TABLE "Copy" ADD COLUMN "holderId" INTEGER REFERENCES "Reader" ("readerId");
+
+CREATE INDEX "idx_copy__state" ON "Copy" ("state", "copyId");
+
+-- Backfill from the history; an active borrow wins over a reservation
+UPDATE Copy
+SET state = 'reserved',
+    holderId = (SELECT R.readerId
+                FROM Reserved R
+                WHERE R.copyId = Copy.copyId
+                  AND R.isReserved = 1
+                ORDER BY R.reserveId DESC
+                LIMIT 1)
+WHERE EXISTS (SELECT *
+              FROM Reserved R
+              WHERE R.copyId = Copy.copyId
+                AND R.isReserved = 1);
+
+UPDATE Copy
+SET state = 'borrowed',
+    holderId = (SELECT B.readerId
+                FROM Borrowed B
+                WHERE B.copyId = Copy.copyId
+                  AND B.rDatetime IS NULL
+                  AND B.fine IS NULL
+                ORDER BY B.borrowId DESC
+                LIMIT 1)
+WHERE EXISTS (SELECT *
+              FROM Borrowed B
+              WHERE B.copyId = Copy.copyId
+                AND B.rDatetime IS NULL
+                AND B.fine IS NULL);
+
+-- Copy.state and Copy.holderId follow the active borrow/reservation of a copy
+CREATE TRIGGER "trg_borrowed__checkout" AFTER INSERT ON "Borrowed"
+WHEN NEW.rDatetime IS NULL
+BEGIN
+  UPDATE Copy
+  SET state = 'borrowed', holderId = NEW.readerId
+  WHERE copyId = NEW.copyId;
+END;
+
+CREATE TRIGGER "trg_borrowed__return" AFTER UPDATE OF rDatetime ON "Borrowed"
+WHEN OLD.rDatetime IS NULL AND NEW.rDatetime IS NOT NULL
+BEGIN
+  UPDATE Copy
+  SET state = 'available', holderId = NULL
+  WHERE copyId = NEW.copyId
+    AND state = 'borrowed'
+    AND holderId = NEW.readerId;
+END;
+
+CREATE TRIGGER "trg_reserved__reserve" AFTER INSERT ON "Reserved"
+WHEN NEW.isReserved
+BEGIN
+  UPDATE Copy
+  SET state = 'reserved', holderId = NEW.readerId
+  WHERE copyId = NEW.copyId
+    AND state = 'available';
+END;
+
+CREATE TRIGGER "trg_reserved__cancel" AFTER UPDATE OF isReserved ON "Reserved"
+WHEN OLD.isReserved AND NOT NEW.isReserved
+BEGIN
+  UPDATE Copy
+  SET state = 'available', holderId = NULL
+  WHERE copyId = NEW.copyId
+    AND state = 'reserved'
+    AND holderId = NEW.readerId;
+END;
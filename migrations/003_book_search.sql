@@ -0,0 +1,76 @@
+-- Full-text catalog index: one row per book, rowid = bookId
+CREATE VIRTUAL TABLE "BookSearch" USING fts5 (
+  "title",
+  "authors",
+  "publisher",
+  tokenize = 'unicode61 remove_diacritics 1',
+  prefix = '2 3'
+);
+
+CREATE TRIGGER "trg_book__search_insert" AFTER INSERT ON "Book"
+BEGIN
+  INSERT INTO BookSearch (rowid, title, authors, publisher)
+  VALUES (NEW.bookId, NEW.title, '',
+          (SELECT name FROM Publisher WHERE publisherId = NEW.publisherId));
+END;
+
+CREATE TRIGGER "trg_book__search_update" AFTER UPDATE OF title, publisherId ON "Book"
+BEGIN
+  UPDATE BookSearch
+  SET title = NEW.title,
+      publisher = (SELECT name FROM Publisher WHERE publisherId = NEW.publisherId)
+  WHERE rowid = NEW.bookId;
+END;
+
+CREATE TRIGGER "trg_book__search_delete" AFTER DELETE ON "Book"
+BEGIN
+  DELETE FROM BookSearch WHERE rowid = OLD.bookId;
+END;
+
+CREATE TRIGGER "trg_wrote__search_insert" AFTER INSERT ON "Wrote"
+BEGIN
+  UPDATE BookSearch
+  SET authors = (SELECT group_concat(A.name, ' ')
+                 FROM Author A, Wrote W
+                 WHERE A.authorId = W.authorId
+                   AND W.bookId = NEW.bookId)
+  WHERE rowid = NEW.bookId;
+END;
+
+CREATE TRIGGER "trg_wrote__search_delete" AFTER DELETE ON "Wrote"
+BEGIN
+  UPDATE BookSearch
+  SET authors = (SELECT group_concat(A.name, ' ')
+                 FROM Author A, Wrote W
+                 WHERE A.authorId = W.authorId
+                   AND W.bookId = OLD.bookId)
+  WHERE rowid = OLD.bookId;
+END;
+
+CREATE TRIGGER "trg_author__search_update" AFTER UPDATE OF name ON "Author"
+BEGIN
+  UPDATE BookSearch
+  SET authors = (SELECT group_concat(A.name, ' ')
+                 FROM Author A, Wrote W
+                 WHERE A.authorId = W.authorId
+                   AND W.bookId = BookSearch.rowid)
+  WHERE rowid IN (SELECT bookId FROM Wrote WHERE authorId = NEW.authorId);
+END;
+
+CREATE TRIGGER "trg_publisher__search_update" AFTER UPDATE OF name ON "Publisher"
+BEGIN
+  UPDATE BookSearch
+  SET publisher = NEW.name
+  WHERE rowid IN (SELECT bookId FROM Book WHERE publisherId = NEW.publisherId);
+END;
+
+-- Index the existing catalog
+INSERT INTO BookSearch (rowid, title, authors, publisher)
+  SELECT B.bookId, B.title,
+         COALESCE((SELECT group_concat(A.name, ' ')
+                   FROM Author A, Wrote W
+                   WHERE A.authorId = W.authorId
+                     AND W.bookId = B.bookId), ''),
+         P.name
+  FROM Book B, Publisher P
+  WHERE B.publisherId = P.publisherId;
@@ -0,0 +1,70 @@
+DROP VIEW "MostBorrowed";
+
+DROP VIEW "FrequentBorrower";
+
+-- Borrow counts per branch, kept up to date by the triggers on Borrowed below
+CREATE TABLE "MostBorrowed" (
+  "libId" INTEGER NOT NULL REFERENCES "Branch" ("libId"),
+  "bookId" INTEGER NOT NULL REFERENCES "Book" ("bookId"),
+  "Times" INTEGER NOT NULL,
+  PRIMARY KEY ("libId", "bookId")
+) WITHOUT ROWID;
+
+CREATE INDEX "idx_mostborrowed__libid_times" ON "MostBorrowed" ("libId", "Times" DESC, "bookId");
+
+CREATE TABLE "FrequentBorrower" (
+  "libId" INTEGER NOT NULL REFERENCES "Branch" ("libId"),
+  "readerId" INTEGER NOT NULL REFERENCES "Reader" ("readerId"),
+  "Times" INTEGER NOT NULL,
+  PRIMARY KEY ("libId", "readerId")
+) WITHOUT ROWID;
+
+CREATE INDEX "idx_frequentborrower__libid_times" ON "FrequentBorrower" ("libId", "Times" DESC, "readerId");
+
+CREATE TRIGGER "trg_borrowed__count_insert" AFTER INSERT ON "Borrowed"
+BEGIN
+  INSERT OR IGNORE INTO MostBorrowed (libId, bookId, Times)
+    SELECT libId, bookId, 0 FROM Copy WHERE copyId = NEW.copyId;
+  UPDATE MostBorrowed
+  SET Times = Times + 1
+  WHERE (libId, bookId) = (SELECT libId, bookId FROM Copy WHERE copyId = NEW.copyId);
+
+  INSERT OR IGNORE INTO FrequentBorrower (libId, readerId, Times)
+    SELECT libId, NEW.readerId, 0 FROM Copy WHERE copyId = NEW.copyId;
+  UPDATE FrequentBorrower
+  SET Times = Times + 1
+  WHERE libId = (SELECT libId FROM Copy WHERE copyId = NEW.copyId)
+    AND readerId = NEW.readerId;
+END;
+
+CREATE TRIGGER "trg_borrowed__count_delete" AFTER DELETE ON "Borrowed"
+BEGIN
+  UPDATE MostBorrowed
+  SET Times = Times - 1
+  WHERE (libId, bookId) = (SELECT libId, bookId FROM Copy WHERE copyId = OLD.copyId);
+  DELETE FROM MostBorrowed
+  WHERE (libId, bookId) = (SELECT libId, bookId FROM Copy WHERE copyId = OLD.copyId)
+    AND Times <= 0;
+
+  UPDATE FrequentBorrower
+  SET Times = Times - 1
+  WHERE libId = (SELECT libId FROM Copy WHERE copyId = OLD.copyId)
+    AND readerId = OLD.readerId;
+  DELETE FROM FrequentBorrower
+  WHERE libId = (SELECT libId FROM Copy WHERE copyId = OLD.copyId)
+    AND readerId = OLD.readerId
+    AND Times <= 0;
+END;
+
+-- Count the existing history
+INSERT INTO MostBorrowed (libId, bookId, Times)
+  SELECT C.libId, C.bookId, COUNT(*)
+  FROM Borrowed B, Copy C
+  WHERE B.copyId = C.copyId
+  GROUP BY C.libId, C.bookId;
+
+INSERT INTO FrequentBorrower (libId, readerId, Times)
+  SELECT C.libId, B.readerId, COUNT(*)
+  FROM Borrowed B, Copy C
+  WHERE B.copyId = C.copyId
+  GROUP BY C.libId, B.readerId;
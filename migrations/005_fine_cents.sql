@@ -0,0 +1,84 @@
+-- Fines move from a TEXT column of decimal strings to whole cents. SQLite
+-- cannot change a column type in place, so Borrowed is rebuilt; dropping the
+-- old table drops its triggers, which are created again below.
+DROP VIEW "AverageFine";
+
+CREATE TABLE "Borrowed_new" (
+  "borrowId" INTEGER PRIMARY KEY AUTOINCREMENT,
+  "copyId" INTEGER NOT NULL REFERENCES "Copy" ("copyId"),
+  "readerId" INTEGER NOT NULL REFERENCES "Reader" ("readerId"),
+  "bDatetime" DATETIME NOT NULL,
+  "rDatetime" DATETIME,
+  "fineCents" INTEGER
+);
+
+INSERT INTO Borrowed_new (borrowId, copyId, readerId, bDatetime, rDatetime, fineCents)
+  SELECT borrowId, copyId, readerId, bDatetime, rDatetime,
+         CAST(ROUND(CAST(NULLIF(fine, '') AS REAL) * 100) AS INTEGER)
+  FROM Borrowed;
+
+DROP TABLE "Borrowed";
+
+ALTER TABLE "Borrowed_new" RENAME TO "Borrowed";
+
+CREATE INDEX "idx_borrowed__copyid" ON "Borrowed" ("copyId");
+
+CREATE INDEX "idx_borrowed__readerid" ON "Borrowed" ("readerId");
+
+CREATE VIEW "AverageFine" AS
+  SELECT R.readerId, AVG(B.fineCents) / 100.0
+  FROM Reader R LEFT OUTER JOIN Borrowed B ON R.readerId = B.readerId
+  GROUP BY R.readerId;
+
+CREATE TRIGGER "trg_borrowed__checkout" AFTER INSERT ON "Borrowed"
+WHEN NEW.rDatetime IS NULL
+BEGIN
+  UPDATE Copy
+  SET state = 'borrowed', holderId = NEW.readerId
+  WHERE copyId = NEW.copyId;
+END;
+
+CREATE TRIGGER "trg_borrowed__return" AFTER UPDATE OF rDatetime ON "Borrowed"
+WHEN OLD.rDatetime IS NULL AND NEW.rDatetime IS NOT NULL
+BEGIN
+  UPDATE Copy
+  SET state = 'available', holderId = NULL
+  WHERE copyId = NEW.copyId
+    AND state = 'borrowed'
+    AND holderId = NEW.readerId;
+END;
+
+CREATE TRIGGER "trg_borrowed__count_insert" AFTER INSERT ON "Borrowed"
+BEGIN
+  INSERT OR IGNORE INTO MostBorrowed (libId, bookId, Times)
+    SELECT libId, bookId, 0 FROM Copy WHERE copyId = NEW.copyId;
+  UPDATE MostBorrowed
+  SET Times = Times + 1
+  WHERE (libId, bookId) = (SELECT libId, bookId FROM Copy WHERE copyId = NEW.copyId);
+
+  INSERT OR IGNORE INTO FrequentBorrower (libId, readerId, Times)
+    SELECT libId, NEW.readerId, 0 FROM Copy WHERE copyId = NEW.copyId;
+  UPDATE FrequentBorrower
+  SET Times = Times + 1
+  WHERE libId = (SELECT libId FROM Copy WHERE copyId = NEW.copyId)
+    AND readerId = NEW.readerId;
+END;
+
+CREATE TRIGGER "trg_borrowed__count_delete" AFTER DELETE ON "Borrowed"
+BEGIN
+  UPDATE MostBorrowed
+  SET Times = Times - 1
+  WHERE (libId, bookId) = (SELECT libId, bookId FROM Copy WHERE copyId = OLD.copyId);
+  DELETE FROM MostBorrowed
+  WHERE (libId, bookId) = (SELECT libId, bookId FROM Copy WHERE copyId = OLD.copyId)
+    AND Times <= 0;
+
+  UPDATE FrequentBorrower
+  SET Times = Times - 1
+  WHERE libId = (SELECT libId FROM Copy WHERE copyId = OLD.copyId)
+    AND readerId = OLD.readerId;
+  DELETE FROM FrequentBorrower
+  WHERE libId = (SELECT libId FROM Copy WHERE copyId = OLD.copyId)
+    AND readerId = OLD.readerId
+    AND Times <= 0;
+END;
@@ -0,0 +1,9 @@
+-- The filtered columns are repeated so the index covers the active-loan
+-- lookups; the planner then prefers it over idx_borrowed__readerid
+CREATE INDEX "idx_borrowed__active"
+  ON "Borrowed" ("readerId", "copyId", "rDatetime", "fineCents")
+  WHERE "rDatetime" IS NULL AND "fineCents" IS NULL;
+
+CREATE INDEX "idx_reserved__active"
+  ON "Reserved" ("readerId", "copyId", "isReserved")
+  WHERE "isReserved" = 1;
@@ -0,0 +1,5 @@
+-- Active loans by borrow date: the overdue ones are a prefix of this index,
+-- which also covers every column the overdue listing reads
+CREATE INDEX "idx_borrowed__active_bdatetime"
+  ON "Borrowed" ("bDatetime", "copyId", "readerId", "rDatetime", "fineCents")
+  WHERE "rDatetime" IS NULL AND "fineCents" IS NULL;
@@ -0,0 +1,2 @@
+-- Lets imports find existing authors by name instead of scanning Author
+CREATE INDEX "idx_author__name" ON "Author" ("name");
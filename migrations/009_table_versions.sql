@@ -0,0 +1,207 @@
+-- One row per table, bumped by the triggers below on every write; the API
+-- derives its ETag and Last-Modified validators from these
+CREATE TABLE "TableVersion" (
+  "tableName" TEXT PRIMARY KEY,
+  "version" INTEGER NOT NULL,
+  "modified" INTEGER NOT NULL
+) WITHOUT ROWID;
+
+INSERT INTO "TableVersion" (tableName, version, modified)
+VALUES ('Author', 0, CAST(strftime('%s', 'now') AS INTEGER)),
+       ('Book', 0, CAST(strftime('%s', 'now') AS INTEGER)),
+       ('Branch', 0, CAST(strftime('%s', 'now') AS INTEGER)),
+       ('Copy', 0, CAST(strftime('%s', 'now') AS INTEGER)),
+       ('Publisher', 0, CAST(strftime('%s', 'now') AS INTEGER)),
+       ('Reader', 0, CAST(strftime('%s', 'now') AS INTEGER)),
+       ('Borrowed', 0, CAST(strftime('%s', 'now') AS INTEGER)),
+       ('Reserved', 0, CAST(strftime('%s', 'now') AS INTEGER)),
+       ('Wrote', 0, CAST(strftime('%s', 'now') AS INTEGER));
+
+CREATE TRIGGER "trg_author__version_insert" AFTER INSERT ON "Author"
+BEGIN
+  UPDATE TableVersion
+  SET version = version + 1, modified = CAST(strftime('%s', 'now') AS INTEGER)
+  WHERE tableName = 'Author';
+END;
+
+CREATE TRIGGER "trg_author__version_update" AFTER UPDATE ON "Author"
+BEGIN
+  UPDATE TableVersion
+  SET version = version + 1, modified = CAST(strftime('%s', 'now') AS INTEGER)
+  WHERE tableName = 'Author';
+END;
+
+CREATE TRIGGER "trg_author__version_delete" AFTER DELETE ON "Author"
+BEGIN
+  UPDATE TableVersion
+  SET version = version + 1, modified = CAST(strftime('%s', 'now') AS INTEGER)
+  WHERE tableName = 'Author';
+END;
+
+CREATE TRIGGER "trg_book__version_insert" AFTER INSERT ON "Book"
+BEGIN
+  UPDATE TableVersion
+  SET version = version + 1, modified = CAST(strftime('%s', 'now') AS INTEGER)
+  WHERE tableName = 'Book';
+END;
+
+CREATE TRIGGER "trg_book__version_update" AFTER UPDATE ON "Book"
+BEGIN
+  UPDATE TableVersion
+  SET version = version + 1, modified = CAST(strftime('%s', 'now') AS INTEGER)
+  WHERE tableName = 'Book';
+END;
+
+CREATE TRIGGER "trg_book__version_delete" AFTER DELETE ON "Book"
+BEGIN
+  UPDATE TableVersion
+  SET version = version + 1, modified = CAST(strftime('%s', 'now') AS INTEGER)
+  WHERE tableName = 'Book';
+END;
+
+CREATE TRIGGER "trg_branch__version_insert" AFTER INSERT ON "Branch"
+BEGIN
+  UPDATE TableVersion
+  SET version = version + 1, modified = CAST(strftime('%s', 'now') AS INTEGER)
+  WHERE tableName = 'Branch';
+END;
+
+CREATE TRIGGER "trg_branch__version_update" AFTER UPDATE ON "Branch"
+BEGIN
+  UPDATE TableVersion
+  SET version = version + 1, modified = CAST(strftime('%s', 'now') AS INTEGER)
+  WHERE tableName = 'Branch';
+END;
+
+CREATE TRIGGER "trg_branch__version_delete" AFTER DELETE ON "Branch"
+BEGIN
+  UPDATE TableVersion
+  SET version = version + 1, modified = CAST(strftime('%s', 'now') AS INTEGER)
+  WHERE tableName = 'Branch';
+END;
+
+CREATE TRIGGER "trg_copy__version_insert" AFTER INSERT ON "Copy"
+BEGIN
+  UPDATE TableVersion
+  SET version = version + 1, modified = CAST(strftime('%s', 'now') AS INTEGER)
+  WHERE tableName = 'Copy';
+END;
+
+CREATE TRIGGER "trg_copy__version_update" AFTER UPDATE ON "Copy"
+BEGIN
+  UPDATE TableVersion
+  SET version = version + 1, modified = CAST(strftime('%s', 'now') AS INTEGER)
+  WHERE tableName = 'Copy';
+END;
+
+CREATE TRIGGER "trg_copy__version_delete" AFTER DELETE ON "Copy"
+BEGIN
+  UPDATE TableVersion
+  SET version = version + 1, modified = CAST(strftime('%s', 'now') AS INTEGER)
+  WHERE tableName = 'Copy';
+END;
+
+CREATE TRIGGER "trg_publisher__version_insert" AFTER INSERT ON "Publisher"
+BEGIN
+  UPDATE TableVersion
+  SET version = version + 1, modified = CAST(strftime('%s', 'now') AS INTEGER)
+  WHERE tableName = 'Publisher';
+END;
+
+CREATE TRIGGER "trg_publisher__version_update" AFTER UPDATE ON "Publisher"
+BEGIN
+  UPDATE TableVersion
+  SET version = version + 1, modified = CAST(strftime('%s', 'now') AS INTEGER)
+  WHERE tableName = 'Publisher';
+END;
+
+CREATE TRIGGER "trg_publisher__version_delete" AFTER DELETE ON "Publisher"
+BEGIN
+  UPDATE TableVersion
+  SET version = version + 1, modified = CAST(strftime('%s', 'now') AS INTEGER)
+  WHERE tableName = 'Publisher';
+END;
+
+CREATE TRIGGER "trg_reader__version_insert" AFTER INSERT ON "Reader"
+BEGIN
+  UPDATE TableVersion
+  SET version = version + 1, modified = CAST(strftime('%s', 'now') AS INTEGER)
+  WHERE tableName = 'Reader';
+END;
+
+CREATE TRIGGER "trg_reader__version_update" AFTER UPDATE ON "Reader"
+BEGIN
+  UPDATE TableVersion
+  SET version = version + 1, modified = CAST(strftime('%s', 'now') AS INTEGER)
+  WHERE tableName = 'Reader';
+END;
+
+CREATE TRIGGER "trg_reader__version_delete" AFTER DELETE ON "Reader"
+BEGIN
+  UPDATE TableVersion
+  SET version = version + 1, modified = CAST(strftime('%s', 'now') AS INTEGER)
+  WHERE tableName = 'Reader';
+END;
+
+CREATE TRIGGER "trg_borrowed__version_insert" AFTER INSERT ON "Borrowed"
+BEGIN
+  UPDATE TableVersion
+  SET version = version + 1, modified = CAST(strftime('%s', 'now') AS INTEGER)
+  WHERE tableName = 'Borrowed';
+END;
+
+CREATE TRIGGER "trg_borrowed__version_update" AFTER UPDATE ON "Borrowed"
+BEGIN
+  UPDATE TableVersion
+  SET version = version + 1, modified = CAST(strftime('%s', 'now') AS INTEGER)
+  WHERE tableName = 'Borrowed';
+END;
+
+CREATE TRIGGER "trg_borrowed__version_delete" AFTER DELETE ON "Borrowed"
+BEGIN
+  UPDATE TableVersion
+  SET version = version + 1, modified = CAST(strftime('%s', 'now') AS INTEGER)
+  WHERE tableName = 'Borrowed';
+END;
+
+CREATE TRIGGER "trg_reserved__version_insert" AFTER INSERT ON "Reserved"
+BEGIN
+  UPDATE TableVersion
+  SET version = version + 1, modified = CAST(strftime('%s', 'now') AS INTEGER)
+  WHERE tableName = 'Reserved';
+END;
+
+CREATE TRIGGER "trg_reserved__version_update" AFTER UPDATE ON "Reserved"
+BEGIN
+  UPDATE TableVersion
+  SET version = version + 1, modified = CAST(strftime('%s', 'now') AS INTEGER)
+  WHERE tableName = 'Reserved';
+END;
+
+CREATE TRIGGER "trg_reserved__version_delete" AFTER DELETE ON "Reserved"
+BEGIN
+  UPDATE TableVersion
+  SET version = version + 1, modified = CAST(strftime('%s', 'now') AS INTEGER)
+  WHERE tableName = 'Reserved';
+END;
+
+CREATE TRIGGER "trg_wrote__version_insert" AFTER INSERT ON "Wrote"
+BEGIN
+  UPDATE TableVersion
+  SET version = version + 1, modified = CAST(strftime('%s', 'now') AS INTEGER)
+  WHERE tableName = 'Wrote';
+END;
+
+CREATE TRIGGER "trg_wrote__version_update" AFTER UPDATE ON "Wrote"
+BEGIN
+  UPDATE TableVersion
+  SET version = version + 1, modified = CAST(strftime('%s', 'now') AS INTEGER)
+  WHERE tableName = 'Wrote';
+END;
+
+CREATE TRIGGER "trg_wrote__version_delete" AFTER DELETE ON "Wrote"
+BEGIN
+  UPDATE TableVersion
+  SET version = version + 1, modified = CAST(strftime('%s', 'now') AS INTEGER)
+  WHERE tableName = 'Wrote';
+END;
@@ -0,0 +1,2 @@
+-- Readers.average_fine computes the averages itself; nothing reads the view
+DROP VIEW "AverageFine";